@@ -0,0 +1,228 @@
+import os
+import json
+import time
+from itertools import groupby
+import numpy as np
+from manifest import refresh_manifest, iter_images, load_image_columns
+from image_probe import probe_manifest
+from embedding_store import EmbeddingStore, EMBEDDINGS_DIR
+from scoring_state import connect_state, invalidate_topic, STATE_PATH
+from aesthetic_scorer import load_models, unload_models, iter_topic_scores, merge_topic_scores
+from split_data import grouped_topk
+from metrics import instrumented, stage
+
+CASCADE_TOP_K = 6  # the Xsmall split takes 4 train + 2 valid images per topic
+CALIBRATION_SAMPLE = 2048
+HOLDOUT_TOPICS = 64  # whole topics also scored with ViT-L-14 to estimate the top-k disagreement
+MARGIN_QUANTILE = 0.995  # share of calibration residuals covered by the margin
+CASCADE_STATE_PATH = "aesthetic_cascade_state.sqlite"  # kept apart from the full ViT-L-14 state
+CASCADE_REPORT = "cascade_report.json"
+# Forward-pass cost at 224px, for the compute estimate in the report
+MODEL_GFLOPS = {"vit_b_32": 4.4, "vit_l_14": 81.1}
+
+
+def score_rows(columns, rows, models, embedding_store=None):
+    """Scores of the given column rows (NaN elsewhere or where decoding failed)."""
+    scores = np.full(len(columns['path']), np.nan)
+    rows = np.sort(rows)
+    if rows.size == 0:
+        return scores
+    index = {(columns['topic_path'][r], columns['filename'][r]): r for r in rows.tolist()}
+    topics = [(topic_dir, [columns['filename'][r] for r in group])
+              for topic_dir, group in groupby(rows.tolist(), key=lambda r: columns['topic_path'][r])]
+    for topic_dir, topic_scores in iter_topic_scores(topics, models=models, embedding_store=embedding_store):
+        for fname, score in topic_scores.items():
+            scores[index[(topic_dir, fname)]] = score
+    return scores
+
+
+def calibrate(cheap, exact):
+    """Linear map cheap → exact score and the margin covering MARGIN_QUANTILE of its residuals."""
+    known = ~np.isnan(cheap) & ~np.isnan(exact)
+    if known.sum() < 2:
+        raise ValueError(f"Calibration needs at least 2 images scored by both ViT-B-32 and ViT-L-14, "
+                         f"got {int(known.sum())} (are the images readable?)")
+    slope, intercept = np.polyfit(cheap[known], exact[known], 1)
+    residuals = np.abs(exact[known] - (slope * cheap[known] + intercept))
+    return float(slope), float(intercept), float(np.quantile(residuals, MARGIN_QUANTILE))
+
+
+def select_candidates(columns, estimate, exact_known, margin, top_k=CASCADE_TOP_K):
+    """
+    Rows that could still be in their topic's top_k by split_data's sorting
+    score (pixels × aesthetic): the upper bound of the row reaches the k-th
+    best lower bound of the topic. Rows already scored exactly have no margin.
+    """
+    pixels = columns['width'].astype(np.float64) * columns['height']
+    valid = (pixels > 0) & ~np.isnan(estimate)
+    spread = np.where(exact_known, 0.0, margin)
+    lower = np.where(valid, pixels * (estimate - spread), -np.inf)
+    upper = np.where(valid, pixels * (estimate + spread), -np.inf)
+
+    _, topic_ids = np.unique(columns['topic_path'].astype(str), return_inverse=True)
+    rows, ranks = grouped_topk(topic_ids, lower, top_k)
+    kth = np.full(topic_ids.max() + 1 if topic_ids.size else 0, -np.inf)
+    last = rows[ranks == top_k - 1]
+    kth[topic_ids[last]] = lower[last]  # topics with fewer than top_k positive bounds keep -inf
+    return np.flatnonzero(valid & ~exact_known & (upper >= kth[topic_ids]))
+
+
+def topk_disagreement(columns, scores_a, scores_b, top_k=CASCADE_TOP_K):
+    """Share of topics whose ordered top_k (by pixels × score) differs between two score columns."""
+    _, topic_ids = np.unique(columns['topic_path'].astype(str), return_inverse=True)
+    pixels = columns['width'].astype(np.float64) * columns['height']
+    tops = []
+    for scores in (scores_a, scores_b):
+        sorting = np.nan_to_num(pixels * scores, nan=-1.0)
+        rows, _ = grouped_topk(topic_ids, sorting, top_k)
+        tops.append({t: tuple(g) for t, g in groupby(rows.tolist(), key=lambda r: topic_ids[r])})
+    topics = set(tops[0]) | set(tops[1])
+    ordered = sum(tops[0].get(t) != tops[1].get(t) for t in topics)
+    as_set = sum(set(tops[0].get(t, ())) != set(tops[1].get(t, ())) for t in topics)
+    return {'topics': len(topics), 'order_differs': ordered, 'set_differs': as_set,
+            'set_differs_fraction': round(as_set / len(topics), 4) if topics else 0.0}
+
+
+def subset(columns, rows):
+    """The given rows of every column."""
+    return {key: values[rows] for key, values in columns.items()}
+
+
+def write_cascade_scores(base_dirs, columns, scores, state_path=CASCADE_STATE_PATH, full_state_path=STATE_PATH):
+    """
+    aesthetic_data.json of every topic from the final cascade scores. The full
+    ViT-L-14 state of every rewritten topic is invalidated, so switching back
+    to the full scorer rescores those topics instead of keeping the estimates.
+    """
+    row_of = {p: r for r, p in enumerate(columns['path'].tolist())}
+    state_conn = connect_state(state_path)
+    full_conn = connect_state(full_state_path)
+    try:
+        for topic_dir, images in groupby(iter_images(base_dirs), key=lambda img: os.path.dirname(img.path)):
+            images = list(images)
+            topic_scores = {img.filename: float(scores[row_of[img.path]]) for img in images
+                            if img.path in row_of and not np.isnan(scores[row_of[img.path]])}
+            merge_topic_scores(state_conn, topic_dir, {img.filename: img.mtime_ns for img in images},
+                               topic_scores, incremental=False)
+            invalidate_topic(full_conn, topic_dir)
+    finally:
+        state_conn.close()
+        full_conn.close()
+
+
+@instrumented("cascade")
+def cascade_score(base_dirs, top_k=CASCADE_TOP_K, calibration_sample=CALIBRATION_SAMPLE, verify=False,
+                  embeddings_dir=EMBEDDINGS_DIR, report_path=CASCADE_REPORT, seed=0, holdout_topics=HOLDOUT_TOPICS):
+    """
+    Score everything with ViT-B-32 + its head, calibrate it against ViT-L-14 on
+    a random sample, then re-score with ViT-L-14 only the rows that could reach
+    their topic's top_k. Other rows keep the calibrated ViT-B-32 estimate.
+    Only ViT-L-14 features are stored in embeddings_dir (so not for every image).
+
+    Every run also scores holdout_topics random whole topics with ViT-L-14 and
+    reports how often the cascade's top_k differs from theirs, as an estimate
+    for the full run. With verify=True every image is scored with ViT-L-14 for
+    the exact figure.
+    """
+    refresh_manifest(base_dirs)
+    probe_manifest(base_dirs)
+    columns = load_image_columns(base_dirs)
+    n = len(columns['path'])
+    seconds = {}
+
+    started = time.perf_counter()
+    with stage("cascade.vit_b_32"):
+        cheap = score_rows(columns, np.arange(n), load_models("vit_b_32"))
+    unload_models()  # ViT-B-32 is not needed any more; free its memory before ViT-L-14 loads
+    seconds['vit_b_32'] = time.perf_counter() - started
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(n, min(calibration_sample, n), replace=False)
+    topic_paths = columns['topic_path'].astype(str)
+    topics = np.unique(topic_paths)
+    holdout = np.flatnonzero(np.isin(topic_paths, rng.choice(topics, min(holdout_topics, topics.size),
+                                                             replace=False)))
+
+    store = EmbeddingStore(embeddings_dir, dim=768) if embeddings_dir else None
+    l14 = load_models("vit_l_14")
+    try:
+        started = time.perf_counter()
+        with stage("cascade.holdout"):
+            held = score_rows(columns, holdout, l14, store)
+        seconds['holdout'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with stage("cascade.calibration"):
+            exact = score_rows(columns, np.setdiff1d(sample, holdout), l14, store)
+        in_sample = np.zeros(n, dtype=bool)
+        in_sample[sample] = True
+        exact = np.where(in_sample & np.isnan(exact), held, exact)  # sample rows already scored as holdout
+        slope, intercept, margin = calibrate(cheap, exact)
+        seconds['calibration'] = time.perf_counter() - started
+        print(f"Calibration on {sample.size} images: L14 ≈ {slope:.3f}·B32 + {intercept:.3f}, margin ±{margin:.3f}")
+
+        estimate = slope * cheap + intercept
+        exact_known = ~np.isnan(exact)
+        final = np.where(exact_known, exact, estimate)
+        candidates = select_candidates(columns, final, exact_known, margin, top_k)
+        print(f"{candidates.size} of {n} images could reach a top-{top_k}; re-scoring them with ViT-L-14")
+
+        started = time.perf_counter()
+        with stage("cascade.vit_l_14"):
+            rescored = score_rows(columns, np.setdiff1d(candidates, holdout), l14, store)
+        rescored[holdout] = held[holdout]
+        seconds['vit_l_14'] = time.perf_counter() - started
+        final[candidates] = np.where(np.isnan(rescored[candidates]), final[candidates], rescored[candidates])
+    finally:
+        if store is not None:
+            store.close()
+
+    # The holdout topics went through the cascade like the others; their full ViT-L-14 top-k is the reference
+    estimated = topk_disagreement(subset(columns, holdout), final[holdout], held[holdout], top_k)
+    final[holdout] = np.where(np.isnan(held[holdout]), final[holdout], held[holdout])
+
+    write_cascade_scores(base_dirs, columns, final)
+
+    l14_images = int(np.union1d(np.union1d(sample, holdout), candidates).size)
+    full_gflops = n * MODEL_GFLOPS['vit_l_14']
+    cascade_gflops = n * MODEL_GFLOPS['vit_b_32'] + l14_images * MODEL_GFLOPS['vit_l_14']
+    report = {
+        'images': n,
+        'top_k': top_k,
+        'calibration': {'images': int(sample.size), 'slope': slope, 'intercept': intercept, 'margin': margin,
+                        'quantile': MARGIN_QUANTILE},
+        'l14_images': l14_images,
+        'l14_skipped': n - l14_images,
+        'l14_skipped_fraction': round(1 - l14_images / n, 4) if n else 0.0,
+        'compute_saved_fraction': round(1 - cascade_gflops / full_gflops, 4) if n else 0.0,
+        'estimate': {'holdout_images': int(holdout.size), **estimated},
+        'seconds': {k: round(v, 2) for k, v in seconds.items()},
+    }
+    if verify:
+        started = time.perf_counter()
+        full = score_rows(columns, np.arange(n), l14)
+        report['seconds']['verify_vit_l_14'] = round(time.perf_counter() - started, 2)
+        report['verify'] = topk_disagreement(columns, final, full, top_k)
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_cascade_report(report)
+    return final, report
+
+
+def print_cascade_report(report):
+    print("\n🪜 Aesthetic Cascade Summary")
+    print("=" * 60)
+    print(f"  Images                   → {report['images']:,}")
+    print(f"  ViT-L-14 encoded         → {report['l14_images']:,} "
+          f"(skipped {report['l14_skipped']:,}, {report['l14_skipped_fraction']:.1%})")
+    print(f"  Estimated compute saved  → {report['compute_saved_fraction']:.1%}")
+    e = report['estimate']
+    label = f"Top-{report['top_k']} differs (estimate)"
+    print(f"  {label:<24} → {e['set_differs']:,} of {e['topics']:,} held-out topics "
+          f"({e['set_differs_fraction']:.2%})")
+    if 'verify' in report:
+        v = report['verify']
+        print(f"  Top-{report['top_k']} differs from full ViT-L-14 → {v['set_differs']:,} of {v['topics']:,} topics "
+              f"({v['set_differs_fraction']:.2%}), order differs in {v['order_differs']:,}")
+    print("=" * 60)
@@ -1,12 +1,35 @@
+import gc
 import os
-import json
+import io
+import hashlib
+import time
 import torch
 import torch.nn as nn
 from PIL import Image
 from urllib.request import urlretrieve
 from os.path import expanduser
+from itertools import groupby
+from collections import namedtuple
+from functools import lru_cache
 from tqdm import tqdm
 import open_clip
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from manifest import refresh_manifest, iter_topics, iter_images
+from embedding_store import EmbeddingStore, EMBEDDINGS_DIR
+from scoring_state import STATE_PATH, connect_state, load_topic_state, load_topic_failures, commit_topic
+from file_utils import atomic_write_json
+from metrics import instrumented, current_stage, timed_iter
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+BATCH_SIZE = 32
+NUM_WORKERS = 4
+PREFETCH_FACTOR = 4
+# Used on CPU-only nodes: "fp32" | "int8" | "bf16" | "compile" | "compile_bf16" | "onnx" | "onnx_int8"
+# (see cpu_backends.py); a backend failing the accuracy gate falls back to fp32
+CPU_BACKEND = "fp32"
+# "full": ViT-L-14 for every image; "cascade": ViT-B-32 screen, ViT-L-14 only where a topic's top-k
+# can still change (aesthetic_cascade.py)
+SCORING_MODE = "full"
 
 # ----------------------- Model Loading Helpers -----------------------
 def get_aesthetic_model(clip_model="vit_l_14"):
@@ -36,89 +59,292 @@ def get_aesthetic_model(clip_model="vit_l_14"):
 
 # ----------------------- Set Device and Load Models -----------------------
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-# Load aesthetic model
-amodel = get_aesthetic_model(clip_model="vit_l_14").to(device)
-amodel.eval()
 
-# Load CLIP model and transforms from open_clip
-model, _, preprocess = open_clip.create_model_and_transforms('ViT-L-14', pretrained='openai')
-model.to(device)
-model.eval()
+# aesthetic head name → (open_clip architecture, pretrained weights)
+CLIP_MODELS = {
+    "vit_l_14": ("ViT-L-14", "openai"),
+    "vit_b_32": ("ViT-B-32", "openai"),
+}
+# encoder: optional replacement of the CLIP + head forward pass (CPU backends in cpu_backends.py)
+ScoringModels = namedtuple("ScoringModels", ["clip", "preprocess", "head", "device", "name", "encoder"],
+                           defaults=(None,))
+
+
+@lru_cache(maxsize=None)
+def load_models(clip_model="vit_l_14", device=device):
+    """
+    CLIP backbone, its preprocessing transform and the aesthetic head, loaded on
+    first use and cached, so importing this module does not load any weights.
+    """
+    architecture, pretrained = CLIP_MODELS[clip_model]
+    head = get_aesthetic_model(clip_model=clip_model).to(device)
+    head.eval()
+    clip, _, preprocess = open_clip.create_model_and_transforms(architecture, pretrained=pretrained)
+    clip.to(device)
+    clip.eval()
+    return ScoringModels(clip, preprocess, head, device, clip_model)
+
+
+def unload_models():
+    """Drop every model load_models cached and return its (GPU) memory."""
+    load_models.cache_clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+@torch.no_grad()
+def encode_batch(models, pixels):
+    """Normalized CLIP features and aesthetic scores of a preprocessed batch."""
+    if models.encoder is not None:
+        return models.encoder(pixels)
+    features = models.clip.encode_image(pixels.to(models.device, non_blocking=True))
+    features /= features.norm(dim=-1, keepdim=True)
+    return features, models.head(features).squeeze(1)
+
+# ----------------------- Streaming Decode Pipeline -----------------------
+class TopicImageStream(IterableDataset):
+    """
+    Decode and preprocess images of many topics and yield ready-made batches.
+    Items are dealt round-robin to DataLoader workers, so topics finish roughly
+    in order, and batches are filled across topic boundaries. Every batch carries
+    the (topic index, file name) of its images plus any images that failed to
+    decode, so the consumer can tell when a topic is complete. The content sha1
+    and mtime of each image are computed from the bytes already read for decoding.
+    """
+
+    def __init__(self, topics, preprocess, batch_size=BATCH_SIZE):
+        self.preprocess = preprocess
+        self.items = [
+            (topic_idx, topic_dir, fname)
+            for topic_idx, (topic_dir, image_files) in enumerate(topics)
+            for fname in image_files
+        ]
+        self.batch_size = batch_size
+
+    def _batch(self, pixels, keys, meta, failed, nbytes):
+        return {
+            'pixels': torch.stack(pixels) if pixels else None,
+            'keys': keys,
+            'meta': meta,
+            'failed': failed,
+            'bytes': nbytes,
+        }
+
+    def __iter__(self):
+        worker = get_worker_info()
+        start, step = (worker.id, worker.num_workers) if worker else (0, 1)
+        pixels, keys, meta, failed, nbytes = [], [], [], [], 0
+        for topic_idx, topic_dir, fname in self.items[start::step]:
+            image_path = os.path.join(topic_dir, fname)
+            try:
+                with open(image_path, 'rb') as f:
+                    data = f.read()
+                    mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                nbytes += len(data)
+                image = Image.open(io.BytesIO(data)).convert("RGB")
+                pixels.append(self.preprocess(image))
+                keys.append((topic_idx, fname))
+                meta.append((image_path, hashlib.sha1(data).hexdigest(), mtime_ns))
+            except Exception as e:
+                print(f"Warning: Skipping {image_path}. Error: {e}")
+                failed.append((topic_idx, fname))
+            if len(pixels) == self.batch_size:
+                yield self._batch(pixels, keys, meta, failed, nbytes)
+                pixels, keys, meta, failed, nbytes = [], [], [], [], 0
+        if pixels or failed:
+            yield self._batch(pixels, keys, meta, failed, nbytes)
+
+
+def iter_topic_scores(topics, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, prefetch_factor=PREFETCH_FACTOR,
+                      embedding_store=None, models=None):
+    """
+    Score a sequence of (topic_dir, image_files) with a streaming multi-worker
+    pipeline and yield (topic_dir, {image: score}) as soon as a topic is complete.
+    If embedding_store is given, the normalized CLIP features are kept in it.
+    models defaults to load_models() (ViT-L-14). Time spent waiting for decoded
+    batches and in the model are reported to the current metrics stage.
+    """
+    models = models or load_models()
+    stage = current_stage()
+    topics = [(topic_dir, list(image_files)) for topic_dir, image_files in topics]
+    remaining = [len(image_files) for _, image_files in topics]
+    scores = [dict() for _ in topics]
+
+    for topic_idx, count in enumerate(remaining):
+        if count == 0:
+            yield topics[topic_idx][0], {}
+
+    loader = DataLoader(
+        TopicImageStream(topics, models.preprocess, batch_size=batch_size),
+        batch_size=None,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=models.device == 'cuda',
+    )
+
+    for batch in tqdm(timed_iter(loader, 'decode_wait', stage), desc="Batches", leave=False):
+        done = [topic_idx for topic_idx, _ in batch['failed']]
+        stage.items(len(batch['keys']))
+        stage.count('failed', len(batch['failed']))
+        stage.add_bytes(read=batch['bytes'])  # read in the DataLoader worker processes
+        if batch['pixels'] is not None:
+            # Encode with CLIP and predict aesthetic scores
+            with stage.timer('model'):
+                image_features, batch_scores = encode_batch(models, batch['pixels'])
+                batch_scores = batch_scores.tolist()  # waits for the device
+
+            if embedding_store is not None:
+                with stage.timer('embedding_store'):
+                    paths, hashes, mtimes = zip(*batch['meta'])
+                    embedding_store.add(list(paths), image_features.half().cpu().numpy(),
+                                        hashes=list(hashes), mtimes=list(mtimes))
+
+            for (topic_idx, name), score in zip(batch['keys'], batch_scores):
+                scores[topic_idx][name] = float(score)
+                done.append(topic_idx)
+
+        # Route results back: a topic is finished once all its images are accounted for
+        for topic_idx in done:
+            remaining[topic_idx] -= 1
+            if remaining[topic_idx] == 0:
+                topic_scores = dict(sorted(scores[topic_idx].items()))
+                scores[topic_idx] = None
+                yield topics[topic_idx][0], topic_scores
+
+
+def save_topic_scores(topic_dir, aesthetic_scores):
+    """Save scores into topic_dir/aesthetic_data.json (an empty {} if no image could be scored)."""
+    output_path = os.path.join(topic_dir, "aesthetic_data.json")
+    atomic_write_json(output_path, aesthetic_scores, indent=2)
+    if not aesthetic_scores:
+        print(f"No valid images in {topic_dir}")
+        return
+    print(f"Saved {len(aesthetic_scores)} scores to {output_path}")
+
+
+def list_topic_images(topic_dir):
+    return sorted([f for f in os.listdir(topic_dir) if f.lower().endswith(IMAGE_EXTENSIONS)])
+
 
 # ----------------------- Processing a Topic -----------------------
-def process_topic(topic_dir, batch_size=32):
+def process_topic(topic_dir, batch_size=BATCH_SIZE, image_files=None, models=None):
     """
     Run batched aesthetic model inference on all images in topic_dir.
     Save results into aesthetic_data.json.
+    image_files can be passed from the manifest to avoid listing the folder again.
     """
+    if image_files is None:
+        image_files = list_topic_images(topic_dir)
     aesthetic_scores = {}
-    image_files = sorted([f for f in os.listdir(topic_dir)
-                          if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))])
-
-    images_to_process = []
-    image_names = []
-
-    for img_file in tqdm(image_files, desc=f"Loading {os.path.basename(topic_dir)}", leave=False):
-        image_path = os.path.join(topic_dir, img_file)
-        try:
-            image = Image.open(image_path).convert("RGB")
-            preprocessed = preprocess(image)
-            images_to_process.append(preprocessed)
-            image_names.append(img_file)
-        except Exception as e:
-            print(f"Warning: Skipping {image_path}. Error: {e}")
-
-    if not images_to_process:
-        print(f"No valid images in {topic_dir}")
-        return {}
+    for _, aesthetic_scores in iter_topic_scores([(topic_dir, image_files)], batch_size=batch_size,
+                                                 models=models):
+        save_topic_scores(topic_dir, aesthetic_scores)
+    return aesthetic_scores
 
-    # Batching
-    with torch.no_grad():
-        for i in range(0, len(images_to_process), batch_size):
-            batch = images_to_process[i:i+batch_size]
-            names = image_names[i:i+batch_size]
-            batch_tensor = torch.stack(batch).to(device)
 
-            # Encode with CLIP
-            image_features = model.encode_image(batch_tensor)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+def plan_topics(topic_images, state_conn, incremental=True):
+    """
+    Decide what to encode. topic_images yields (topic_dir, {filename: mtime_ns}).
+    Returns [(topic_dir, files_to_score)] for topics that need work: new or
+    changed images, removed images, or no aesthetic_data.json yet. Unchanged,
+    already checkpointed topics are skipped entirely, and images that failed to
+    decode are only retried once their mtime changes.
+    """
+    todo, skipped = [], 0
+    for topic_dir, current in topic_images:
+        stored = load_topic_state(state_conn, topic_dir) if incremental else {}
+        known = load_topic_failures(state_conn, topic_dir) if incremental else {}
+        known.update((f, mtime_ns) for f, (mtime_ns, _) in stored.items())
+        changed = sorted(f for f, mtime_ns in current.items() if known.get(f) != mtime_ns)
+        removed = set(known) - set(current)
+        has_output = os.path.exists(os.path.join(topic_dir, "aesthetic_data.json"))
+        if not changed and not removed and (has_output or not stored):
+            skipped += 1
+            continue
+        todo.append((topic_dir, changed))
+    return todo, skipped
 
-            # Predict aesthetic scores
-            scores = amodel(image_features).squeeze(1).tolist()
 
-            for name, score in zip(names, scores):
-                aesthetic_scores[name] = float(score)
+def merge_topic_scores(state_conn, topic_dir, current, new_scores, incremental=True, attempted=()):
+    """
+    Merge fresh scores with the still-valid stored ones, write aesthetic_data.json
+    atomically, then checkpoint the topic in the state database. Images of
+    attempted without a score are checkpointed as failed to decode.
+    """
+    stored = load_topic_state(state_conn, topic_dir) if incremental else {}
+    merged = {
+        f: score for f, (mtime_ns, score) in stored.items()
+        if current.get(f) == mtime_ns
+    }
+    merged.update(new_scores)
+    merged = dict(sorted(merged.items()))
+    failed = {f: mtime_ns for f, mtime_ns in load_topic_failures(state_conn, topic_dir).items()
+              if current.get(f) == mtime_ns} if incremental else {}
+    failed.update((f, current[f]) for f in attempted if f not in new_scores)
+    # JSON first: if we crash before the checkpoint, the topic is simply redone
+    save_topic_scores(topic_dir, merged)
+    commit_topic(state_conn, topic_dir, [(f, current[f], score) for f, score in merged.items()], time.time(),
+                 failures=[(f, mtime_ns) for f, mtime_ns in sorted(failed.items()) if f not in merged])
+    return merged
+
+
+@instrumented("score")
+def score_dataset(base_dirs, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, embeddings_dir=EMBEDDINGS_DIR,
+                  incremental=True, state_path=STATE_PATH, models=None):
+    """
+    Score every topic of base_dirs in one stream, so batches stay full across
+    topic and dataset boundaries. Each topic's aesthetic_data.json is written
+    as soon as its last image has been scored. CLIP features are saved to
+    embeddings_dir (set to None to skip). models defaults to fp32 ViT-L-14.
+
+    In incremental mode only images whose path+mtime is not in the scoring state
+    are encoded and merged into the existing output. Every completed topic is
+    checkpointed, so an interrupted run resumes after the last finished topic.
+    Every topic is re-listed (full manifest refresh), so files overwritten in
+    place under the same name are rescored too.
+    """
+    refresh_manifest(base_dirs, full=True)
+    state_conn = connect_state(state_path)
+    # Topics without images stay in, so scores of their deleted images are dropped
+    mtimes = {topic.path: {} for topic in iter_topics(base_dirs)}
+    for topic_dir, images in groupby(iter_images(base_dirs), key=lambda img: os.path.dirname(img.path)):
+        mtimes[topic_dir] = {img.filename: img.mtime_ns for img in images}
+    topics, skipped = plan_topics(mtimes.items(), state_conn, incremental=incremental)
+    attempted = dict(topics)
+    n_images = sum(len(files) for _, files in topics)
+    print(f"Starting aesthetic inference in: {', '.join(base_dirs)}")
+    print(f"{len(topics)} topics to update ({n_images} images to encode), {skipped} topics unchanged")
+
+    store = EmbeddingStore(embeddings_dir, dim=768) if embeddings_dir else None
+    stage = current_stage()
+    stage.count('topics_skipped', skipped)
+    last_done = time.perf_counter()
+    try:
+        for topic_dir, new_scores in iter_topic_scores(topics, batch_size=batch_size, num_workers=num_workers,
+                                                       embedding_store=store, models=models):
+            with stage.timer('write'):
+                merge_topic_scores(state_conn, topic_dir, mtimes[topic_dir], new_scores, incremental=incremental,
+                                   attempted=attempted[topic_dir])
+            now = time.perf_counter()
+            stage.topic(topic_dir, images=len(new_scores), seconds=round(now - last_done, 4))
+            last_done = now
+    finally:
+        if store is not None:
+            store.close()
+        state_conn.close()
+    print("Aesthetic inference complete!")
 
-    # Save to JSON
-    output_path = os.path.join(topic_dir, "aesthetic_data.json")
-    with open(output_path, 'w') as f:
-        json.dump(aesthetic_scores, f, indent=2)
-    print(f"Saved {len(aesthetic_scores)} scores to {output_path}")
-    return aesthetic_scores
 
 # ----------------------- Directory Traversal -----------------------
 base_dirs = ['/home/user/kz-mm/data/DataSet_1','/home/user/kz-mm/data/DataSet_2','/home/user/kz-mm/data/DataSet_3','/home/user/kz-mm/data/DataSet_4']
 
-for base_dir in base_dirs:
-
-    print(f"Starting aesthetic inference in base folder: {base_dir}")
-    
-    # Traverse clusters -> subclusters -> topics
-    for cluster in tqdm(os.listdir(base_dir), desc="Clusters"):
-        print(f"\t{cluster}...")
-        cluster_path = os.path.join(base_dir, cluster)
-        if not os.path.isdir(cluster_path):
-            continue
-        for subcluster in os.listdir(cluster_path):
-            print(f"\t{subcluster}...")
-            subcluster_path = os.path.join(cluster_path, subcluster)
-            if not os.path.isdir(subcluster_path):
-                continue
-            for topic in os.listdir(subcluster_path):
-                topic_path = os.path.join(subcluster_path, topic)
-                if not os.path.isdir(topic_path):
-                    continue
-                # Run aesthetic inference on each topic folder.
-                process_topic(topic_path)
-    
-    print("Aesthetic inference complete!")
\ No newline at end of file
+if __name__ == "__main__" and SCORING_MODE == "cascade":
+    from aesthetic_cascade import cascade_score
+    cascade_score(base_dirs)
+elif __name__ == "__main__":
+    models = None
+    if device == 'cpu' and CPU_BACKEND != 'fp32':
+        from cpu_backends import select_cpu_models
+        models = select_cpu_models(CPU_BACKEND, base_dirs)
+    score_dataset(base_dirs, models=models)
@@ -1,8 +1,4 @@
-import os
-import json
-import numpy as np
-from tqdm import tqdm
-from collections import defaultdict
+from stats_engine import build_statistics
 
 base_dirs = [
     '/home/user/kz-mm/data/DataSet_1',
@@ -11,68 +7,35 @@ base_dirs = [
     '/home/user/kz-mm/data/DataSet_4'
 ]
 
-subcluster_scores = defaultdict(list)  # {subcluster_path: [topic medians]}
-topic_medians = {}  # optional: store per-topic stats if you want
-
-def compute_median_from_json(json_path):
-    try:
-        with open(json_path, 'r') as f:
-            data = json.load(f)
-            scores = list(data.values())
-            if scores:
-                return float(np.median(scores))
-    except Exception as e:
-        print(f"Failed to read {json_path}: {e}")
-    return None
-
-# Traverse and collect medians
-for base_dir in base_dirs:
-    print(f"\n📁 Starting in base folder: {base_dir}")
-    
-    for cluster in tqdm(os.listdir(base_dir), desc="Clusters"):
-        cluster_path = os.path.join(base_dir, cluster)
-        if not os.path.isdir(cluster_path):
-            continue
-
-        for subcluster in os.listdir(cluster_path):
-            subcluster_path = os.path.join(cluster_path, subcluster)
-            if not os.path.isdir(subcluster_path):
-                continue
-
-            for topic in os.listdir(subcluster_path):
-                topic_path = os.path.join(subcluster_path, topic)
-                if not os.path.isdir(topic_path):
-                    continue
-
-                json_path = os.path.join(topic_path, "aesthetic_data.json")
-
-                try:
-                    median = compute_median_from_json(json_path)
-                    if median is not None:
-                        subcluster_scores[subcluster_path].append(median)
-                        topic_medians[topic_path] = median
-                except:
-                    print(f"no data: {topic_path}")
-
-print("\n✅ Aggregation complete!")
-
-# Compute subcluster medians
-subcluster_medians = {
-    sub: float(np.median(scores)) for sub, scores in subcluster_scores.items() if scores
-}
-n_candidates = 5
-# Sort
-sorted_subclusters = sorted(subcluster_medians.items(), key=lambda x: x[1], reverse=True)
-top_ = sorted_subclusters[:n_candidates]
-bottom_ = sorted_subclusters[-n_candidates:]
-
-# Print result
-print(f"\n🏆 Top {n_candidates} subclusters by median aesthetic score:")
-for path, median in top_:
-    path_name = f"{path.split('/')[-2]}-{path.split('/')[-1]}"
-    print(f"{path_name} → median: {median:.3f}")
-
-print(f"\n📉 Bottom {n_candidates} subclusters by median aesthetic score:")
-for path, median in bottom_:
-    path_name = f"{path.split('/')[-2]}-{path.split('/')[-1]}"
-    print(f"{path_name} → median: {median:.3f}")
\ No newline at end of file
+if __name__ == "__main__":
+    # Topic partials are cached in stats_partials.sqlite; only changed topics are re-read
+    levels = build_statistics(base_dirs)
+    print("\n✅ Aggregation complete!")
+
+    # Median of topic medians per subcluster, from the merged sketches
+    subcluster_medians = {
+        sub: node.median('topic_aesthetic_median') for sub, node in levels['subcluster'].items()
+        if node.median('topic_aesthetic_median') is not None
+    }
+    n_candidates = 5
+    # Sort
+    sorted_subclusters = sorted(subcluster_medians.items(), key=lambda x: x[1], reverse=True)
+    top_ = sorted_subclusters[:n_candidates]
+    bottom_ = sorted_subclusters[-n_candidates:]
+
+    # Print result
+    print(f"\n🏆 Top {n_candidates} subclusters by median aesthetic score:")
+    for path, median in top_:
+        path_name = f"{path.split('/')[-2]}-{path.split('/')[-1]}"
+        print(f"{path_name} → median: {median:.3f}")
+
+    print(f"\n📉 Bottom {n_candidates} subclusters by median aesthetic score:")
+    for path, median in bottom_:
+        path_name = f"{path.split('/')[-2]}-{path.split('/')[-1]}"
+        print(f"{path_name} → median: {median:.3f}")
+
+    print("\n📈 Aesthetic score distribution per dataset:")
+    for name, node in sorted(levels['dataset'].items()):
+        dist = node.sketches['aesthetic'].summary() if 'aesthetic' in node.sketches else {'n': 0}
+        if dist['n']:
+            print(f"{name:<12} n={dist['n']:,} p10={dist['p10']:.3f} p50={dist['p50']:.3f} p90={dist['p90']:.3f}")
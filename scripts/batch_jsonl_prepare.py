@@ -1,37 +1,30 @@
+import os
+import sys
 import json
+from itertools import islice
 from pathlib import Path
+from generate_file_map import FILE_MAP_DB, lookup_urls
+from manifest import refresh_manifest, iter_images
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH
+from metrics import instrumented, current_stage
 
-INPUT_JSON_PATH = "valid_set_Xsmall.json"
-LINKS_JSON_PATH = "file_map.json"
-OUTPUT_BATCH_JSONL = "batch_input.jsonl"
-MAX_ITEMS = 50_000
+# A split file (JSON list of image paths) or a dataset folder to caption entirely
+INPUT_SOURCE = "valid_set_Xsmall.json"
+LINKS_DB_PATH = FILE_MAP_DB
+OUTPUT_DIR = "batch_inputs"
+SHARD_MANIFEST = "shards.json"
+ID_MAP = "custom_ids.jsonl"
+# Requests already answered in the response cache, in batch output format
+CACHED_RESULTS = "cached_results.jsonl"
+# Batch API limits per input file: 50,000 requests and 200 MB
+MAX_REQUESTS_PER_SHARD = 50_000
+MAX_SHARD_BYTES = 190 * 1024 * 1024
+LOOKUP_CHUNK = 10_000
+MODEL_NAME = "gpt-4o-mini-2024-07-18"
 
-def generate_batch_requests(input_paths_file, links_dict_file, max_items=MAX_ITEMS):
-    with open(input_paths_file, "r") as f:
-        input_paths = json.load(f)
 
-    with open(links_dict_file, "r") as f:
-        url_lookup = json.load(f)
-
-    batch_requests = []
-
-    for idx, path_str in enumerate(input_paths, 1):
-        if idx > max_items:
-            break
-
-        path = Path(path_str)
-        try:
-            topic_name = path.parts[-2]
-        except IndexError:
-            print(f"[WARN] Skipped due to path error: {path_str}")
-            continue
-
-        image_url = url_lookup.get(path_str)
-        if not image_url:
-            print(f"[WARN] No URL found for: {path_str}")
-            continue
-
-        prompt = f"""
+def build_prompt(topic_name):
+    return f"""
 You are a precise visual assistant for a blind person. Write a factual, detailed caption in Kazakh for the image, using exactly five sentences (40–60 words). Describe only what is directly visible: objects, their appearance, interactions, and environment. Use clear, neutral Kazakh; avoid style, opinions, or guesses (e.g., no “looks cozy” or “seems happy”). No 'Суретте' at the beginning. Just describe the image directly. 
 Include '{topic_name}' only if they clearly match the scene—don’t force them.
 Each sentence must describe a distinct, observable detail, such as:
@@ -44,40 +37,140 @@ Use simple, natural Kazakh and precise, factual adjectives (e.g., “үлкен,
 Don’t mention time, purpose, or unseen context.
         """
 
-        batch_requests.append({
-            "custom_id": f"caption_{idx}",
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o-mini-2024-07-18",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": image_url,
-                                    "detail": "low"
-                                }
+
+def build_request(custom_id, prompt, image_url, model=MODEL_NAME):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                                "detail": "low"
                             }
-                        ]
-                    }
-                ],
-                "max_tokens": 300
-            }
-        })
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 300
+        }
+    }
+
+
+def iter_input_paths(source):
+    """Image paths from a JSON list file, or every manifest image of a dataset folder."""
+    if os.path.isdir(source):
+        refresh_manifest([source])
+        for image in iter_images([source]):
+            yield image.path
+    else:
+        with open(source, "r") as f:
+            yield from json.load(f)
+
+
+def generate_batch_requests(input_paths, links_db_path, max_items=None):
+    """
+    Yield (custom_id, image_path, request) for every input path with a known URL.
+    URLs are looked up in chunks so the input is never materialized as a whole.
+    """
+    paths = iter(input_paths)
+    if max_items is not None:
+        paths = islice(paths, max_items)
+    idx = 0
+    while True:
+        chunk = list(islice(paths, LOOKUP_CHUNK))
+        if not chunk:
+            break
+        url_lookup = lookup_urls(chunk, links_db_path)
+        for path_str in chunk:
+            idx += 1
+            path = Path(path_str)
+            try:
+                topic_name = path.parts[-2]
+            except IndexError:
+                print(f"[WARN] Skipped due to path error: {path_str}")
+                continue
+
+            image_url = url_lookup.get(path_str)
+            if not image_url:
+                print(f"[WARN] No URL found for: {path_str}")
+                continue
+
+            custom_id = f"caption_{idx}"
+            yield custom_id, path_str, build_request(custom_id, build_prompt(topic_name), image_url)
+
+
+@instrumented("batch_prep")
+def write_sharded_jsonl(requests, output_dir=OUTPUT_DIR, max_requests=MAX_REQUESTS_PER_SHARD,
+                        max_bytes=MAX_SHARD_BYTES, cache_path=RESPONSE_CACHE_PATH):
+    """
+    Stream requests to batch_input_NNNNN.jsonl shards, rolling over whenever
+    the request count or byte size cap would be exceeded. Writes custom_id →
+    image path to custom_ids.jsonl and the shard list to shards.json.
+    Requests with a response in the cache are written to cached_results.jsonl
+    instead of a shard, so only new requests are submitted (cache_path=None to
+    submit everything).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []
+    shard_file = None
+    cache = ResponseCache(cache_path) if cache_path else None
+    cached_path = os.path.join(output_dir, CACHED_RESULTS)
+    n_cached = 0
+
+    def open_shard():
+        name = f"batch_input_{len(shards):05d}.jsonl"
+        shards.append({"file": os.path.join(output_dir, name), "requests": 0, "bytes": 0})
+        return open(shards[-1]["file"], "wb")
+
+    with open(os.path.join(output_dir, ID_MAP), "w", encoding="utf-8") as id_map, \
+            open(cached_path, "w", encoding="utf-8") as cached_results:
+        for custom_id, image_path, request in requests:
+            id_map.write(json.dumps({"custom_id": custom_id, "image_path": image_path}, ensure_ascii=False) + "\n")
+            cached = cache.get(request["body"]) if cache is not None else None
+            if cached is not None:
+                cached_results.write(json.dumps({"custom_id": custom_id,
+                                                 "response": {"status_code": 200, "body": cached}},
+                                                ensure_ascii=False) + "\n")
+                n_cached += 1
+                continue
+            line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+            current = shards[-1] if shards else None
+            if current is None or current["requests"] >= max_requests or current["bytes"] + len(line) > max_bytes:
+                if shard_file:
+                    shard_file.close()
+                shard_file = open_shard()
+                current = shards[-1]
+            shard_file.write(line)
+            current["requests"] += 1
+            current["bytes"] += len(line)
+    if shard_file:
+        shard_file.close()
+    if cache is not None:
+        cache.close()
 
-    return batch_requests
+    with open(os.path.join(output_dir, SHARD_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"shards": shards, "id_map": os.path.join(output_dir, ID_MAP),
+                   "cached_results": cached_path, "cached": n_cached}, f, ensure_ascii=False, indent=2)
 
-def save_to_jsonl(data, path):
-    with open(path, "w", encoding="utf-8") as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    total = sum(s["requests"] for s in shards)
+    stage = current_stage()
+    stage.items(total + n_cached)
+    stage.count("cached", n_cached)
+    stage.count("shards", len(shards))
+    print(f"Saved {total} entries to {len(shards)} shards in {output_dir} ({n_cached} answered from cache)")
+    return shards
 
-    print(f"Saved {len(data)} entries to {path}")
 
 if __name__ == "__main__":
-    requests = generate_batch_requests(INPUT_JSON_PATH, LINKS_JSON_PATH)
-    save_to_jsonl(requests, OUTPUT_BATCH_JSONL)
+    # e.g. `python batch_jsonl_prepare.py /home/user/kz-mm/data/full_dataset` for the whole dataset
+    source = sys.argv[1] if len(sys.argv) > 1 else INPUT_SOURCE
+    write_sharded_jsonl(generate_batch_requests(iter_input_paths(source), LINKS_DB_PATH))
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import threading
+import subprocess
+import urllib.request
+from collections import Counter
+import numpy as np
+import httpx
+from PIL import Image
+from openai import AsyncOpenAI
+import image_payload
+from gpt_captioning_for_prompt_testing import generate_kz_captions_async
+from gpt_judge import judge_captions_async
+from gpt_batch_run import run_batches, load_shard_files
+from batch_jsonl_prepare import build_prompt, build_request, write_sharded_jsonl
+from metrics import current_rss
+
+BENCH_DIR = "gpt_benchmark"
+BENCH_IMAGES = 200
+CONCURRENCY = 64
+SCENARIOS = ["captioning", "judge", "batch"]
+# Passed to mock_openai_server.py; the client-side limits are lifted so the pipeline itself is measured
+SERVER_ARGS = ["--latency-ms", "200", "--jitter-ms", "50", "--rate-429", "0.02", "--rate-5xx", "0.01",
+               "--batch-seconds", "1"]
+RESULTS_JSON = "benchmark_results.json"
+UNLIMITED = 10 ** 12
+
+
+class RequestTimer:
+    """httpx event hooks recording latency (to response headers) and status of every API call."""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.sent = 0
+
+    async def on_request(self, request):
+        self.sent += 1
+        request.extensions["bench_start"] = time.perf_counter()
+
+    async def on_response(self, response):
+        start = response.request.extensions.get("bench_start")
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+        self.statuses[response.status_code] += 1
+
+
+class PeakRSS:
+    """Samples this process's resident set size in a background thread."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = self.baseline = self.current()
+        self.running = False
+
+    current = staticmethod(current_rss)
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def start_mock_server(args=SERVER_ARGS):
+    """Run mock_openai_server.py in a subprocess (kept out of the measured RSS); returns (process, base_url)."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_openai_server.py")
+    process = subprocess.Popen([sys.executable, server_path, "--port", str(port), *args],
+                               stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/v1"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"{base_url}/stats", timeout=1).read()
+            return process, base_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("mock server did not start")
+
+
+def server_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/stats") as response:
+        return json.load(response)
+
+
+def make_dataset(root, n_images):
+    """n_images JPEGs laid out as cluster/subcluster/topic, one per cluster so every group is captioned."""
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(n_images):
+        topic_dir = os.path.join(root, f"cluster_{i:04d}", "subcluster", f"topic_{i % 17}")
+        os.makedirs(topic_dir, exist_ok=True)
+        path = os.path.join(topic_dir, "image.jpg")
+        if not os.path.exists(path):
+            pixels = rng.integers(0, 255, (768, 1024, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+async def bench_captioning(client, paths):
+    with open("input.json", "w") as f:
+        json.dump(paths, f)
+    result = await generate_kz_captions_async(client, "input.json", "captions_output.json",
+                                              concurrency=CONCURRENCY, rpm=UNLIMITED, tpm=UNLIMITED,
+                                              max_groups=len(paths))
+    return 2 * len(result)
+
+
+async def bench_judge(client, paths):
+    data = {f"image_with_caption_{i}": {"image_path": p, "caption_1": f"сипаттама {i}", "caption_2": f"мәтін {i}"}
+            for i, p in enumerate(paths)}
+    with open("captions_output.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    judged = await judge_captions_async(client, "captions_output.json", "judged.json",
+                                        concurrency=CONCURRENCY, rpm=UNLIMITED, tpm=UNLIMITED)
+    return 2 * len(judged)
+
+
+async def bench_batch(client, paths):
+    requests = ((f"caption_{i}", p, build_request(f"caption_{i}", build_prompt(os.path.basename(os.path.dirname(p))),
+                                                  f"https://example.invalid/{i}.jpg"))
+                for i, p in enumerate(paths))
+    write_sharded_jsonl(requests, "batch_inputs", max_requests=max(1, len(paths) // 4), cache_path=None)
+    shards = await run_batches(client, load_shard_files("batch_inputs/shards.json"), poll_interval=0.25)
+    return sum(s.get("output_lines", 0) + s.get("error_lines", 0) for s in shards.values())
+
+
+BENCHMARKS = {"captioning": bench_captioning, "judge": bench_judge, "batch": bench_batch}
+
+
+def run_scenario(name, base_url, paths, work_dir):
+    """Run one script against the mock server in a fresh directory and collect its metrics."""
+    scenario_dir = os.path.join(work_dir, name)
+    os.makedirs(scenario_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(scenario_dir)  # checkpoints, caches and outputs of the scripts land here
+    image_payload._encode_cached.cache_clear()
+    image_payload.payload_stats.clear()
+    timer = RequestTimer()
+    before = server_stats(base_url)
+
+    async def run():
+        http_client = httpx.AsyncClient(event_hooks={"request": [timer.on_request], "response": [timer.on_response]},
+                                        limits=httpx.Limits(max_connections=CONCURRENCY * 2), timeout=60)
+        client = AsyncOpenAI(base_url=base_url, api_key="mock", max_retries=0, http_client=http_client)
+        try:
+            return await BENCHMARKS[name](client, paths)
+        finally:
+            await http_client.aclose()
+
+    try:
+        with PeakRSS() as rss:
+            started = time.perf_counter()
+            items = asyncio.run(run())
+            elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+
+    after = server_stats(base_url)
+    latencies = np.asarray(timer.latencies) * 1000
+    # 429 / 5xx answers plus requests that never got a response (connection errors); all are retried
+    transport_errors = timer.sent - sum(timer.statuses.values())
+    retried = sum(n for status, n in timer.statuses.items() if status == 429 or status >= 500) + transport_errors
+    return {
+        "scenario": name,
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(items / elapsed, 2),
+        "http_requests": int(latencies.size),
+        "requests_per_sec": round(latencies.size / elapsed, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1) if latencies.size else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1) if latencies.size else None,
+        "retried_errors": retried,
+        "status_counts": {str(k): v for k, v in sorted(timer.statuses.items())},
+        "transport_errors": transport_errors,
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+        "rss_growth_mb": round((rss.peak - rss.baseline) / 2**20, 1),
+        "server": {k: after.get(k, 0) - before.get(k, 0) for k in after},
+    }
+
+
+def print_report(results):
+    print("\n🚀 GPT pipeline benchmark (mock server)")
+    print("=" * 100)
+    print(f"{'scenario':<12}{'items':>8}{'sec':>9}{'items/s':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'retries':>9}{'peak MB':>10}{'+MB':>8}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['items']:>8}{r['seconds']:>9.2f}{r['items_per_sec']:>10.1f}"
+              f"{r['requests_per_sec']:>9.1f}{r['p50_ms'] or 0:>9.1f}{r['p99_ms'] or 0:>9.1f}"
+              f"{r['retried_errors']:>9}{r['peak_rss_mb']:>10.1f}{r['rss_growth_mb']:>8.1f}")
+    print("=" * 100)
+
+
+def run_benchmarks(scenarios=SCENARIOS, n_images=BENCH_IMAGES, work_dir=BENCH_DIR, server_args=SERVER_ARGS):
+    work_dir = os.path.abspath(work_dir)
+    paths = make_dataset(os.path.join(work_dir, "data"), n_images)
+    process, base_url = start_mock_server(server_args)
+    try:
+        results = []
+        for name in scenarios:
+            # No caches or checkpoints from earlier runs
+            shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+            results.append(run_scenario(name, base_url, paths, work_dir))
+    finally:
+        process.terminate()
+        process.wait()
+    print_report(results)
+    with open(os.path.join(work_dir, RESULTS_JSON), "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {os.path.join(work_dir, RESULTS_JSON)}")
+    return results
+
+
+if __name__ == "__main__":
+    # e.g. `python benchmark_gpt.py captioning judge`
+    run_benchmarks(sys.argv[1:] or SCENARIOS)
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from aesthetic_scorer import load_models, encode_batch, NUM_WORKERS, BATCH_SIZE
+from manifest import load_image_columns
+from metrics import emit
+
+BACKENDS = ["fp32", "int8", "bf16", "compile", "compile_bf16", "onnx", "onnx_int8"]
+ONNX_DIR = "onnx_models"
+ONNX_OPSET = 17
+# Threads for the model; the DataLoader decode workers get the remaining cores
+CPU_THREADS = None  # None = available cores - NUM_WORKERS
+INTEROP_THREADS = 1  # one batch at a time, so inter-op parallelism only adds contention
+GATE_SAMPLE = 256
+MIN_SPEARMAN = 0.995
+MAX_SCORE_DEVIATION = 0.1  # aesthetic scores are on a ~1-10 scale
+
+
+def configure_threads(threads=CPU_THREADS, interop_threads=INTEROP_THREADS):
+    """Set torch intra-/inter-op thread counts; returns the intra-op count used."""
+    if threads is None:
+        threads = max(1, len(os.sched_getaffinity(0)) - NUM_WORKERS)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:  # can only be set before the first parallel op
+        pass
+    return threads
+
+
+class ScoringHead(nn.Module):
+    """CLIP visual tower + normalization + aesthetic head as one module (for ONNX export)."""
+
+    def __init__(self, clip, head):
+        super().__init__()
+        self.visual = clip.visual
+        self.head = head
+
+    def forward(self, pixels):
+        features = self.visual(pixels)
+        features = features / features.norm(dim=-1, keepdim=True)
+        return features, self.head(features).squeeze(1)
+
+
+def _image_size(models):
+    size = getattr(models.clip.visual, 'image_size', 224)
+    return size if isinstance(size, (tuple, list)) else (size, size)
+
+
+def export_onnx(models, quantize=False, onnx_dir=ONNX_DIR):
+    """Export (once) the scoring graph of models to ONNX, optionally with dynamic int8 weights."""
+    import onnx  # noqa: F401  (required by torch.onnx.export)
+    os.makedirs(onnx_dir, exist_ok=True)
+    path = os.path.join(onnx_dir, f"{models.name}_aesthetic.onnx")
+    if not os.path.exists(path):
+        dummy = torch.zeros(1, 3, *_image_size(models))
+        torch.onnx.export(ScoringHead(models.clip, models.head).eval(), dummy, path, opset_version=ONNX_OPSET,
+                          input_names=["pixels"], output_names=["features", "scores"],
+                          dynamic_axes={"pixels": {0: "batch"}, "features": {0: "batch"}, "scores": {0: "batch"}})
+        print(f"Exported {models.name} to {path}")
+    if not quantize:
+        return path
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = path.replace(".onnx", "_int8.onnx")
+    if not os.path.exists(int8_path):
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def load_cpu_models(backend="int8", clip_model="vit_l_14", threads=CPU_THREADS):
+    """
+    ScoringModels for CPU inference with the given backend:
+      fp32          eager float32 (the baseline)
+      int8          dynamic int8 quantization of the visual tower's nn.Linear layers
+      bf16          eager with bfloat16 autocast
+      compile       torch.compile of the visual tower
+      compile_bf16  torch.compile + bfloat16 autocast
+      onnx          ONNX Runtime (graph optimizations, tuned threads)
+      onnx_int8     ONNX Runtime with dynamically quantized int8 weights
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CPU backend: {backend}")
+    threads = configure_threads(threads)
+    base = load_models(clip_model, 'cpu')
+    if backend == "fp32":
+        return base
+
+    if backend.startswith("onnx"):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = INTEROP_THREADS
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(export_onnx(base, quantize=backend == "onnx_int8"), options,
+                                       providers=["CPUExecutionProvider"])
+
+        def encoder(pixels):
+            features, scores = session.run(None, {"pixels": pixels.numpy()})
+            return torch.from_numpy(features), torch.from_numpy(scores)
+        return base._replace(encoder=encoder)
+
+    visual = base.clip.visual
+    if backend == "int8":
+        # Attention out-projections are left in float by quantize_dynamic; the MLPs carry most weights
+        visual = torch.ao.quantization.quantize_dynamic(visual, {nn.Linear}, dtype=torch.qint8)
+    elif backend.startswith("compile"):
+        visual = torch.compile(visual)
+    bf16 = backend.endswith("bf16")
+
+    def encoder(pixels):
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+            features = visual(pixels)
+        features = features.float()
+        features /= features.norm(dim=-1, keepdim=True)
+        return features, base.head(features).squeeze(1)
+    return base._replace(encoder=encoder)
+
+
+def _spearman(a, b):
+    ranks_a = np.argsort(np.argsort(a))
+    ranks_b = np.argsort(np.argsort(b))
+    return float(np.corrcoef(ranks_a, ranks_b)[0, 1])
+
+
+def _run(models, batches):
+    features, scores = [], []
+    started = time.perf_counter()
+    for pixels in batches:
+        f, s = encode_batch(models, pixels)
+        features.append(f.float().numpy())
+        scores.append(s.float().numpy())
+    return np.concatenate(features), np.concatenate(scores), time.perf_counter() - started
+
+
+def accuracy_gate(candidate, baseline, image_paths, batch_size=BATCH_SIZE):
+    """
+    Score image_paths with both models and compare: Spearman rank correlation
+    and max/mean absolute deviation of scores, the lowest embedding cosine
+    similarity, and the speedup. `passed` applies MIN_SPEARMAN / MAX_SCORE_DEVIATION.
+    """
+    pixels = []
+    for path in image_paths:
+        try:
+            pixels.append(baseline.preprocess(Image.open(path).convert("RGB")))
+        except Exception as e:
+            print(f"Warning: Skipping {path}. Error: {e}")
+    batches = [torch.stack(pixels[i:i + batch_size]) for i in range(0, len(pixels), batch_size)]
+    if not batches:
+        raise ValueError("No readable images for the accuracy gate")
+    _run(candidate, batches[:1])  # warm-up (torch.compile traces, ONNX allocates)
+    base_features, base_scores, base_seconds = _run(baseline, batches)
+    features, scores, seconds = _run(candidate, batches)
+
+    deviation = np.abs(scores - base_scores)
+    report = {
+        'images': len(pixels),
+        'spearman': _spearman(scores, base_scores) if len(pixels) > 1 else 1.0,
+        'max_deviation': float(deviation.max()),
+        'mean_deviation': float(deviation.mean()),
+        'min_cosine': float(np.min(np.sum(features * base_features, axis=1))),
+        'baseline_images_per_sec': round(len(pixels) / base_seconds, 2),
+        'images_per_sec': round(len(pixels) / seconds, 2),
+        'speedup': round(base_seconds / seconds, 2),
+    }
+    report['passed'] = report['spearman'] >= MIN_SPEARMAN and report['max_deviation'] <= MAX_SCORE_DEVIATION
+    emit({'type': 'accuracy_gate', 'model': candidate.name, 'time': time.time(), **report})
+    return report
+
+
+def sample_paths(base_dirs, sample_size=GATE_SAMPLE, seed=0):
+    paths = load_image_columns(base_dirs)['path']
+    if len(paths) > sample_size:
+        paths = paths[np.sort(np.random.default_rng(seed).choice(len(paths), sample_size, replace=False))]
+    return paths.tolist()
+
+
+def print_gate_report(backend, report):
+    status = "✅ PASS" if report['passed'] else "❌ FAIL"
+    print(f"{backend:<14} {status}  spearman {report['spearman']:.4f}  max Δ {report['max_deviation']:.4f}  "
+          f"mean Δ {report['mean_deviation']:.4f}  min cos {report['min_cosine']:.4f}  "
+          f"{report['images_per_sec']:.1f} img/s (x{report['speedup']:.2f})")
+
+
+def select_cpu_models(backend, base_dirs, clip_model="vit_l_14", sample_size=GATE_SAMPLE):
+    """The requested CPU backend if it passes the accuracy gate on a sample of base_dirs, else fp32."""
+    baseline = load_cpu_models("fp32", clip_model)
+    if backend == "fp32":
+        return baseline
+    try:
+        candidate = load_cpu_models(backend, clip_model)
+        report = accuracy_gate(candidate, baseline, sample_paths(base_dirs, sample_size))
+    except Exception as e:
+        print(f"⚠️ CPU backend {backend} unavailable ({e}), using fp32")
+        return baseline
+    print_gate_report(backend, report)
+    if not report['passed']:
+        print(f"⚠️ {backend} failed the accuracy gate, using fp32")
+        return baseline
+    return candidate
+
+
+if __name__ == "__main__":
+    # e.g. `python cpu_backends.py /home/user/kz-mm/data/DataSet_1 int8 onnx_int8`
+    base_dir, backends = sys.argv[1], sys.argv[2:] or BACKENDS[1:]
+    paths = sample_paths([base_dir])
+    baseline = load_cpu_models("fp32")
+    print(f"Accuracy gate on {len(paths)} images ({torch.get_num_threads()} threads)")
+    for backend in backends:
+        try:
+            print_gate_report(backend, accuracy_gate(load_cpu_models(backend), baseline, paths))
+        except Exception as e:
+            print(f"{backend:<14} ⚠️ unavailable: {e}")
@@ -1,39 +1,34 @@
-import os
-import json
-import numpy as np
+from stats_engine import build_statistics
 
-summary_files = [
-    'duplicates_summary_DataSet_1.json',
-    'duplicates_summary_DataSet_2.json',
-    'duplicates_summary_DataSet_3.json',
-    'duplicates_summary_DataSet_4.json',
+base_dirs = [
+    '/home/user/kz-mm/data/DataSet_1',
+    '/home/user/kz-mm/data/DataSet_2',
+    '/home/user/kz-mm/data/DataSet_3',
+    '/home/user/kz-mm/data/DataSet_4'
 ]
 
-total_duplicates = 0
-all_cluster_total_images = []
-all_cluster_duplicate_images = []
-
-for file in summary_files:
-    print(f"🔍 Reading: {file}")
-    try:
-        with open(file, 'r') as f:
-            data = json.load(f)
-
-        total_duplicates += data.get('total_duplicate_images', 0)
-
-        for cluster, stats in data.get('cluster_stats', {}).items():
-            all_cluster_total_images.append(stats.get('total_images', 0))
-            all_cluster_duplicate_images.append(stats.get('duplicate_images', 0))
-
-    except Exception as e:
-        print(f"❌ Failed to read {file}: {e}")
-
-# Calculate medians
-median_total_images = float(np.median(all_cluster_total_images)) if all_cluster_total_images else 0
-median_duplicate_images = float(np.median(all_cluster_duplicate_images)) if all_cluster_duplicate_images else 0
-
-# Output results
-print("\n📊 Duplicates Aggregated Stats:")
-print(f"🧮 Total duplicate images across all clusters: {total_duplicates}")
-print(f"📐 Median total images per cluster: {int(median_total_images)}")
-print(f"📐 Median duplicate images per cluster: {int(median_duplicate_images)}")
\ No newline at end of file
+if __name__ == "__main__":
+    # Duplicate counts come from the duplicates_<topic>.json files, merged per topic → cluster → dataset.
+    # Image dimensions are not needed, so nothing is probed and dataset_statistics.json is left alone.
+    levels = build_statistics(base_dirs, probe=False, output_path=None)
+    overall = levels['all'].get('all')
+
+    if overall is None:
+        print("❌ No topics found")
+    else:
+        total_duplicates = overall.counters['duplicates']
+        cluster_images = overall.sketches['cluster_images'].summary()
+        cluster_duplicates = overall.sketches['cluster_duplicates'].summary()
+
+        # Output results
+        print("\n📊 Duplicates Aggregated Stats:")
+        print(f"🧮 Total duplicate images across all clusters: {total_duplicates}")
+        print(f"📐 Median total images per cluster: {int(cluster_images['p50'])}")
+        print(f"📐 Median duplicate images per cluster: {int(cluster_duplicates['p50'])}")
+        print(f"📐 Duplicates per cluster p10 / p90: {int(cluster_duplicates['p10'])} / {int(cluster_duplicates['p90'])}")
+
+        print("\n📁 Per dataset:")
+        for name, node in sorted(levels['dataset'].items()):
+            images = node.counters['images']
+            share = node.counters['duplicates'] / images if images else 0
+            print(f"  {name:<12} {node.counters['duplicates']:,} duplicates of {images:,} images ({share:.1%})")
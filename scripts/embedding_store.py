@@ -0,0 +1,157 @@
+import os
+import sqlite3
+from pathlib import Path
+import numpy as np
+
+EMBEDDINGS_DIR = "clip_embeddings/vit_l_14"
+SHARD_SIZE = 65_536
+DTYPE = np.float16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, rows INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS embeddings (
+    path TEXT PRIMARY KEY,
+    sha1 TEXT,
+    mtime_ns INTEGER,
+    shard INTEGER NOT NULL,
+    row INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS embeddings_sha1 ON embeddings (sha1);
+"""
+
+
+class EmbeddingStore:
+    """
+    Sharded float16 store of normalized CLIP image features.
+
+    Vectors live in preallocated .npy shards of shard_size rows that are opened
+    as memory maps, so readers get zero-copy views. index.sqlite maps each image
+    path (and its content sha1) to (shard, row). Re-adding a path appends a new
+    row and repoints the index; the old row is left unused. A readonly store
+    opens an existing index with mode=ro and never creates or writes files.
+    """
+
+    def __init__(self, root=EMBEDDINGS_DIR, dim=768, shard_size=SHARD_SIZE, readonly=False):
+        self.root = root
+        self.readonly = readonly
+        index_path = os.path.join(root, "index.sqlite")
+        if readonly:
+            if not os.path.exists(index_path):
+                raise FileNotFoundError(f"No embedding store at {root}")
+            self.conn = sqlite3.connect(Path(index_path).resolve().as_uri() + "?mode=ro", uri=True)
+        else:
+            os.makedirs(root, exist_ok=True)
+            self.conn = sqlite3.connect(index_path)
+            self.conn.executescript(SCHEMA)
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if meta:
+            self.dim = int(meta['dim'])
+            self.shard_size = int(meta['shard_size'])
+        else:
+            self.dim, self.shard_size = dim, shard_size
+        if not meta and not readonly:
+            with self.conn:
+                self.conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                      [('dim', str(dim)), ('shard_size', str(shard_size)),
+                                       ('dtype', np.dtype(DTYPE).name)])
+        self.shard_rows = dict(self.conn.execute("SELECT shard, rows FROM shards"))
+        self._maps = {}
+
+    def _shard_path(self, shard):
+        return os.path.join(self.root, f"shard_{shard:05d}.npy")
+
+    def _open_shard(self, shard):
+        if shard not in self._maps:
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                mode = 'r' if self.readonly else 'r+'
+                self._maps[shard] = np.load(path, mmap_mode=mode)
+            elif self.readonly:
+                raise FileNotFoundError(path)
+            else:
+                self._maps[shard] = np.lib.format.open_memmap(
+                    path, mode='w+', dtype=DTYPE, shape=(self.shard_size, self.dim)
+                )
+        return self._maps[shard]
+
+    def add(self, paths, vectors, hashes=None, mtimes=None):
+        """Append vectors (N×dim) for the given image paths."""
+        vectors = np.asarray(vectors, dtype=DTYPE)
+        hashes = hashes or [None] * len(paths)
+        mtimes = mtimes or [None] * len(paths)
+        rows = []
+        offset = 0
+        while offset < len(paths):
+            shard = max(self.shard_rows, default=0)
+            used = self.shard_rows.get(shard, 0)
+            if used == self.shard_size:
+                shard, used = shard + 1, 0
+            take = min(self.shard_size - used, len(paths) - offset)
+            self._open_shard(shard)[used:used + take] = vectors[offset:offset + take]
+            for i in range(take):
+                j = offset + i
+                rows.append((paths[j], hashes[j], mtimes[j], shard, used + i))
+            self.shard_rows[shard] = used + take
+            offset += take
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?,?,?,?,?)", rows)
+            self.conn.executemany("INSERT OR REPLACE INTO shards VALUES (?, ?)", self.shard_rows.items())
+
+    def lookup(self, paths):
+        """{path: (shard, row, mtime_ns)} for the paths that are stored."""
+        found = {}
+        for i in range(0, len(paths), 900):
+            chunk = paths[i:i + 900]
+            query = ("SELECT path, shard, row, mtime_ns FROM embeddings "
+                     f"WHERE path IN ({','.join('?' * len(chunk))})")
+            for path, shard, row, mtime_ns in self.conn.execute(query, chunk):
+                found[path] = (shard, row, mtime_ns)
+        return found
+
+    def lookup_hash(self, sha1):
+        """Paths whose content hash is sha1 (identical files)."""
+        return [p for (p,) in self.conn.execute("SELECT path FROM embeddings WHERE sha1 = ?", (sha1,))]
+
+    def get(self, paths):
+        """Vectors for paths as an N×dim float16 array. Raises KeyError for missing paths."""
+        found = self.lookup(list(paths))
+        out = np.empty((len(paths), self.dim), dtype=DTYPE)
+        for i, path in enumerate(paths):
+            if path not in found:
+                raise KeyError(path)
+            shard, row, _ = found[path]
+            out[i] = self._open_shard(shard)[row]
+        return out
+
+    def iter_shards(self):
+        """
+        Yield (paths, vectors) per shard with the rows the index still points to,
+        in row order. Shards without stale rows are yielded as zero-copy memmap slices.
+        """
+        for shard in sorted(self.shard_rows):
+            rows = self.conn.execute(
+                "SELECT path, row FROM embeddings WHERE shard = ? ORDER BY row", (shard,)
+            ).fetchall()
+            if not rows:
+                continue
+            paths = [p for p, _ in rows]
+            idx = np.fromiter((r for _, r in rows), dtype=np.int64, count=len(rows))
+            data = self._open_shard(shard)
+            if len(idx) == idx[-1] + 1:  # no stale rows: contiguous zero-copy slice
+                yield paths, data[:len(idx)]
+            else:
+                yield paths, data[idx]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def flush(self):
+        for data in self._maps.values():
+            if not self.readonly:
+                data.flush()
+
+    def close(self):
+        self.flush()
+        self._maps.clear()
+        self.conn.close()
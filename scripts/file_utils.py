@@ -0,0 +1,12 @@
+import os
+import json
+
+
+def atomic_write_json(path, data, **kwargs):
+    """Write JSON to a temp file next to path and rename it into place."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
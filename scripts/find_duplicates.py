@@ -2,68 +2,132 @@ import os
 import json
 from imagededup.methods import DHash
 from collections import defaultdict
+from itertools import groupby
 from tqdm import tqdm
 import logging
+from manifest import refresh_manifest, iter_topics, topic_images, store_hashes, load_hashes, unhashed_images
+from hash_index import MultiIndexHash, hex_to_codes, duplicate_groups
+from dhash_engine import hash_topics
+from metrics import instrumented, current_stage
 logging.getLogger('imagededup').setLevel(logging.CRITICAL)
 #base_dir = '/home/user/kz-mm/data/DataSet_1'
 
 dhasher = DHash()
 
 base_dirs = ['/home/user/kz-mm/data/DataSet_2','/home/user/kz-mm/data/DataSet_3','/home/user/kz-mm/data/DataSet_4']
+# Datasets whose cached hashes are compared against each other in the global pass
+global_base_dirs = ['/home/user/kz-mm/data/DataSet_1'] + base_dirs
+DHASH_MAX_DISTANCE = 10  # imagededup's default max_distance_threshold
+# Reduced-resolution decoding in dhash_engine; False gives hashes bit-identical to imagededup
+FAST_HASHING = True
 
 
-for base_dir in base_dirs:
+@instrumented("global_dedup")
+def find_global_duplicates(base_dirs, max_distance=DHASH_MAX_DISTANCE):
+    """
+    Near-duplicates across topics, subclusters and datasets using the DHash
+    values cached in the manifest and a multi-index Hamming search.
+    Writes global_duplicates.json ({path: [paths]}, like all_duplicates_*.json)
+    and global_duplicate_groups.json (connected groups of paths).
+    Images of base_dirs that were never hashed (e.g. a dataset not run through
+    find_dataset_duplicates) are hashed first, so none are silently left out.
+    """
+    missing = unhashed_images(base_dirs)
+    if missing:
+        print(f"Hashing {sum(len(files) for _, files in missing)} images without a cached hash")
+        for topic_path, encodings in hash_topics(missing, fast=FAST_HASHING):
+            store_hashes([(os.path.join(topic_path, k), v) for k, v in encodings.items() if v])
+        unreadable = sum(len(files) for _, files in unhashed_images(base_dirs))
+        if unreadable:
+            print(f"⚠️ {unreadable} unreadable images are left out of the global search")
+    paths, hashes = load_hashes(base_dirs)
+    print(f"Global duplicate search over {len(paths)} hashed images (distance <= {max_distance})")
+    index = MultiIndexHash(hex_to_codes(hashes))
+    pairs = list(index.pairs(max_distance))
+
+    global_duplicates = defaultdict(list)
+    for i_block, j_block, _ in pairs:
+        for i, j in zip(i_block.tolist(), j_block.tolist()):
+            global_duplicates[paths[i]].append(paths[j])
+            global_duplicates[paths[j]].append(paths[i])
+    groups = [[paths[i] for i in group] for group in duplicate_groups(len(paths), pairs)]
+
+    with open('global_duplicates.json', 'w') as f:
+        json.dump({k: sorted(v) for k, v in sorted(global_duplicates.items())}, f, indent=2)
+    with open('global_duplicate_groups.json', 'w') as f:
+        json.dump(groups, f, indent=2)
+
+    summary = {
+        'total_images': len(paths),
+        'duplicate_groups': len(groups),
+        'duplicate_images': sum(len(g) for g in groups),
+        'cross_topic_groups': sum(len({os.path.dirname(p) for p in g}) > 1 for g in groups),
+        # DataSet_N/cluster/subcluster/topic/image
+        'cross_dataset_groups': sum(len({p.split(os.sep)[-5] for p in g}) > 1 for g in groups),
+    }
+    current_stage().items(len(paths))
+    print(json.dumps(summary, indent=2))
+    return groups
+
+
+@instrumented("hash_dataset")
+def find_dataset_duplicates(base_dir):
+    """Per-topic duplicates, all_duplicates_<dataset>.json and the summary for one dataset."""
     curr_cluster_num = 1
     all_duplicates = {}
     total_images = 0
     total_duplicates = set()
     cluster_stats = {}
-    num_clusters = len(os.listdir(base_dir))
     dataset_name = base_dir.split('/')[-1]
     print(base_dir)
-    for cluster in tqdm(os.listdir(base_dir)):
-        cluster_path = os.path.join(base_dir, cluster)
-        if not os.path.isdir(cluster_path):
-            continue
+    dataset_topics = list(iter_topics([base_dir]))
+    stage = current_stage()
+    # Hash all topics of the dataset in parallel before comparing within topics
+    with stage.timer('hash'):
+        topic_encodings = dict(hash_topics(
+            [(t.path, topic_images(t.path)) for t in dataset_topics], fast=FAST_HASHING
+        ))
+    # Topics are ordered by cluster in the manifest, so group them per cluster
+    for cluster, topics in groupby(tqdm(dataset_topics), key=lambda t: t.cluster):
         print(f"Processing # {curr_cluster_num}: {cluster}")
         cluster_duplicates = {}
         cluster_images = 0
         cluster_dup_set = set()
     
-        for subcluster in tqdm(os.listdir(cluster_path)):
-            subcluster_path = os.path.join(cluster_path, subcluster)
-            if not os.path.isdir(subcluster_path):
-                continue
-            print(f"\t{subcluster}...")
-            for topic in os.listdir(subcluster_path):
-                topic_path = os.path.join(subcluster_path, topic)
-                if not os.path.isdir(topic_path):
-                    continue
-                print(f"\t\t{topic}...")
-                try:
-                    encodings = dhasher.encode_images(image_dir=topic_path)
+        for topic_entry in topics:
+            topic = topic_entry.topic
+            topic_path = topic_entry.path
+            subcluster_path = os.path.dirname(topic_path)
+            print(f"\t{topic_entry.subcluster}/{topic}...")
+            try:
+                encodings = topic_encodings[topic_path]
+                with stage.timer('compare'):
                     duplicates = dhasher.find_duplicates(encoding_map=encodings)
-                except Exception as e:
-                    print(f"error!!! topic {topic_path} | {e}")
-                    continue
-    
-                # Save per-topic duplicates
-                output_path = os.path.join(subcluster_path, f'duplicates_{topic}.json')
-                with open(output_path, 'w') as f:
-                    json.dump(duplicates, f, indent=2)
-    
-                cluster_duplicates.update({
-                    os.path.join(topic_path, k): [os.path.join(topic_path, dup) for dup in v]
-                    for k, v in duplicates.items() if v
-                })
-    
-                # Update stats
-                cluster_images += len(encodings)
-                for k, v in duplicates.items():
-                    for dup in v:
-                        cluster_dup_set.add(os.path.join(topic_path, dup))
-                        cluster_dup_set.add(os.path.join(topic_path, k))
-                        
+            except Exception as e:
+                print(f"error!!! topic {topic_path} | {e}")
+                continue
+
+            store_hashes([(os.path.join(topic_path, k), v) for k, v in encodings.items() if v])
+
+            # Save per-topic duplicates
+            output_path = os.path.join(subcluster_path, f'duplicates_{topic}.json')
+            with open(output_path, 'w') as f:
+                json.dump(duplicates, f, indent=2)
+
+            cluster_duplicates.update({
+                os.path.join(topic_path, k): [os.path.join(topic_path, dup) for dup in v]
+                for k, v in duplicates.items() if v
+            })
+
+            # Update stats
+            stage.items(len(encodings))
+            stage.topic(topic_path, images=len(encodings), duplicates=sum(bool(v) for v in duplicates.values()))
+            cluster_images += len(encodings)
+            for k, v in duplicates.items():
+                for dup in v:
+                    cluster_dup_set.add(os.path.join(topic_path, dup))
+                    cluster_dup_set.add(os.path.join(topic_path, k))
+
         curr_cluster_num += 1
         all_duplicates[cluster] = cluster_duplicates
         total_images += cluster_images
@@ -87,4 +151,14 @@ for base_dir in base_dirs:
         json.dump(summary, f, indent=2)
     
     # Print stats
-    print(json.dumps(summary, indent=2))
\ No newline at end of file
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    refresh_manifest(global_base_dirs)
+
+    for base_dir in base_dirs:
+        find_dataset_duplicates(base_dir)
+
+    # Compare all cached hashes at once to catch duplicates across topics and datasets
+    find_global_duplicates(global_base_dirs)
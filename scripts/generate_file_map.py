@@ -1,31 +1,151 @@
+import os
 import json
+import sqlite3
 import unicodedata
 from urllib.parse import quote
 from pathlib import Path
+from metrics import instrumented, current_stage
 
 LOCAL_ROOT = Path("/home/user/kz-mm/data/full_dataset").resolve()
 REPO_ID = "horde-research/kaz-vision-50k"
 BASE_URL = f"https://huggingface.co/datasets/{REPO_ID}/resolve/main"
-OUTPUT_JSON = "file_map.json"
+FILE_MAP_DB = "file_map.sqlite"
+WRITE_BATCH = 10_000
 
-def generate_file_map(local_root: Path, base_url: str) -> dict:
-    file_map = {}
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
 
-    for file_path in local_root.rglob("*"):
-        if file_path.is_file():
-            relative_path = file_path.relative_to(local_root)
-            normalized_path = unicodedata.normalize("NFD", relative_path.as_posix())
-            encoded_path = quote(normalized_path)
-            hf_url = f"{base_url}/{encoded_path}"
-            file_map[str(file_path)] = hf_url
 
-    return file_map
+def connect(db_path=FILE_MAP_DB):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
 
-def save_file_map(file_map: dict, output_path: str):
+
+def build_url(relative_path: str, base_url: str) -> str:
+    normalized_path = unicodedata.normalize("NFD", relative_path)
+    encoded_path = quote(normalized_path)
+    return f"{base_url}/{encoded_path}"
+
+
+@instrumented("file_map")
+def generate_file_map(local_root: Path, base_url: str, db_path: str = FILE_MAP_DB, full: bool = False) -> dict:
+    """
+    Stream every file under local_root into the SQLite file map with its
+    Hugging Face URL. A directory whose mtime is unchanged since the last run
+    keeps its stored entries (only its subdirectories are visited), so reruns
+    only touch folders where files were added or removed. A folder's new rows,
+    deletions and its dirs row are committed in the same transaction, so an
+    interrupted run never records a folder as scanned without its files.
+    """
+    conn = connect(db_path)
+    root = str(local_root)
+    known_dirs = dict(conn.execute("SELECT path, mtime_ns FROM dirs"))
+    seen_dirs = set()
+    stats = {'dirs': 0, 'rescanned_dirs': 0, 'added': 0, 'removed': 0}
+    pending, pending_deletes, pending_dirs = [], [], []
+
+    def flush():
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", pending)
+            conn.executemany("DELETE FROM files WHERE path = ?", pending_deletes)
+            conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?)", pending_dirs)
+        pending.clear()
+        pending_deletes.clear()
+        pending_dirs.clear()
+
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        seen_dirs.add(dir_path)
+        stats['dirs'] += 1
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        unchanged = not full and known_dirs.get(dir_path) == mtime_ns
+        names = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif not unchanged and entry.is_file():
+                    names.append(entry.path)
+        if unchanged:
+            continue
+
+        stats['rescanned_dirs'] += 1
+        stored = {p for (p,) in conn.execute("SELECT path FROM files WHERE dir = ?", (dir_path,))}
+        for file_path in names:
+            if file_path in stored:
+                stored.discard(file_path)
+                continue
+            relative_path = os.path.relpath(file_path, root).replace(os.sep, '/')
+            pending.append((file_path, dir_path, build_url(relative_path, base_url)))
+            stats['added'] += 1
+        pending_deletes.extend((p,) for p in stored)
+        pending_dirs.append((dir_path, mtime_ns))
+        stats['removed'] += len(stored)
+        if len(pending) + len(pending_deletes) >= WRITE_BATCH:
+            flush()
+    flush()
+
+    gone = [(d,) for d in known_dirs if d not in seen_dirs]
+    with conn:
+        for (d,) in gone:
+            stats['removed'] += conn.execute("DELETE FROM files WHERE dir = ?", (d,)).rowcount
+        conn.executemany("DELETE FROM dirs WHERE path = ?", gone)
+    total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    conn.close()
+    stage = current_stage()
+    stage.items(stats['added'])
+    for key, value in stats.items():
+        stage.count(key, value)
+    print(f"Mapping completed: {total} files in {db_path} "
+          f"({stats['rescanned_dirs']}/{stats['dirs']} folders rescanned, "
+          f"+{stats['added']} / -{stats['removed']} files)")
+    return stats
+
+
+def lookup_urls(paths, db_path: str = FILE_MAP_DB) -> dict:
+    """Bulk lookup {path: url} for the given local paths; missing paths are left out."""
+    conn = connect(db_path)
+    paths = list(paths)
+    found = {}
+    for i in range(0, len(paths), 900):
+        chunk = paths[i:i + 900]
+        query = f"SELECT path, url FROM files WHERE path IN ({','.join('?' * len(chunk))})"
+        found.update(conn.execute(query, chunk))
+    conn.close()
+    return found
+
+
+def lookup_url(path: str, db_path: str = FILE_MAP_DB):
+    """URL of a single local path, or None."""
+    return lookup_urls([path], db_path).get(path)
+
+
+def save_file_map(output_path: str, db_path: str = FILE_MAP_DB):
+    """Export the store as the legacy {path: url} JSON, streamed row by row."""
+    conn = connect(db_path)
+    count = 0
     with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(file_map, f, ensure_ascii=False, indent=2)
-    print(f"Mapping completed: {len(file_map)} files saved to {output_path}")
+        f.write("{")
+        for path, url in conn.execute("SELECT path, url FROM files ORDER BY path"):
+            f.write(("," if count else "") + f"\n  {json.dumps(path, ensure_ascii=False)}: {json.dumps(url)}")
+            count += 1
+        f.write("\n}\n")
+    conn.close()
+    print(f"Exported {count} files to {output_path}")
+
 
 if __name__ == "__main__":
-    file_map = generate_file_map(LOCAL_ROOT, BASE_URL)
-    save_file_map(file_map, OUTPUT_JSON)
+    generate_file_map(LOCAL_ROOT, BASE_URL)
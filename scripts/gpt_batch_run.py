@@ -1,55 +1,297 @@
-import time
+import os
+import sys
 import json
-from openai import OpenAI
+import asyncio
+import hashlib
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from file_utils import atomic_write_json
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH, request_key
+from metrics import instrumented, current_stage
 
-BATCH_INPUT_PATH = "batch_input.jsonl"
+SHARD_MANIFEST_PATH = "batch_inputs/shards.json"
 BATCH_NAME = "generate_kz_captions_batch"
 COMPLETION_WINDOW = "24h"
-OUTPUT_JSON = "output_valid_dataset_xsmall.json"
+STATE_PATH = "batch_state.json"
+RESULTS_DIR = "batch_results"
+POLL_INTERVAL = 15
+MAX_CONCURRENT_UPLOADS = 4
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
-def run_batch(input_path: str, output_path: str):
-    load_dotenv()
-    client = OpenAI()
 
-    with open(input_path, "rb") as f:
-        upload = client.files.create(file=f, purpose="batch")
-    print(f"[UPLOAD] File uploaded: {upload.id}")
+class BatchState:
+    """
+    Local record of every shard's upload, batch id, status and download, saved
+    atomically after each change so a restarted run never uploads or submits
+    a shard twice and never downloads a finished result twice. Each entry keeps
+    the sha256 of the shard it was made for.
+    """
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.shards = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.shards = json.load(f)
+
+    def get(self, shard_file):
+        return self.shards.setdefault(shard_file, {})
+
+    def update(self, shard_file, **fields):
+        self.get(shard_file).update(fields)
+        atomic_write_json(self.path, self.shards, ensure_ascii=False, indent=2)
+
+    def reset(self, shard_file, **fields):
+        self.shards[shard_file] = {}
+        self.update(shard_file, **fields)
+        return self.shards[shard_file]
+
+
+def shard_digest(shard_file):
+    """sha256 of a shard file's content."""
+    digest = hashlib.sha256()
+    with open(shard_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def retry_shard_path(shard_file):
+    """batch_input_00000.jsonl → batch_input_00000.retry1.jsonl → ….retry2.jsonl"""
+    root, ext = os.path.splitext(shard_file)
+    stem, _, n = root.rpartition(".retry")
+    if stem and n.isdigit():
+        return f"{stem}.retry{int(n) + 1}{ext}"
+    return f"{root}.retry1{ext}"
+
+
+def write_retry_shard(shard_file, output_path):
+    """Write the requests of shard_file missing from output_path to a retry shard; its path, or None."""
+    answered = set()
+    if output_path and os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as f:
+            answered = {json.loads(line)["custom_id"] for line in f}
+    retry_path = retry_shard_path(shard_file)
+    missing = 0
+    with open(shard_file, encoding="utf-8") as src, open(retry_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if json.loads(line)["custom_id"] not in answered:
+                dst.write(line)
+                missing += 1
+    if not missing:
+        os.remove(retry_path)
+        return None
+    print(f"[RETRY] {missing} unprocessed requests of {shard_file} → {retry_path}")
+    return retry_path
+
+
+def discard_shard(state, shard_file, results_dir):
+    """Remove the downloaded results of shard_file and of its retry shards, and the retry shards themselves."""
+    entry = state.get(shard_file)
+    if "batch_id" in entry:
+        for suffix in ("", ".errors"):
+            stale = os.path.join(results_dir, f"{entry['batch_id']}{suffix}.jsonl")
+            if os.path.exists(stale):
+                os.remove(stale)
+    if entry.get("retry_shard"):
+        discard_shard(state, entry["retry_shard"], results_dir)
+        state.shards.pop(entry["retry_shard"], None)
+        if os.path.exists(entry["retry_shard"]):
+            os.remove(entry["retry_shard"])
+
+
+def shard_chain(state, shard_file):
+    """shard_file followed by its retry shards, as far as they were created."""
+    chain = [shard_file]
+    while state.get(chain[-1]).get("retry_shard"):
+        chain.append(state.get(chain[-1])["retry_shard"])
+    return chain
 
-    batch = client.batches.create(
-        input_file_id=upload.id,
-        endpoint="/v1/chat/completions",
-        completion_window=COMPLETION_WINDOW,
-        metadata={"name": BATCH_NAME}
-    )
-    
-    print(f"[BATCH] Batch created: {batch.id} | Status: {batch.status}")
+
+async def stream_file_to_jsonl(client, file_id, output_path):
+    """Stream an OpenAI file line by line into output_path (via a .part file)."""
+    part_path = output_path + ".part"
+    count = 0
+    async with client.files.with_streaming_response.content(file_id) as response:
+        with open(part_path, "w", encoding="utf-8") as f:
+            async for line in response.iter_lines():
+                if line.strip():
+                    f.write(line.rstrip("\n") + "\n")
+                    count += 1
+    os.replace(part_path, output_path)
+    return count
+
+
+def ingest_into_cache(shard_file, output_path, cache):
+    """Store every successful result with message content in the response cache under its request's key."""
+    keys = {}
+    with open(shard_file, encoding="utf-8") as f:
+        for line in f:
+            request = json.loads(line)
+            keys[request["custom_id"]] = (request_key(request["body"]), request["body"].get("model"))
+    stored = 0
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200 and result["custom_id"] in keys:
+                key, model = keys[result["custom_id"]]
+                stored += cache.put_key(key, response["body"], model)
+    return stored
+
+
+async def run_shard(client, state, shard_file, upload_slots, results_dir=RESULTS_DIR, poll_interval=POLL_INTERVAL,
+                    cache=None):
+    """
+    Upload, submit, poll and download one shard, resuming from whatever the state
+    already has. A shard whose content changed since it was submitted (e.g.
+    regenerated by batch_jsonl_prepare) is submitted again and its old results
+    are removed. Entries from before content hashes were kept adopt the current hash.
+
+    Only a completed batch marks the shard as done. A failed batch forgets its
+    batch id, so the next run submits the shard again. The requests an expired
+    or cancelled batch did not answer are written to a retry shard, which is
+    run right after (and resumed on later runs) like any other shard.
+    """
+    entry = state.get(shard_file)
+    digest = shard_digest(shard_file)
+    if "sha256" not in entry:
+        state.update(shard_file, sha256=digest)
+    elif entry["sha256"] != digest:
+        print(f"[CHANGED] {shard_file} differs from the submitted shard, resubmitting")
+        discard_shard(state, shard_file, results_dir)
+        entry = state.reset(shard_file, sha256=digest)
+    if entry.get("downloaded"):
+        if entry.get("retry_shard"):
+            await run_shard(client, state, entry["retry_shard"], upload_slots, results_dir, poll_interval, cache)
+        return entry
+
+    if "input_file_id" not in entry:
+        async with upload_slots:
+            with open(shard_file, "rb") as f:
+                upload = await client.files.create(file=f, purpose="batch")
+        state.update(shard_file, input_file_id=upload.id)
+        print(f"[UPLOAD] {shard_file} → {upload.id}")
+
+    if "batch_id" not in entry:
+        batch = await client.batches.create(
+            input_file_id=entry["input_file_id"],
+            endpoint="/v1/chat/completions",
+            completion_window=COMPLETION_WINDOW,
+            metadata={"name": BATCH_NAME, "shard": os.path.basename(shard_file)}
+        )
+        state.update(shard_file, batch_id=batch.id, status=batch.status)
+        print(f"[BATCH] {shard_file} → {batch.id} | Status: {batch.status}")
 
     while True:
-        status = client.batches.retrieve(batch.id)
-        print(f"[WAIT] Status: {status.status}")
-        if status.status in {"completed", "failed", "expired"}:
+        status = await client.batches.retrieve(entry["batch_id"])
+        if status.status != entry.get("status"):
+            print(f"[WAIT] {entry['batch_id']} Status: {status.status}")
+            state.update(shard_file, status=status.status)
+        if status.status in TERMINAL_STATUSES:
             break
-        time.sleep(15)
+        await asyncio.sleep(poll_interval)
 
-    if status.status == "completed":
-        file_id = status.output_file_id
-        if not file_id:
-            print("[ERROR] Batch completed, but output_file_id is missing.")
-            return
+    if status.status == "failed":
+        print(f"[FAILURE] Batch {entry['batch_id']} failed. Error: {status.errors}. "
+              f"{shard_file} will be resubmitted on the next run")
+        state.reset(shard_file, sha256=digest, input_file_id=entry["input_file_id"],
+                    failed_batches=entry.get("failed_batches", []) + [entry["batch_id"]])
+        return state.get(shard_file)
+    # Expired / cancelled batches can still carry partial output
+    os.makedirs(results_dir, exist_ok=True)
+    downloads = {}
+    for kind, file_id in (("output", status.output_file_id), ("errors", status.error_file_id)):
+        if file_id:
+            suffix = "" if kind == "output" else ".errors"
+            path = os.path.join(results_dir, f"{entry['batch_id']}{suffix}.jsonl")
+            downloads[kind] = await stream_file_to_jsonl(client, file_id, path)
+            print(f"[DOWNLOAD] {downloads[kind]} {kind} lines → {path}")
+            if kind == "output" and cache is not None:
+                print(f"[CACHE] {ingest_into_cache(shard_file, path, cache)} responses cached")
+    retry_shard = None
+    if status.status != "completed":
+        output_path = os.path.join(results_dir, f"{entry['batch_id']}.jsonl") if "output" in downloads else None
+        retry_shard = write_retry_shard(shard_file, output_path)
+    state.update(shard_file, downloaded=True, output_lines=downloads.get("output", 0),
+                 error_lines=downloads.get("errors", 0), retry_shard=retry_shard)
+    if retry_shard:
+        await run_shard(client, state, retry_shard, upload_slots, results_dir, poll_interval, cache)
+    return entry
 
-        print(f"[DOWNLOAD] Fetching content from file ID: {file_id}")
-        response = client.files.content(file_id)
 
-        lines = [json.loads(line) for line in response.text.strip().splitlines()]
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(lines, f, ensure_ascii=False, indent=2)
-        print(f"[SUCCESS] Saved {len(lines)} entries to {output_path}")
+@instrumented("batch_run")
+async def run_batches(client, shard_files, state_path=STATE_PATH, results_dir=RESULTS_DIR,
+                      poll_interval=POLL_INTERVAL, cache_path=RESPONSE_CACHE_PATH):
+    """
+    Drive all shards concurrently; one shard failing does not stop the others.
+    Downloaded results are also written to the response cache (cache_path=None to skip).
+    """
+    state = BatchState(state_path)
+    upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    cache = ResponseCache(cache_path) if cache_path else None
+    results = await asyncio.gather(
+        *(run_shard(client, state, shard_file, upload_slots, results_dir, poll_interval, cache)
+          for shard_file in shard_files),
+        return_exceptions=True,
+    )
+    if cache is not None:
+        cache.close()
+    for shard_file, result in zip(shard_files, results):
+        if isinstance(result, Exception):
+            print(f"[ERROR] {shard_file}: {result}")
+    chains = [shard_chain(state, s) for s in shard_files]
+    done = sum(all(state.get(s).get("downloaded") for s in chain) for chain in chains)
+    stage = current_stage()
+    stage.items(sum(state.get(s).get("output_lines", 0) for chain in chains for s in chain))
+    stage.count("shards_downloaded", done)
+    stage.count("shards_failed", sum(isinstance(r, Exception) for r in results))
+    print(f"[SUCCESS] {done}/{len(shard_files)} shards downloaded into {results_dir}")
+    return state.shards
+
+
+def load_id_map(manifest_path=SHARD_MANIFEST_PATH):
+    """{custom_id: image_path} from the custom_ids.jsonl written next to the shards."""
+    with open(manifest_path, encoding="utf-8") as f:
+        id_map_path = json.load(f)["id_map"]
+    id_map = {}
+    with open(id_map_path, encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            id_map[row["custom_id"]] = row["image_path"]
+    return id_map
+
+
+def iter_results(results_dir=RESULTS_DIR, id_map=None, manifest_path=SHARD_MANIFEST_PATH):
+    """
+    Yield (image_path, result) for every line of the results store (error files
+    excluded), followed by the requests batch preparation answered from the
+    response cache. image_path is None when no id_map is given or the id is unknown.
+    """
+    id_map = id_map or {}
+    files = [os.path.join(results_dir, name) for name in sorted(os.listdir(results_dir))
+             if name.endswith(".jsonl") and not name.endswith(".errors.jsonl")]
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            cached_results = json.load(f).get("cached_results")
+        if cached_results and os.path.exists(cached_results):
+            files.append(cached_results)
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                yield id_map.get(result.get("custom_id")), result
+
+
+def load_shard_files(manifest_path=SHARD_MANIFEST_PATH):
+    with open(manifest_path, encoding="utf-8") as f:
+        return [shard["file"] for shard in json.load(f)["shards"]]
 
-    elif status.status == "failed":
-        print(f"[FAILURE] Batch failed. Error: {status.error}")
-    else:
-        print(f"[INFO] Final status: {status.status}")
 
 if __name__ == "__main__":
-    run_batch(BATCH_INPUT_PATH, OUTPUT_JSON)
+    # e.g. `python gpt_batch_run.py judge_batch_inputs/shards.json judge_batch_results` for judging
+    manifest_path = sys.argv[1] if len(sys.argv) > 1 else SHARD_MANIFEST_PATH
+    results_dir = sys.argv[2] if len(sys.argv) > 2 else RESULTS_DIR
+    load_dotenv()
+    # AsyncOpenAI honours OPENAI_BASE_URL, so the same run works against a local stub server
+    asyncio.run(run_batches(AsyncOpenAI(), load_shard_files(manifest_path), results_dir=results_dir))
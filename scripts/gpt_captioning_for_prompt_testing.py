@@ -1,10 +1,20 @@
+import os
 import json
-import base64
 import random
+import asyncio
+from functools import partial
 from pathlib import Path
 from collections import defaultdict
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+from image_payload import image_data_url, print_payload_report
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH
+from realtime_client import run_requests, MAX_CONCURRENCY, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from file_utils import atomic_write_json
+from metrics import instrumented
+
+CHECKPOINT_PATH = "captions_checkpoint.jsonl"
+MAX_GROUPS = 50
 
 
 def get_random_path_excluding_first(paths: list[str]) -> str:
@@ -16,53 +26,8 @@ def get_random_path_excluding_first(paths: list[str]) -> str:
     return random.choice(paths[1:])
 
 
-def generate_kz_captions(
-    client: OpenAI,
-    input_json_path: str,
-    output_json_path: str,
-    model_name: str = "gpt-4o-mini-2024-07-18"
-):
-    """
-    Generate captions for images listed in the input JSON file using GPT, not using batch-mode.
-    Saves a dictionary with image path and two captions (with and without keyword) to JSON.
-    Args:
-        client (OpenAI): Initialized OpenAI client.
-        input_json_path (str): Path to the input JSON file with image paths.
-        output_json_path (str): Path to save the output JSON with captions.
-        model_name (str): Name of the model to use.
-    """
-    with open(input_json_path, "r") as f:
-        image_paths = json.load(f)
-
-    # To group by categories 
-    grouped = defaultdict(list)
-    for path_str in image_paths:
-        path = Path(path_str)
-        parts = path.parts
-        try:
-            key = f"{parts[-4]}/{parts[-3]}"
-            grouped[key].append(path_str)
-        except IndexError:
-            print(f"Wrong path: {path_str}")
-            continue
-
-    result = {}
-    
-    for idx, paths in enumerate(grouped.values(), 1):      
-        image_path = paths[0]
-        if idx > 50:
-            break
-        image_path = get_random_path_excluding_first(paths)
-        topic_name = Path(image_path).parts[-2]
-
-        try:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        except Exception as e:
-            print(f"Failed to load image {image_path}: {e}")
-            continue
-
-        prompt_with_keyword = f"""
+def build_prompt_with_keyword(topic_name: str) -> str:
+    return f"""
 You are a precise visual assistant for a blind person. Write a factual, detailed caption in Kazakh for the image, using exactly five sentences (40–60 words). Describe only what is directly visible: objects, their appearance, interactions, and environment. Use clear, neutral Kazakh; avoid style, opinions, or guesses (e.g., no “looks cozy” or “seems happy”). No 'Суретте' at the beginning. Just describe the image directly. 
 Include '{topic_name}' only if they clearly match the scene—don’t force them.
 Each sentence must describe a distinct, observable detail, such as:
@@ -74,7 +39,8 @@ Each sentence must describe a distinct, observable detail, such as:
 Use simple, natural Kazakh and precise, factual adjectives (e.g., “үлкен,” “көк”)—not subjective (e.g., “әдемі,” “жылы”). Don’t mention time, purpose, or unseen context.
         """
 
-        prompt_without_keyword = """
+
+PROMPT_WITHOUT_KEYWORD = """
 You are a precise visual assistant. Write a factual, detailed caption in Kazakh for the image, using exactly five sentences (40–60 words).
 Describe only what is directly visible: objects, their appearance, interactions, and environment. Use clear, neutral Kazakh; avoid style, opinions, or guesses (e.g., no “looks cozy” or “seems happy”).
 Each sentence must describe a distinct, observable detail, such as:
@@ -86,76 +52,171 @@ Each sentence must describe a distinct, observable detail, such as:
 Use simple, natural Kazakh and precise, factual adjectives (e.g., “үлкен,” “көк”)—not subjective (e.g., “әдемі,” “жылы”). Don’t mention time, purpose, or unseen context.
         """
 
-        # With keyword
-        try:
-            response_1 = client.chat.completions.create(
-                model=model_name,
-                messages=[
+
+def build_caption_request(prompt: str, image_url: str, model_name: str) -> dict:
+    return {
+        "model": model_name,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
                     {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt_with_keyword},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "low",
-                                },
-                            },
-                        ],
-                    }
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                            "detail": "low",
+                        },
+                    },
                 ],
-                max_tokens=300,
-            )
-            caption_with_kw = response_1.choices[0].message.content.strip()
-            print(f"\n[DEBUG] Response with keyword:\n{caption_with_kw!r}\n")
-        except Exception as e:
-            print(f"Error (with keyword) on {image_path}: {e}")
-            caption_with_kw = "[ERROR]"
-
-        # Without keyword
+            }
+        ],
+        "max_tokens": 300,
+    }
+
+
+def build_caption_request_for_image(prompt: str, image_path: str, model_name: str) -> dict:
+    # Downscaled once, then served from the payload cache for the second caption
+    return build_caption_request(prompt, image_data_url(image_path), model_name)
+
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """{entry key: entry} rebuilt from the append-only checkpoint; later lines win."""
+    result = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from an interrupted run
+                entry = result.setdefault(row["key"], {"image_path": row["image_path"]})
+                entry[row["field"]] = row["caption"]
+    return result
+
+
+def select_images(image_paths: list[str], done: dict, max_groups: int = MAX_GROUPS) -> dict:
+    """
+    One random image (not the first) per category/subcategory group, keyed
+    image_with_caption_<idx>. Groups already in the checkpoint keep their image.
+    """
+    # To group by categories
+    grouped = defaultdict(list)
+    for path_str in image_paths:
+        parts = Path(path_str).parts
         try:
-            response_2 = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt_without_keyword},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "low",
-                                },
-                            },
-                        ],
-                    }
-                ],
-                max_tokens=300,
-            )
-            caption_without_kw = response_2.choices[0].message.content.strip()
-            print(f"\n[DEBUG] Response without keyword:\n{caption_without_kw!r}\n")
-        except Exception as e:
-            print(f"Error (without keyword) on {image_path}: {e}")
-            caption_without_kw = "[ERROR]"
-        
-        result[f"image_with_caption_{idx}"] = {
+            key = f"{parts[-4]}/{parts[-3]}"
+            grouped[key].append(path_str)
+        except IndexError:
+            print(f"Wrong path: {path_str}")
+            continue
+
+    selected = {}
+    for idx, paths in enumerate(grouped.values(), 1):
+        if idx > max_groups:
+            break
+        key = f"image_with_caption_{idx}"
+        selected[key] = done[key]["image_path"] if key in done else get_random_path_excluding_first(paths)
+    return selected
+
+
+def iter_caption_jobs(selected: dict, done: dict, model_name: str):
+    """
+    Yield ((key, image_path, field), build) for every caption still missing;
+    build() reads the image and returns the request body.
+    """
+    for key, image_path in selected.items():
+        missing = [field for field in ("caption_1", "caption_2") if field not in done.get(key, {})]
+        if not missing:
+            continue
+        topic_name = Path(image_path).parts[-2]
+        prompts = {"caption_1": build_prompt_with_keyword(topic_name), "caption_2": PROMPT_WITHOUT_KEYWORD}
+        for field in missing:
+            yield (key, image_path, field), partial(build_caption_request_for_image, prompts[field], image_path,
+                                                    model_name)
+
+
+@instrumented("captioning")
+async def generate_kz_captions_async(
+    client: AsyncOpenAI,
+    input_json_path: str,
+    output_json_path: str,
+    model_name: str = "gpt-4o-mini-2024-07-18",
+    checkpoint_path: str = CHECKPOINT_PATH,
+    cache_path: str = RESPONSE_CACHE_PATH,
+    concurrency: int = MAX_CONCURRENCY,
+    rpm: int = REQUESTS_PER_MINUTE,
+    tpm: int = TOKENS_PER_MINUTE,
+    max_groups: int = MAX_GROUPS,
+):
+    """
+    Generate captions for images listed in the input JSON file using GPT, not using batch-mode.
+    Both captions of every image are requested concurrently under the rate limits,
+    and each finished caption is appended to the checkpoint so an interrupted run
+    resumes where it stopped. Failed requests are not checkpointed and are retried
+    on the next run.
+    Args:
+        client (AsyncOpenAI): Initialized async OpenAI client.
+        input_json_path (str): Path to the input JSON file with image paths.
+        output_json_path (str): Path to save the output JSON with captions.
+        model_name (str): Name of the model to use.
+        checkpoint_path (str): Append-only JSONL of finished captions.
+        cache_path (str): Response cache; identical requests are never paid for twice.
+    """
+    with open(input_json_path, "r") as f:
+        image_paths = json.load(f)
+
+    done = load_checkpoint(checkpoint_path)
+    selected = select_images(image_paths, done, max_groups)
+    if done:
+        print(f"[RESUME] {sum(len(e) - 1 for e in done.values())} captions loaded from {checkpoint_path}")
+
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        def on_result(job, response, error):
+            key, image_path, field = job
+            if error is not None:
+                print(f"Error ({field}) on {image_path}: {error}")
+                return
+            caption = (response["choices"][0]["message"]["content"] or "").strip()
+            if not caption:
+                # Raising counts the request as failed and keeps it out of the response cache
+                raise ValueError("response has no caption (refused or filtered)")
+            done.setdefault(key, {"image_path": image_path})[field] = caption
+            checkpoint.write(json.dumps({"key": key, "image_path": image_path, "field": field,
+                                         "caption": caption}, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+
+        cache = ResponseCache(cache_path)
+        try:
+            await run_requests(client, iter_caption_jobs(selected, done, model_name), on_result,
+                               concurrency=concurrency, rpm=rpm, tpm=tpm, cache=cache)
+        finally:
+            cache.close()
+
+    result = {}
+    for key, image_path in selected.items():
+        entry = done.get(key, {})
+        result[key] = {
             "image_path": image_path,
-            "caption_1": caption_with_kw,
-            "caption_2": caption_without_kw,
+            "caption_1": entry.get("caption_1", "[ERROR]"),
+            "caption_2": entry.get("caption_2", "[ERROR]"),
         }
-        
+    atomic_write_json(output_json_path, result, ensure_ascii=False, indent=2)
+    print_payload_report()
+    print(f"\nDone. Saved {len(result)} entries to {output_json_path}")
+    return result
 
-    with open(output_json_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
 
-    print(f"\nDone. Saved {len(result)} entries to {output_json_path}")
+def generate_kz_captions(client: AsyncOpenAI, input_json_path: str, output_json_path: str,
+                         model_name: str = "gpt-4o-mini-2024-07-18", **kwargs):
+    """Synchronous entry point for generate_kz_captions_async."""
+    return asyncio.run(generate_kz_captions_async(client, input_json_path, output_json_path, model_name, **kwargs))
 
 
 if __name__ == "__main__":
     load_dotenv()
-    client = OpenAI()
+    # Retries are handled by realtime_client with rate-limit aware backoff
+    client = AsyncOpenAI(max_retries=0)
 
     input_json_path = "train_set_Xsmall.json"
     output_json_path = "captions_output.json"
@@ -1,81 +1,252 @@
+import sys
 import json
-import base64
+import asyncio
+from functools import partial
 from pathlib import Path
-from openai import OpenAI
+from collections import defaultdict
+import numpy as np
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH
+from image_payload import image_data_url, print_payload_report
+from realtime_client import run_requests, MAX_CONCURRENCY, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from batch_jsonl_prepare import write_sharded_jsonl
+from gpt_batch_run import iter_results
+from file_utils import atomic_write_json
+from metrics import instrumented
 
 JUDGING_DATA_PATH = "captions_output.json"
 OUTPUT_PATH = "judged_captions_output.json"
 MODEL_NAME = "gpt-4o-mini-2024-07-18"
+JUDGE_BATCH_DIR = "judge_batch_inputs"
+JUDGE_RESULTS_DIR = "judge_batch_results"
+WIN_RATES_PATH = "judge_win_rates.json"
 
-def judge_captions(client: OpenAI, input_path: str, output_path: str, model: str = MODEL_NAME):
-    with open(input_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    updated_data = {}
-
-    for image_id, entry in data.items():
-        image_path = entry["image_path"]
-        caption_1 = entry["caption_1"]
-        caption_2 = entry["caption_2"]
-
-        try:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        except Exception as e:
-            print(f"[ERROR] Failed to read: {image_path}. Reason: {e}")
-            continue
+# Every pair is judged twice: "ab" shows caption_1 first, "ba" shows caption_2 first
+ORDERS = ("ab", "ba")
+CAPTION_WINNERS = {"caption_1": "with_keyword", "caption_2": "without_keyword"}
+# with_keyword share of a verdict, for win rates
+WINNER_SCORES = {"with_keyword": 1.0, "without_keyword": 0.0, "tie": 0.5}
 
-        print(f"Judging: {image_path}")
 
-        keyword = Path(image_path).parts[-2]
-        judge_prompt = f"""
+def build_judge_prompt(keyword: str) -> str:
+    return f"""
 You are a visual evaluator comparing two Kazakh captions (caption_1, caption_2) for an image tagged with '{keyword}'.
 Choose the one that best matches only visible content—no guesses, opinions, or stylistic bias.
 Prioritize accuracy, completeness, relevance. Penalize hallucinations, omissions, and subjectivity.
 Reply ONLY with: 1 or 2 (just the number, nothing else).
 """
 
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "user", "content": [
-                        {"type": "text", "text": judge_prompt},
-                        {"type": "text", "text": f"caption_1: {caption_1}"},
-                        {"type": "text", "text": f"caption_2: {caption_2}"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "low"}},
-                    ]},
-                ],
-                max_tokens=10,
-            )
-            content = response.choices[0].message.content.strip()
-            print(f"[RESULT] Judgement: {content}")
-
-            if content == "1":
-                winner = "with_keyword"
-            elif content == "2":
-                winner = "without_keyword"
-            else:
-                winner = "error"
-
-        except Exception as e:
-            print(f"[ERROR] OpenAI judging failed on {image_path}: {e}")
-            winner = "error"
-
-        updated_data[image_id] = {
-            "image_path": image_path,
-            "caption_1": caption_1,
-            "caption_2": caption_2,
-            "winner": winner,
+
+def build_judge_request(entry: dict, order: str, model: str = MODEL_NAME) -> dict:
+    """chat.completions body judging one entry with its captions shown in the given order."""
+    first, second = ("caption_1", "caption_2") if order == "ab" else ("caption_2", "caption_1")
+    keyword = Path(entry["image_path"]).parts[-2]
+    return {
+        "model": model,
+        "messages": [
+            {"role": "user", "content": [
+                {"type": "text", "text": build_judge_prompt(keyword)},
+                {"type": "text", "text": f"caption_1: {entry[first]}"},
+                {"type": "text", "text": f"caption_2: {entry[second]}"},
+                {"type": "image_url", "image_url": {"url": image_data_url(entry["image_path"]), "detail": "low"}},
+            ]},
+        ],
+        "max_tokens": 10,
+    }
+
+
+def iter_judge_jobs(data: dict, model: str = MODEL_NAME):
+    """Yield ((image_id, order), build) for both orders of every entry; build() reads the image and returns the body."""
+    for image_id, entry in data.items():
+        for order in ORDERS:
+            yield (image_id, order), partial(build_judge_request, entry, order, model)
+
+
+def response_content(body: dict):
+    """Message content of a chat completion body; None for refusals, filtered or malformed responses."""
+    try:
+        return body["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def parse_vote(content, order: str):
+    """Caption the judge picked ("caption_1" / "caption_2"), undoing the swap; None if missing or unparseable."""
+    content = (content or "").strip()
+    if content not in ("1", "2"):
+        return None
+    shown_first = content == "1"
+    if order == "ba":
+        shown_first = not shown_first
+    return "caption_1" if shown_first else "caption_2"
+
+
+def combine_votes(votes: dict) -> str:
+    """
+    Verdict from the twin votes: agreeing votes win, disagreeing votes are a
+    position-driven tie, a single valid vote stands on its own.
+    """
+    valid = [v for v in votes.values() if v]
+    if not valid:
+        return "error"
+    if len(set(valid)) > 1:
+        return "tie"
+    return CAPTION_WINNERS[valid[0]]
+
+
+def build_judged(data: dict, votes: dict) -> dict:
+    return {
+        image_id: {
+            "image_path": entry["image_path"],
+            "caption_1": entry["caption_1"],
+            "caption_2": entry["caption_2"],
+            "votes": votes.get(image_id, {}),
+            "winner": combine_votes(votes.get(image_id, {})),
         }
+        for image_id, entry in data.items()
+    }
+
+
+def save_judged(judged: dict, output_path: str):
+    atomic_write_json(output_path, judged, ensure_ascii=False, indent=2)
+    rates = win_rates(judged)
+    atomic_write_json(WIN_RATES_PATH, rates, ensure_ascii=False, indent=2)
+    print_win_rates(rates)
+    print(f"\n[FINISH] Judging complete. Saved to {output_path} (win rates in {WIN_RATES_PATH})")
+
+
+@instrumented("judge")
+async def judge_captions_async(client: AsyncOpenAI, input_path: str, output_path: str, model: str = MODEL_NAME,
+                               cache_path: str = RESPONSE_CACHE_PATH, concurrency: int = MAX_CONCURRENCY,
+                               rpm: int = REQUESTS_PER_MINUTE, tpm: int = TOKENS_PER_MINUTE):
+    """Realtime mode: both orders of every pair are judged concurrently through the response cache."""
+    with open(input_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    votes = defaultdict(dict)
+
+    def on_result(job, response, error):
+        image_id, order = job
+        if error is not None:
+            print(f"[ERROR] OpenAI judging failed on {data[image_id]['image_path']} ({order}): {error}")
+            votes[image_id][order] = None
+            return
+        vote = parse_vote(response_content(response), order)
+        if vote is None:
+            # Raising keeps the response out of the cache, so the next run asks again
+            raise ValueError(f"unparseable vote {response_content(response)!r}")
+        votes[image_id][order] = vote
+
+    cache = ResponseCache(cache_path)
+    try:
+        await run_requests(client, iter_judge_jobs(data, model), on_result, concurrency=concurrency,
+                           rpm=rpm, tpm=tpm, cache=cache)
+    finally:
+        cache.close()
+    print_payload_report()
+    judged = build_judged(data, votes)
+    save_judged(judged, output_path)
+    return judged
+
+
+def judge_captions(client: AsyncOpenAI, input_path: str, output_path: str, model: str = MODEL_NAME, **kwargs):
+    """Synchronous entry point for judge_captions_async."""
+    return asyncio.run(judge_captions_async(client, input_path, output_path, model, **kwargs))
+
+
+def prepare_judge_batch(input_path: str, output_dir: str = JUDGE_BATCH_DIR, model: str = MODEL_NAME):
+    """Batch mode, step 1: write both orders of every pair as Batch API JSONL shards."""
+    with open(input_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    def requests():
+        for (image_id, order), build in iter_judge_jobs(data, model):
+            try:
+                body = build()
+            except Exception as e:
+                print(f"[ERROR] Failed to read: {data[image_id]['image_path']}. Reason: {e}")
+                continue
+            custom_id = f"{image_id}:{order}"
+            yield custom_id, data[image_id]["image_path"], {
+                "custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body,
+            }
+
+    shards = write_sharded_jsonl(requests(), output_dir)
+    print_payload_report()
+    return shards
+
+
+def ingest_judge_results(input_path: str, output_path: str, results_dir: str = JUDGE_RESULTS_DIR,
+                         batch_dir: str = JUDGE_BATCH_DIR):
+    """
+    Batch mode, step 3 (after `python gpt_batch_run.py judge_batch_inputs/shards.json judge_batch_results`):
+    fold the downloaded verdicts back into the judged output.
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    votes = defaultdict(dict)
+    for _, result in iter_results(results_dir, manifest_path=f"{batch_dir}/shards.json"):
+        image_id, order = result["custom_id"].rsplit(":", 1)
+        response = result.get("response") or {}
+        vote = None
+        if response.get("status_code") == 200:
+            vote = parse_vote(response_content(response.get("body")), order)
+        votes[image_id][order] = vote
+    judged = build_judged(data, votes)
+    save_judged(judged, output_path)
+    return judged
+
+
+def win_rates(judged: dict) -> dict:
+    """with_keyword win rate (ties count half) per cluster and cluster/subcluster, in one bincount pass."""
+    clusters, subclusters, scores = [], [], []
+    for entry in judged.values():
+        if entry["winner"] not in WINNER_SCORES:
+            continue
+        parts = Path(entry["image_path"]).parts
+        cluster, subcluster = (parts[-4], parts[-3]) if len(parts) >= 4 else ("?", "?")
+        clusters.append(cluster)
+        subclusters.append(f"{cluster}/{subcluster}")
+        scores.append(WINNER_SCORES[entry["winner"]])
+    scores = np.asarray(scores, dtype=np.float64)
+    ties = (scores == 0.5).astype(np.float64)
+
+    rates = {"overall": {
+        "n": int(scores.size),
+        "with_keyword_win_rate": float(scores.mean()) if scores.size else None,
+        "tie_rate": float(ties.mean()) if scores.size else None,
+    }}
+    for level, labels in (("cluster", clusters), ("subcluster", subclusters)):
+        names, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+        n = np.bincount(inverse, minlength=names.size)
+        wins = np.bincount(inverse, weights=scores, minlength=names.size) / np.maximum(n, 1)
+        tie_rate = np.bincount(inverse, weights=ties, minlength=names.size) / np.maximum(n, 1)
+        rates[level] = {
+            str(name): {"n": int(k), "with_keyword_win_rate": float(w), "tie_rate": float(t)}
+            for name, k, w, t in zip(names, n, wins, tie_rate)
+        }
+    return rates
+
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(updated_data, f, ensure_ascii=False, indent=2)
+def print_win_rates(rates: dict):
+    overall = rates["overall"]
+    if not overall["n"]:
+        print("[RESULT] No valid verdicts.")
+        return
+    print(f"\n[RESULT] with_keyword win rate {overall['with_keyword_win_rate']:.1%} "
+          f"over {overall['n']} pairs (ties {overall['tie_rate']:.1%})")
+    for cluster, r in sorted(rates["cluster"].items()):
+        print(f"  {cluster:<40} n={r['n']:>5}  win={r['with_keyword_win_rate']:.1%}  ties={r['tie_rate']:.1%}")
 
-    print(f"\n[FINISH] Judging complete. Saved to {output_path}")
 
 if __name__ == "__main__":
-    load_dotenv()
-    client = OpenAI()
-    judge_captions(client, JUDGING_DATA_PATH, OUTPUT_PATH)
+    # realtime (default) | batch-prepare | batch-ingest
+    mode = sys.argv[1] if len(sys.argv) > 1 else "realtime"
+    if mode == "batch-prepare":
+        prepare_judge_batch(JUDGING_DATA_PATH)
+    elif mode == "batch-ingest":
+        ingest_judge_results(JUDGING_DATA_PATH, OUTPUT_PATH)
+    else:
+        load_dotenv()
+        judge_captions(AsyncOpenAI(max_retries=0), JUDGING_DATA_PATH, OUTPUT_PATH)
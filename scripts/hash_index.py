@@ -0,0 +1,131 @@
+from itertools import combinations
+import numpy as np
+
+MAX_PAIRS_PER_BLOCK = 20_000_000
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hex_to_codes(hashes):
+    """Hex perceptual hashes (as produced by imagededup) → uint64 array."""
+    return np.array([int(h, 16) for h in hashes], dtype=np.uint64)
+
+
+def popcount64(x):
+    """Number of set bits of each uint64 element."""
+    x = np.ascontiguousarray(np.atleast_1d(x), dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.uint8)
+    return _POPCOUNT_TABLE[x.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.uint8)
+
+
+def _flip_masks(bits, radius):
+    """All bit masks over `bits` bits with at most `radius` bits set."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for combo in combinations(range(bits), r):
+            masks.append(sum(1 << b for b in combo))
+    return np.array(masks, dtype=np.int64)
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over packed 64-bit hashes.
+
+    Each hash is split into n_chunks substrings with one bucket table per chunk.
+    If two hashes are within Hamming distance r, at least one chunk differs by at
+    most r // n_chunks bits, so probing every chunk with those flip masks finds
+    all pairs without comparing all of them. Candidates are verified with a
+    vectorized popcount on the full 64-bit XOR.
+    """
+
+    def __init__(self, codes, n_chunks=4):
+        if n_chunks not in (4, 8):
+            raise ValueError(f"n_chunks must be 4 or 8, got {n_chunks}")
+        self.codes = np.asarray(codes, dtype=np.uint64)
+        self.n_chunks = n_chunks
+        self.chunk_bits = 64 // n_chunks
+        table_size = 1 << self.chunk_bits
+        self.chunks = []
+        for c in range(n_chunks):
+            values = self._chunk(self.codes, c)
+            order = np.argsort(values, kind='stable')
+            counts = np.bincount(values, minlength=table_size)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            self.chunks.append((values, order, counts, starts))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _chunk(self, codes, c):
+        shift = np.uint64(c * self.chunk_bits)
+        mask = np.uint64((1 << self.chunk_bits) - 1)
+        return ((codes >> shift) & mask).astype(np.int64)
+
+    def _candidates(self, c, mask, rows):
+        values, order, counts, starts = self.chunks[c]
+        keys = values[rows] ^ mask
+        n = counts[keys]
+        total = int(n.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        i = np.repeat(rows, n)
+        offsets = np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+        j = order[np.repeat(starts[keys], n) + offsets]
+        return i, j
+
+    def pairs(self, radius):
+        """
+        Yield blocks (i, j, distance) of all index pairs i < j whose Hamming
+        distance is <= radius. Every pair is reported exactly once.
+        """
+        sub = radius // self.n_chunks
+        masks = _flip_masks(self.chunk_bits, sub)
+        n = len(self.codes)
+        for c in range(self.n_chunks):
+            values, _, counts, _ = self.chunks[c]
+            for mask in masks:
+                cum = np.cumsum(counts[values ^ mask])
+                start = 0
+                while start < n:
+                    base = cum[start - 1] if start else 0
+                    end = max(int(np.searchsorted(cum, base + MAX_PAIRS_PER_BLOCK, side='right')), start + 1)
+                    i, j = self._candidates(c, mask, np.arange(start, end))
+                    start = end
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                    xor = self.codes[i] ^ self.codes[j]
+                    dist = popcount64(xor)
+                    keep = dist <= radius
+                    # A pair is owned by the first chunk within `sub` bits
+                    for k in range(c):
+                        keep &= popcount64(self._chunk(xor, k).astype(np.uint64)) > sub
+                    if keep.any():
+                        yield i[keep], j[keep], dist[keep]
+
+    def query(self, code, radius):
+        """Indices of all hashes within `radius` of a single code."""
+        return np.flatnonzero(popcount64(self.codes ^ np.uint64(code)) <= radius)
+
+
+def duplicate_groups(n, pairs):
+    """Connected components (size > 1) of the pair graph, as sorted lists of indices."""
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    touched = set()
+    for i_block, j_block, _ in pairs:
+        for i, j in zip(i_block.tolist(), j_block.tolist()):
+            touched.update((i, j))
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    groups = {}
+    for x in sorted(touched):
+        groups.setdefault(find(x), []).append(x)
+    return list(groups.values())
@@ -0,0 +1,101 @@
+import io
+import os
+import base64
+import hashlib
+import threading
+from functools import lru_cache
+from collections import Counter
+from PIL import Image
+
+# detail="low" requests are served from a 512x512 rendition; anything bigger is wasted upload
+LOW_DETAIL_MAX_SIDE = 512
+JPEG_QUALITY = 85
+PAYLOAD_CACHE_DIR = "payload_cache"
+LRU_SIZE = 4096
+
+payload_stats = Counter()
+# One lock per file version being encoded, so concurrent callers encode it once
+_encoding = {}
+_encoding_guard = threading.Lock()
+
+
+def compact_jpeg(data, max_side=LOW_DETAIL_MAX_SIDE, quality=JPEG_QUALITY):
+    """
+    Downscale image bytes so the longest side is at most max_side and re-encode
+    as JPEG. The original bytes are kept when they are already a small enough
+    JPEG that is not larger than the re-encoded version.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        original_format = img.format
+        if original_format == "JPEG":
+            img.draft("RGB", (max_side, max_side))  # DCT scaling, decodes a fraction of the pixels
+        img = img.convert("RGB")
+        fits = max(img.size) <= max_side
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+    encoded = out.getvalue()
+    if original_format == "JPEG" and fits and len(data) <= len(encoded):
+        return data
+    return encoded
+
+
+def _disk_cache_path(digest, cache_dir):
+    return os.path.join(cache_dir, digest[:2], f"{digest}_{LOW_DETAIL_MAX_SIDE}_q{JPEG_QUALITY}.jpg")
+
+
+@lru_cache(maxsize=LRU_SIZE)
+def _encode_cached(path, size, mtime_ns, cache_dir):
+    """base64 payload for one file version; (size, mtime_ns) make edited files miss the LRU."""
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    cache_path = _disk_cache_path(digest, cache_dir) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            payload = f.read()
+        payload_stats["disk_hits"] += 1
+    else:
+        payload = compact_jpeg(data)
+        payload_stats["encoded"] += 1
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, cache_path)
+    return base64.b64encode(payload).decode("ascii")
+
+
+def encode_image(path, cache_dir=PAYLOAD_CACHE_DIR):
+    """Compact base64 JPEG of the image at path, memoized in memory and on disk."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns, cache_dir)
+    with _encoding_guard:
+        lock = _encoding.setdefault(key, threading.Lock())
+    with lock:
+        encoded = _encode_cached(*key)
+    with _encoding_guard:
+        _encoding.pop(key, None)
+    # Per request, compared with sending the whole original file every time
+    payload_stats["requests"] += 1
+    payload_stats["original_bytes"] += st.st_size
+    payload_stats["payload_bytes"] += len(encoded) * 3 // 4
+    return encoded
+
+
+def image_data_url(path, cache_dir=PAYLOAD_CACHE_DIR):
+    return f"data:image/jpeg;base64,{encode_image(path, cache_dir)}"
+
+
+def print_payload_report():
+    """Payload bytes sent this run vs. base64-ing the original file for every request."""
+    original = payload_stats["original_bytes"]
+    payload = payload_stats["payload_bytes"]
+    info = _encode_cached.cache_info()
+    print(f"[PAYLOAD] {payload_stats['requests']} requests, {info.currsize} images "
+          f"({payload_stats['encoded']} encoded, "
+          f"{payload_stats['disk_hits']} from disk cache, {info.hits} memory hits)")
+    if original:
+        print(f"[PAYLOAD] {original / 2**20:.1f} MB originals → {payload / 2**20:.1f} MB sent "
+              f"({(original - payload) / 2**20:.1f} MB saved, {100 * (1 - payload / original):.0f}%)")
@@ -0,0 +1,151 @@
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from tqdm import tqdm
+from manifest import MANIFEST_PATH, connect
+from metrics import instrumented, current_stage
+
+PROBE_CHUNKSIZE = 256
+WRITE_EVERY = 10_000
+
+# JPEG start-of-frame markers (everything in C0..CF except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers that carry no length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):  # EOI / SOS before any frame header
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def _png_size(head):
+    if head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and head[20] == 0x2F:
+        bits = struct.unpack('<I', head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def probe_header(path):
+    """
+    Read (width, height) from the JPEG SOF / PNG IHDR / WebP VP8* header only.
+    Returns None if the format is not recognized or the header is malformed.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        if head[:3] == b'\xff\xd8\xff':
+            return _jpeg_size(f)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return _png_size(head)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+            return _webp_size(head)
+    return None
+
+
+def probe_size(path):
+    """(width, height) from the header, falling back to PIL. None if unreadable."""
+    try:
+        size = probe_header(path)
+        if size and size[0] > 0 and size[1] > 0:
+            return size
+    except (OSError, struct.error, IndexError):
+        pass
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def _probe_row(row):
+    path, mtime_ns = row
+    return path, mtime_ns, probe_size(path)
+
+
+@instrumented("probe")
+def probe_manifest(base_dirs=None, db_path=MANIFEST_PATH, max_workers=None, chunksize=PROBE_CHUNKSIZE):
+    """
+    Fill width/height for every manifest image that has not been probed yet.
+    The manifest clears dimensions when a file's size/mtime changes, so this
+    acts as a path+mtime cache: unchanged images are never opened again.
+    Unreadable images are stored as 0x0 so they are not retried until modified.
+    """
+    conn = connect(db_path)
+    query = "SELECT path, mtime_ns FROM images WHERE width IS NULL"
+    params = []
+    if base_dirs:
+        roots = [os.path.abspath(b) for b in base_dirs]
+        query += f" AND root IN ({','.join('?' * len(roots))})"
+        params = roots
+    pending = conn.execute(query, params).fetchall()
+    if not pending:
+        conn.close()
+        return {'probed': 0, 'failed': 0}
+
+    probed, failed, updates = 0, 0, []
+
+    def flush():
+        with conn:
+            conn.executemany(
+                "UPDATE images SET width = ?, height = ? WHERE path = ? AND mtime_ns = ?", updates
+            )
+        updates.clear()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(_probe_row, pending, chunksize=chunksize)
+        for path, mtime_ns, size in tqdm(results, total=len(pending), desc="Probing sizes"):
+            if size is None:
+                print(f"Warning: could not read {path}")
+                failed += 1
+                size = (0, 0)
+            probed += 1
+            updates.append((size[0], size[1], path, mtime_ns))
+            if len(updates) >= WRITE_EVERY:
+                flush()
+    flush()
+    conn.close()
+    current_stage().items(probed)
+    current_stage().count('unreadable', failed)
+    print(f"[PROBE] {probed} images probed, {failed} unreadable")
+    return {'probed': probed, 'failed': failed}
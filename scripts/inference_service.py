@@ -0,0 +1,346 @@
+import io
+import os
+import json
+import time
+import queue
+import base64
+import socket
+import argparse
+import threading
+import http.client
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import numpy as np
+from PIL import Image
+
+HOST = "127.0.0.1"
+PORT = 8766
+MAX_BATCH = 64
+MAX_WAIT_MS = 10  # how long the first image of a batch waits for company
+DECODE_WORKERS = 8
+
+
+class MicroBatcher:
+    """
+    Collects preprocessed images submitted by any number of request threads and
+    runs them through `encode` on a single model thread. A batch starts as soon
+    as max_batch images are waiting or max_wait_ms after its first image arrived.
+    encode(list of pixel tensors) → (float16 features [n, dim], scores [n]).
+    A batch that fails is retried image by image, so one bad input only fails
+    its own request. If the model thread dies anyway, `error` says why and all
+    pending and later submissions fail instead of hanging.
+    """
+
+    def __init__(self, encode, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats = Counter()
+        self.error = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def alive(self):
+        return self.error is None and self.thread.is_alive()
+
+    def submit(self, pixels):
+        future = Future()
+        if not self.alive:
+            future.set_exception(RuntimeError(f"Model thread is dead: {self.error!r}"))
+            return future
+        self.queue.put((pixels, future))
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            try:
+                items.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self, items):
+        started = time.perf_counter()
+        try:
+            features, scores = self.encode([pixels for pixels, _ in items])
+        except BaseException as e:
+            if len(items) > 1:
+                self.stats['retried_batches'] += 1
+                for item in items:
+                    self._run([item])
+                return
+            self.stats['failed_images'] += 1
+            _resolve(items[0][1], error=e)
+            return
+        self.stats['batches'] += 1
+        self.stats['images'] += len(items)
+        self.stats['model_ms'] += (time.perf_counter() - started) * 1000
+        for i, (_, future) in enumerate(items):
+            _resolve(future, result=(float(scores[i]), features[i]))
+
+    def _loop(self):
+        items = []
+        try:
+            while True:
+                items = self._collect()
+                self._run(items)
+                items = []
+        except BaseException as e:
+            self.error = e
+            dead = RuntimeError(f"Model thread is dead: {e!r}")
+            for _, future in items:
+                _resolve(future, error=dead)
+            while True:
+                try:
+                    _, future = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                _resolve(future, error=dead)
+
+
+def _resolve(future, result=None, error=None):
+    """Complete a future unless it already was (e.g. cancelled by its caller)."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class InferenceService:
+    """Decodes images on a thread pool and scores them through a shared MicroBatcher."""
+
+    def __init__(self, encode, preprocess, model_name, device, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS,
+                 decode_workers=DECODE_WORKERS):
+        self.preprocess = preprocess
+        self.model_name = model_name
+        self.device = device
+        self.batcher = MicroBatcher(encode, max_batch, max_wait_ms)
+        self.decoder = ThreadPoolExecutor(max_workers=decode_workers)
+
+    def _decode(self, source):
+        if isinstance(source, bytes):
+            image = Image.open(io.BytesIO(source))
+        else:
+            image = Image.open(source)
+        return self.preprocess(image.convert("RGB"))
+
+    def score(self, sources):
+        """[(score, float16 embedding) or exception] for image paths or raw bytes, in order."""
+        decoded = [self.decoder.submit(self._decode, source) for source in sources]
+        pending = []
+        for future in decoded:
+            try:
+                pending.append(self.batcher.submit(future.result()))
+            except Exception as e:
+                pending.append(e)
+        results = []
+        for item in pending:
+            try:
+                results.append(item if isinstance(item, Exception) else item.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def health(self):
+        stats = self.batcher.stats
+        return {
+            'status': 'ok' if self.batcher.alive else 'dead',
+            'error': repr(self.batcher.error) if self.batcher.error else None,
+            'model': self.model_name,
+            'device': str(self.device),
+            'max_batch': self.batcher.max_batch,
+            'batches': stats['batches'],
+            'images': stats['images'],
+            'mean_batch': round(stats['images'] / stats['batches'], 2) if stats['batches'] else 0,
+            'model_ms': round(stats['model_ms'], 1),
+            'retried_batches': stats['retried_batches'],
+            'failed_images': stats['failed_images'],
+        }
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """POST /v1/score {"paths": [...]} or {"images": [base64, ...]}, "embeddings": bool; GET /v1/health."""
+
+    service = None  # set on the bound subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/health":
+            health = self.service.health()
+            return self.send_json(200 if health['status'] == 'ok' else 503, health)
+        self.send_json(404, {'error': f"Unknown route: GET {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/score":
+            return self.send_json(404, {'error': f"Unknown route: POST {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sources = request.get('paths') or [base64.b64decode(b) for b in request.get('images', [])]
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {'error': f"Bad request: {e}"})
+
+        results = self.service.score(sources)
+        response = {
+            'model': self.service.model_name,
+            'scores': [None if isinstance(r, Exception) else r[0] for r in results],
+            'errors': {str(i): str(r) for i, r in enumerate(results) if isinstance(r, Exception)},
+        }
+        if request.get('embeddings'):
+            response['embeddings'] = [
+                None if isinstance(r, Exception) else base64.b64encode(np.asarray(r[1], np.float16).tobytes()).decode()
+                for r in results
+            ]
+        self.send_json(200, response)
+
+
+class InferenceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class UnixInferenceServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_server(service, host=HOST, port=PORT, socket_path=None):
+    """HTTP server for service on host:port, or on a Unix socket if socket_path is given."""
+    handler = type("BoundInferenceHandler", (InferenceHandler,), {"service": service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixInferenceServer(socket_path, handler)
+    return InferenceHTTPServer((host, port), handler)
+
+
+def torch_service(clip_model="vit_l_14", max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS,
+                  decode_workers=DECODE_WORKERS, backend=None):
+    """
+    InferenceService around aesthetic_scorer's CLIP backbone and aesthetic head
+    (loaded once, here). backend selects a cpu_backends.py variant on CPU nodes.
+    """
+    import torch
+    from aesthetic_scorer import load_models, encode_batch
+
+    if backend and backend != "fp32":
+        from cpu_backends import load_cpu_models
+        models = load_cpu_models(backend, clip_model)
+    else:
+        models = load_models(clip_model)
+
+    def encode(pixels):
+        features, scores = encode_batch(models, torch.stack(pixels))
+        return features.half().cpu().numpy(), scores.float().cpu().numpy()
+
+    return InferenceService(encode, models.preprocess, clip_model, models.device, max_batch, max_wait_ms,
+                            decode_workers)
+
+
+# ----------------------- Client -----------------------
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """
+    Client of a running inference_service.py. Scores come back as a float array
+    (NaN for images that failed), embeddings as a float16 [n, dim] array
+    (zero rows for failures) and errors as {index: message}.
+    """
+
+    def __init__(self, host=HOST, port=PORT, socket_path=None, timeout=600):
+        self.host, self.port, self.socket_path, self.timeout = host, port, socket_path, timeout
+
+    def _request(self, method, path, payload=None):
+        if self.socket_path:
+            conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"Inference service error {response.status}: {data.get('error')}")
+        return data
+
+    def _score(self, payload, embeddings):
+        data = self._request("POST", "/v1/score", dict(payload, embeddings=embeddings))
+        scores = np.array([np.nan if s is None else s for s in data['scores']], dtype=np.float64)
+        result = {'scores': scores, 'errors': {int(i): msg for i, msg in data['errors'].items()}}
+        if embeddings:
+            rows = [np.frombuffer(base64.b64decode(e), dtype=np.float16) if e else None for e in data['embeddings']]
+            dim = next((r.size for r in rows if r is not None), 0)
+            result['embeddings'] = np.stack([r if r is not None else np.zeros(dim, np.float16) for r in rows]) \
+                if rows else np.zeros((0, dim), np.float16)
+        return result
+
+    def score_paths(self, paths, embeddings=False):
+        """Score image files readable by the service process."""
+        return self._score({'paths': list(paths)}, embeddings)
+
+    def score_bytes(self, images, embeddings=False):
+        """Score encoded images (JPEG/PNG/WebP bytes)."""
+        return self._score({'images': [base64.b64encode(b).decode() for b in images]}, embeddings)
+
+    def health(self):
+        return self._request("GET", "/v1/health")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived CLIP aesthetic scoring and embedding service")
+    parser.add_argument("--clip-model", default="vit_l_14", choices=["vit_l_14", "vit_b_32"])
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--socket", help="serve on this Unix socket instead of host:port")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--backend", default="fp32", help="CPU backend from cpu_backends.py (int8, onnx, ...)")
+    args = parser.parse_args()
+
+    service = torch_service(args.clip_model, args.max_batch, args.max_wait_ms, args.decode_workers, args.backend)
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{server.server_port}"
+    print(f"🧠 {args.clip_model} aesthetic service on {where} ({service.device}, batches of up to {args.max_batch})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
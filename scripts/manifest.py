@@ -0,0 +1,289 @@
+import os
+import json
+import sqlite3
+from collections import namedtuple
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import instrumented, current_stage
+
+MANIFEST_PATH = "dataset_manifest.sqlite"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+SCAN_WORKERS = 8
+# Seconds a writer waits for another process's or stage's write transaction instead of failing with "database is locked"
+BUSY_TIMEOUT = 300
+
+TopicEntry = namedtuple("TopicEntry", ["root", "dataset", "cluster", "subcluster", "topic", "path"])
+ImageEntry = namedtuple("ImageEntry", [
+    "root", "dataset", "cluster", "subcluster", "topic", "filename", "path",
+    "size", "mtime_ns", "format", "width", "height",
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS topics (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    subcluster TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    topic_path TEXT NOT NULL,
+    root TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    subcluster TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    dhash TEXT
+);
+CREATE INDEX IF NOT EXISTS images_topic ON images (topic_path);
+CREATE INDEX IF NOT EXISTS images_order ON images (root, cluster, subcluster, topic, filename);
+"""
+
+
+def connect(db_path=MANIFEST_PATH):
+    """
+    Open the manifest database, creating the schema if needed. Several stages
+    may write at once (e.g. scans of different datasets): WAL lets readers run
+    alongside a writer, and writers wait up to BUSY_TIMEOUT for each other.
+    Writes are kept to short per-cluster / per-batch transactions.
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+    if 'dhash' not in columns:  # manifests created before hashes were cached
+        conn.execute("ALTER TABLE images ADD COLUMN dhash TEXT")
+    return conn
+
+
+def is_image(fname):
+    return fname.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _subdirs(path):
+    with os.scandir(path) as it:
+        return [(e.name, e.path) for e in it if e.is_dir()]
+
+
+def _scan_cluster(root, cluster, cluster_path, known_topic_mtimes, full):
+    """
+    Walk one cluster with os.scandir. Topics whose directory mtime matches the
+    manifest are reported without a file listing so the caller keeps their rows.
+    """
+    dataset = os.path.basename(root)
+    results = []
+    for subcluster, subcluster_path in _subdirs(cluster_path):
+        for topic, topic_path in _subdirs(subcluster_path):
+            topic_mtime = os.stat(topic_path).st_mtime_ns
+            topic_row = (topic_path, root, dataset, cluster, subcluster, topic, topic_mtime)
+            if not full and known_topic_mtimes.get(topic_path) == topic_mtime:
+                results.append((topic_row, None))
+                continue
+            files = []
+            with os.scandir(topic_path) as it:
+                for entry in it:
+                    if not is_image(entry.name) or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    files.append((entry.name, entry.path, st.st_size, st.st_mtime_ns))
+            results.append((topic_row, files))
+    return results
+
+
+def _apply_topic(conn, topic_row, files):
+    """Diff a freshly listed topic against stored rows. Returns (added_or_changed, removed)."""
+    topic_path, root, dataset, cluster, subcluster, topic, _ = topic_row
+    stored = {
+        path: (size, mtime_ns)
+        for path, size, mtime_ns in conn.execute(
+            "SELECT path, size, mtime_ns FROM images WHERE topic_path = ?", (topic_path,)
+        )
+    }
+    upserts = []
+    for fname, path, size, mtime_ns in files:
+        if stored.pop(path, None) == (size, mtime_ns):
+            continue
+        fmt = fname.rsplit('.', 1)[-1].lower()
+        # A changed file invalidates its probed dimensions and hash.
+        upserts.append((path, topic_path, root, dataset, cluster, subcluster, topic,
+                        fname, size, mtime_ns, fmt))
+    conn.executemany(
+        "INSERT OR REPLACE INTO images (path, topic_path, root, dataset, cluster, subcluster, topic, "
+        "filename, size, mtime_ns, format) VALUES (?,?,?,?,?,?,?,?,?,?,?)", upserts
+    )
+    conn.executemany("DELETE FROM images WHERE path = ?", [(p,) for p in stored])
+    return len(upserts), len(stored)
+
+
+@instrumented("scan")
+def refresh_manifest(base_dirs, db_path=MANIFEST_PATH, full=False, max_workers=SCAN_WORKERS):
+    """
+    Scan base_dirs (DataSet_N/cluster/subcluster/topic) into the manifest.
+    Clusters are walked in parallel; only topics whose directory mtime changed
+    are re-listed, and only files whose size/mtime changed are rewritten.
+    Pass full=True to re-list every topic (e.g. after in-place file edits).
+    """
+    conn = connect(db_path)
+    stats = {'topics': 0, 'rescanned_topics': 0, 'changed_images': 0, 'removed_images': 0}
+
+    for base_dir in base_dirs:
+        root = os.path.abspath(base_dir)
+        known = dict(conn.execute("SELECT path, mtime_ns FROM topics WHERE root = ?", (root,)))
+        seen_topics = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_scan_cluster, root, cluster, cluster_path, known, full)
+                for cluster, cluster_path in sorted(_subdirs(root))
+            ]
+            for future in futures:
+                with conn:
+                    for topic_row, files in future.result():
+                        seen_topics.add(topic_row[0])
+                        stats['topics'] += 1
+                        if files is None:
+                            continue
+                        stats['rescanned_topics'] += 1
+                        changed, removed = _apply_topic(conn, topic_row, files)
+                        stats['changed_images'] += changed
+                        stats['removed_images'] += removed
+                        conn.execute("INSERT OR REPLACE INTO topics VALUES (?,?,?,?,?,?,?)", topic_row)
+
+        gone = [(p,) for p in known if p not in seen_topics]
+        with conn:
+            for (topic_path,) in gone:
+                stats['removed_images'] += conn.execute(
+                    "DELETE FROM images WHERE topic_path = ?", (topic_path,)
+                ).rowcount
+            conn.executemany("DELETE FROM topics WHERE path = ?", gone)
+
+    conn.close()
+    for key, value in stats.items():
+        current_stage().count(key, value)
+    print(f"[MANIFEST] {stats['topics']} topics ({stats['rescanned_topics']} rescanned), "
+          f"{stats['changed_images']} new/changed, {stats['removed_images']} removed images")
+    return stats
+
+
+def root_filter(base_dirs):
+    if not base_dirs:
+        return "", []
+    roots = [os.path.abspath(b) for b in base_dirs]
+    return f" WHERE root IN ({','.join('?' * len(roots))})", roots
+
+
+def iter_topics(base_dirs=None, db_path=MANIFEST_PATH):
+    """Yield TopicEntry rows (optionally restricted to base_dirs) in a stable order."""
+    where, params = root_filter(base_dirs)
+    conn = connect(db_path)
+    try:
+        query = ("SELECT root, dataset, cluster, subcluster, topic, path FROM topics"
+                 f"{where} ORDER BY root, cluster, subcluster, topic")
+        for row in conn.execute(query, params):
+            yield TopicEntry(*row)
+    finally:
+        conn.close()
+
+
+def iter_images(base_dirs=None, topic_path=None, db_path=MANIFEST_PATH):
+    """Yield ImageEntry rows for base_dirs, or for a single topic_path."""
+    if topic_path is not None:
+        where, params = " WHERE topic_path = ?", [topic_path]
+    else:
+        where, params = root_filter(base_dirs)
+    conn = connect(db_path)
+    try:
+        query = ("SELECT root, dataset, cluster, subcluster, topic, filename, path, "
+                 "size, mtime_ns, format, width, height FROM images"
+                 f"{where} ORDER BY root, cluster, subcluster, topic, filename")
+        for row in conn.execute(query, params):
+            yield ImageEntry(*row)
+    finally:
+        conn.close()
+
+
+def load_image_columns(base_dirs=None, db_path=MANIFEST_PATH):
+    """
+    Images of base_dirs as columns in manifest order: paths, topic_paths and
+    filenames as object arrays; size, width and height as int64 (0 = not probed).
+    """
+    where, params = root_filter(base_dirs)
+    conn = connect(db_path)
+    rows = conn.execute("SELECT path, topic_path, filename, size, COALESCE(width, 0), COALESCE(height, 0) "
+                        f"FROM images{where} ORDER BY root, cluster, subcluster, topic, filename", params).fetchall()
+    conn.close()
+    paths, topic_paths, filenames, sizes, widths, heights = zip(*rows) if rows else ((),) * 6
+    return {
+        'path': np.array(paths, dtype=object),
+        'topic_path': np.array(topic_paths, dtype=object),
+        'filename': np.array(filenames, dtype=object),
+        'size': np.array(sizes, dtype=np.int64),
+        'width': np.array(widths, dtype=np.int64),
+        'height': np.array(heights, dtype=np.int64),
+    }
+
+
+def store_hashes(rows, db_path=MANIFEST_PATH):
+    """Cache perceptual hashes: rows of (path, hex_hash)."""
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("UPDATE images SET dhash = ? WHERE path = ?", [(h, p) for p, h in rows])
+    conn.close()
+
+
+def load_hashes(base_dirs=None, db_path=MANIFEST_PATH):
+    """(paths, hex_hashes) of all manifest images that have a cached hash."""
+    where, params = root_filter(base_dirs)
+    where = f"{where} AND dhash IS NOT NULL" if where else " WHERE dhash IS NOT NULL"
+    conn = connect(db_path)
+    rows = conn.execute(f"SELECT path, dhash FROM images{where} ORDER BY path", params).fetchall()
+    conn.close()
+    return [p for p, _ in rows], [h for _, h in rows]
+
+
+def unhashed_images(base_dirs=None, db_path=MANIFEST_PATH):
+    """[(topic_path, [filenames])] of manifest images without a cached hash."""
+    where, params = root_filter(base_dirs)
+    where = f"{where} AND dhash IS NULL" if where else " WHERE dhash IS NULL"
+    conn = connect(db_path)
+    rows = conn.execute(f"SELECT topic_path, filename FROM images{where} ORDER BY topic_path, filename",
+                        params).fetchall()
+    conn.close()
+    return [(topic_path, [f for _, f in group]) for topic_path, group in groupby(rows, key=lambda r: r[0])]
+
+
+def load_topic_duplicates(subcluster_path, topic):
+    """Set of file names listed as duplicates in duplicates_<topic>.json."""
+    dup_json_path = os.path.join(subcluster_path, f'duplicates_{topic}.json')
+    duplicates = set()
+    if os.path.exists(dup_json_path):
+        with open(dup_json_path, "r") as f:
+            for k, v in json.load(f).items():
+                duplicates.update(v)
+    return duplicates
+
+
+def topic_images(topic_path, db_path=MANIFEST_PATH):
+    """Sorted image filenames of one topic."""
+    return [img.filename for img in iter_images(topic_path=topic_path, db_path=db_path)]
+
+
+if __name__ == "__main__":
+    base_dirs = [
+        '/home/user/kz-mm/data/DataSet_1',
+        '/home/user/kz-mm/data/DataSet_2',
+        '/home/user/kz-mm/data/DataSet_3',
+        '/home/user/kz-mm/data/DataSet_4'
+    ]
+    refresh_manifest(base_dirs)
@@ -1,7 +1,13 @@
 import os
+import errno
+import fcntl
 import shutil
 import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from manifest import refresh_manifest, iter_images, iter_topics, is_image, load_topic_duplicates
+from metrics import instrumented, current_stage
 
 base_dirs = [
     '/home/user/kz-mm/data/DataSet_1',
@@ -11,51 +17,145 @@ base_dirs = [
 ]
 
 output_dir = '/home/user/kz-mm/data/full_dataset'
-os.makedirs(output_dir, exist_ok=True)
-
-for base_dir in base_dirs:
-    for cluster in tqdm(os.listdir(base_dir), desc=f"Processing {base_dir}"):
-        cluster_path = os.path.join(base_dir, cluster)
-        if not os.path.isdir(cluster_path):
-            continue
-
-        for subcluster in os.listdir(cluster_path):
-            subcluster_path = os.path.join(cluster_path, subcluster)
-            if not os.path.isdir(subcluster_path):
-                continue
-
-            # Preload all duplicates in this subcluster once
-            duplicates_by_topic = {}
-
-            for fname in os.listdir(subcluster_path):
-                if fname.startswith("duplicates_") and fname.endswith(".json"):
-                    dup_json_path = os.path.join(subcluster_path, fname)
-                    with open(dup_json_path, "r") as f:
-                        dup_data = json.load(f)
-                        duplicates = set()
-                        for k, v in dup_data.items():
-                            duplicates.update(v)
-                        duplicates_by_topic[fname] = duplicates
-
-            for topic in os.listdir(subcluster_path):
-                topic_path = os.path.join(subcluster_path, topic)
-                if not os.path.isdir(topic_path):
-                    continue
 
-                # Resolve the duplicate file
-                dup_filename = f'duplicates_{topic}.json'
-                topic_duplicates = duplicates_by_topic.get(dup_filename, set())
+# "hardlink" | "reflink" | "copy" | "virtual"
+#   hardlink: os.link, falls back to copy across filesystems
+#   reflink:  FICLONE, then copy_file_range (server-side / CoW copy), then copy
+#   copy:     plain shutil.copy2
+#   virtual:  no files, only a logical → physical path map in VIRTUAL_MANIFEST
+MERGE_STRATEGY = "hardlink"
+MERGE_WORKERS = 16
+VIRTUAL_MANIFEST = 'full_dataset_manifest.json'
+
+FICLONE = 0x40049409  # linux/fs.h _IOW(0x94, 9, int)
+
+
+def _reflink(src_path, dst_path):
+    """Clone src into a new dst. Returns the method that worked or None."""
+    with open(src_path, 'rb') as src, open(dst_path, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+        try:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return 'copy_file_range'
+        except (OSError, AttributeError):
+            dst.truncate(0)
+            return None
+
+
+def merge_file(src_path, dst_path, strategy):
+    """
+    Place src_path at dst_path with the given strategy.
+    Returns (method actually used, bytes), or ('exists', 0) if dst is already there.
+    """
+    size = os.path.getsize(src_path)
+    if strategy == 'hardlink':
+        try:
+            os.link(src_path, dst_path)
+            return 'hardlink', size
+        except FileExistsError:
+            return 'exists', 0
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif strategy == 'reflink':
+        try:
+            method = _reflink(src_path, dst_path)
+        except FileExistsError:
+            return 'exists', 0
+        if method:
+            shutil.copystat(src_path, dst_path)
+            return method, size
+        os.remove(dst_path)
+    if os.path.exists(dst_path):
+        return 'exists', 0
+    shutil.copy2(src_path, dst_path)
+    return 'copy', size
+
 
-                # Destination path
-                dest_topic_path = os.path.join(output_dir, cluster, subcluster, topic)
+@instrumented("merge")
+def merge_datasets(base_dirs, output_dir, strategy=MERGE_STRATEGY, workers=MERGE_WORKERS):
+    """
+    Merge the topics of all base_dirs into output_dir/cluster/subcluster/topic,
+    skipping known duplicates. Files are placed by a thread pool; returns
+    per-method file and byte counters.
+    """
+    refresh_manifest(base_dirs)
+    files, nbytes = Counter(), Counter()
+    jobs = []
+    virtual_map = {}
+
+    for base_dir in base_dirs:
+        duplicates_cache = {}
+        for topic in iter_topics([base_dir]):
+            topic_duplicates = load_topic_duplicates(os.path.dirname(topic.path), topic.topic)
+            duplicates_cache[topic.path] = topic_duplicates
+            dest_topic_path = os.path.join(output_dir, topic.cluster, topic.subcluster, topic.topic)
+            if strategy != 'virtual':
                 os.makedirs(dest_topic_path, exist_ok=True)
+            # Non-image files (aesthetic_data.json, captions, ...) are merged like before the
+            # manifest; they are always copied so later edits never touch the source datasets
+            with os.scandir(topic.path) as it:
+                for entry in it:
+                    if entry.is_file() and not is_image(entry.name) and entry.name not in topic_duplicates:
+                        jobs.append((entry.path, os.path.join(dest_topic_path, entry.name), 'copy'))
+
+        for image in iter_images([base_dir]):
+            topic_path = os.path.dirname(image.path)
+            if image.filename in duplicates_cache[topic_path]:
+                files['skipped_duplicate'] += 1
+                continue  # Skip known duplicates
+            dst_path = os.path.join(output_dir, image.cluster, image.subcluster, image.topic, image.filename)
+            if strategy == 'virtual':
+                if dst_path in virtual_map:
+                    files['exists'] += 1
+                    continue
+                virtual_map[dst_path] = image.path
+                files['virtual'] += 1
+                nbytes['virtual'] += image.size
+            else:
+                jobs.append((image.path, dst_path, strategy))
+
+    if strategy == 'virtual':
+        for src_path, dst_path, _ in jobs:  # sidecars are still materialized
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        with open(VIRTUAL_MANIFEST, 'w', encoding='utf-8') as f:
+            json.dump(virtual_map, f, ensure_ascii=False, indent=2)
+
+    stage = current_stage()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda job: merge_file(*job), jobs)
+        for method, size in tqdm(results, total=len(jobs), desc=f"Merging ({strategy})"):
+            files[method] += 1
+            nbytes[method] += size
+
+    stage.items(sum(files.values()))
+    for method in files:
+        stage.count(f"files:{method}", files[method])
+    # Plain copies show up in wchar; copy_file_range bypasses it, links and reflinks write nothing
+    stage.add_bytes(written=nbytes['copy_file_range'])
+    return files, nbytes
+
 
-                for fname in os.listdir(topic_path):
-                    if fname in topic_duplicates:
-                        continue  # Skip known duplicates
+def print_merge_summary(files, nbytes):
+    print("\n📦 Merge Summary")
+    print("=" * 60)
+    for method in sorted(files):
+        print(f"  {method:<18} → {files[method]:>10,} files  {nbytes[method] / 2**30:>10.2f} GiB")
+    print("=" * 60)
 
-                    src_path = os.path.join(topic_path, fname)
-                    dst_path = os.path.join(dest_topic_path, fname)
 
-                    if os.path.isfile(src_path) and not os.path.exists(dst_path):
-                        shutil.copy2(src_path, dst_path)
\ No newline at end of file
+if __name__ == "__main__":
+    os.makedirs(output_dir, exist_ok=True)
+    files, nbytes = merge_datasets(base_dirs, output_dir)
+    print_merge_summary(files, nbytes)
+    if MERGE_STRATEGY == 'virtual':
+        print(f"✅ Logical → physical map saved to `{VIRTUAL_MANIFEST}`")
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import inspect
+import cProfile
+import resource
+import functools
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# JSON-lines file every stage and topic record is appended to ("" disables)
+METRICS_PATH = os.environ.get("KZ_METRICS", "metrics.jsonl")
+# Comma-separated stage names (or "all") to run under cProfile; dumps go to PROFILE_DIR/<stage>.prof
+PROFILE = os.environ.get("KZ_PROFILE", "")
+PROFILE_DIR = "profiles"
+
+_write_lock = threading.Lock()
+_current = contextvars.ContextVar("metrics_stage", default=None)
+# Stages running right now, across threads; used to detect stages that overlap
+_active = set()
+_active_lock = threading.Lock()
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in bytes (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def io_counters():
+    """
+    Bytes this process read/wrote: rchar/wchar count all read()/write() calls,
+    read_bytes/write_bytes what actually hit storage. {} where /proc is missing.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+
+def emit(record, path=None):
+    """Append one record to the metrics file."""
+    path = METRICS_PATH if path is None else path
+    if not path:
+        return
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _write_lock, open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+class Stage:
+    """Counters and named timers of one running stage; thread-safe."""
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent.name if parent else None
+        self.lineage = (parent.lineage | {parent}) if parent else frozenset()
+        # Set once a stage outside this one's lineage ran at the same time
+        self.concurrent = False
+        self.counters = Counter()
+        self.timers = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+
+    def items(self, n=1):
+        """Images (or requests, files, ...) processed; drives items_per_sec."""
+        self.count("items", n)
+
+    def add_bytes(self, read=0, written=0):
+        """Bytes moved outside this process's read()/write() calls (hardlinks, child processes, ...)."""
+        self.count("extra_bytes_read", read)
+        self.count("extra_bytes_written", written)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.timers[name] += elapsed
+
+    def topic(self, topic, **fields):
+        """Emit a per-topic record for this stage."""
+        emit({"type": "topic", "stage": self.name, "topic": topic, "time": time.time(), **fields})
+
+
+class _NullStage(Stage):
+    """Used outside any stage, so library calls can report unconditionally."""
+
+    def count(self, key, n=1):
+        pass
+
+    def timer(self, name):
+        return nullcontext()
+
+    def topic(self, topic, **fields):
+        pass
+
+
+NULL_STAGE = _NullStage("none")
+
+
+def _enter(current):
+    """Register a started stage and mark it and every unrelated running stage as concurrent."""
+    with _active_lock:
+        for other in _active:
+            if other not in current.lineage:
+                other.concurrent = current.concurrent = True
+        _active.add(current)
+
+
+def _leave(current):
+    with _active_lock:
+        _active.discard(current)
+
+
+def current_stage():
+    return _current.get() or NULL_STAGE
+
+
+def _profiled(name):
+    wanted = {p.strip() for p in PROFILE.split(",") if p.strip()}
+    return "all" in wanted or name in wanted
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Time a block as a stage and emit one record for it: wall and CPU seconds,
+    items and items/sec, bytes read/written, current and peak RSS, named timers
+    and counters. Stages nest (the record names its parent).
+
+    CPU seconds and /proc/self/io bytes are process-wide, so they are only
+    reported for a stage that ran alone (apart from its parents and children).
+    When another stage overlapped it, e.g. parallel pipeline stages, the record
+    has "concurrent": true, those fields are None, and the bytes the stage
+    reported through add_bytes stay in its counters.
+    """
+    parent = _current.get()
+    current = Stage(name, parent)
+    token = _current.set(current)
+    _enter(current)
+    io_before = io_counters()
+    started_at, started, cpu_started = time.time(), time.perf_counter(), time.process_time()
+    profiler = cProfile.Profile() if _profiled(name) else None
+    if profiler:
+        profiler.enable()
+    status = "ok"
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name.replace(os.sep, '_')}.prof"))
+        _current.reset(token)
+        _leave(current)
+        seconds = time.perf_counter() - started
+        cpu_seconds = time.process_time() - cpu_started
+        io_after = io_counters()
+        io = {key: io_after[key] - io_before.get(key, 0) for key in io_after}
+        counters = dict(current.counters)
+        items = counters.pop("items", 0)
+        if current.concurrent:
+            process_wide = dict.fromkeys(("cpu_seconds", "bytes_read", "bytes_written",
+                                          "disk_read_bytes", "disk_write_bytes"))
+        else:
+            process_wide = {
+                "cpu_seconds": round(cpu_seconds, 4),
+                "bytes_read": io.get("rchar", 0) + counters.pop("extra_bytes_read", 0),
+                "bytes_written": io.get("wchar", 0) + counters.pop("extra_bytes_written", 0),
+                "disk_read_bytes": io.get("read_bytes", 0),
+                "disk_write_bytes": io.get("write_bytes", 0),
+            }
+        record = {
+            "type": "stage",
+            "stage": name,
+            "parent": current.parent,
+            "status": status,
+            "started_at": started_at,
+            "seconds": round(seconds, 4),
+            "concurrent": current.concurrent,
+            **process_wide,
+            "items": items,
+            "items_per_sec": round(items / seconds, 2) if seconds > 0 else None,
+            "rss_mb": round(current_rss() / 2**20, 1),
+            "peak_rss_mb": round(peak_rss() / 2**20, 1),
+            "timers": {key: round(value, 4) for key, value in current.timers.items()},
+            "counters": counters,
+            **fields,
+        }
+        emit(record)
+        if current.parent is None:
+            rate = f", {items:,} items ({record['items_per_sec']:,}/s)" if items else ""
+            print(f"[METRICS] {name}: {seconds:.1f}s{rate}, peak RSS {record['peak_rss_mb']:,.0f} MB")
+
+
+def instrumented(name=None):
+    """Decorator running a function (sync or async) as a stage named name (default: function name)."""
+    def decorator(func):
+        stage_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(stage_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, timer_name, current=None):
+    """Yield from iterable, adding the time spent waiting for each item to a timer (e.g. decode vs model)."""
+    current = current or current_stage()
+    iterator = iter(iterable)
+    while True:
+        with current.timer(timer_name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
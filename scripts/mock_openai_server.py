@@ -0,0 +1,305 @@
+import io
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter, deque
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+MOCK_CAPTIONS = [
+    "Үстелдің үстінде ақ кесе тұр. Кесенің жанында қызыл алма жатыр. Артқы жақта сұр қабырға көрінеді. "
+    "Терезеден күн сәулесі түсіп тұр. Еденде қоңыр кілем төселген.",
+    "Көк аспан астында жасыл шөп өсіп тұр. Алдыңғы жақта үлкен тас жатыр. Тастың жанында кішкентай ит отыр. "
+    "Алыста биік таулар көрінеді. Күн ашық әрі жарық.",
+]
+
+
+class MockConfig:
+    """Latency, fault injection and rate limits of the mock server."""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, rate_429=0.0, rate_5xx=0.0, rpm=0, tpm=0,
+                 batch_seconds=2.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rpm = rpm  # 0 = unlimited
+        self.tpm = tpm
+        self.batch_seconds = batch_seconds
+
+
+class MockAPIError(Exception):
+    def __init__(self, status, message, error_type, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.retry_after = retry_after
+
+
+class MinuteWindow:
+    """Sliding one-minute window of (time, amount) used for the RPM / TPM limits."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.events = deque()
+        self.total = 0
+
+    def admit(self, amount, now):
+        """Record amount if it fits under the limit; otherwise return seconds until it would."""
+        while self.events and self.events[0][0] <= now - 60:
+            self.total -= self.events.popleft()[1]
+        if not self.limit or self.total + amount <= self.limit or not self.events:
+            self.events.append((now, amount))
+            self.total += amount
+            return 0.0
+        return self.events[0][0] + 60 - now
+
+
+class MockOpenAI:
+    """
+    In-memory state behind the mock server: completions, uploaded files and
+    batches that complete batch_seconds after creation.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.stats = Counter()
+        self.requests_window = MinuteWindow(config.rpm)
+        self.tokens_window = MinuteWindow(config.tpm)
+
+    def completion(self, body):
+        """A chat.completion for body: a verdict for judge prompts, a canned caption otherwise."""
+        text = " ".join(part.get("text", "") for message in body.get("messages", [])
+                        for part in (message["content"] if isinstance(message["content"], list)
+                                     else [{"text": message["content"]}]))
+        digest = hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).digest()
+        if "Reply ONLY with: 1 or 2" in text:
+            content = "1" if digest[0] % 2 else "2"
+        else:
+            content = MOCK_CAPTIONS[digest[0] % len(MOCK_CAPTIONS)]
+        prompt_tokens = len(text) // 3 + 85
+        completion_tokens = len(content) // 3
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def check_limits(self, body):
+        """Raise the 429 / 5xx a real endpoint would, per rate limits and the injection rates."""
+        tokens = len(json.dumps(body.get("messages", ""))) // 4 + body.get("max_tokens", 0)
+        with self.lock:
+            now = time.monotonic()
+            wait = self.requests_window.admit(1, now)
+            if not wait:
+                wait = self.tokens_window.admit(tokens, now)
+            if wait:
+                self.stats["rate_limited"] += 1
+                raise MockAPIError(429, "Rate limit reached (mock)", "requests", retry_after=round(wait, 3))
+        roll = random.random()
+        if roll < self.config.rate_429:
+            self.stats["injected_429"] += 1
+            raise MockAPIError(429, "Injected rate limit (mock)", "requests", retry_after=None)
+        if roll < self.config.rate_429 + self.config.rate_5xx:
+            self.stats["injected_5xx"] += 1
+            raise MockAPIError(random.choice([500, 502, 503]), "Injected server error (mock)", "server_error")
+
+    def chat_completion(self, body):
+        delay = random.gauss(self.config.latency_ms, self.config.jitter_ms) / 1000
+        time.sleep(max(0.0, delay))
+        self.check_limits(body)
+        self.stats["chat_completions"] += 1
+        return self.completion(body)
+
+    def create_file(self, filename, purpose, data):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file_id] = (meta, data)
+            self.stats["files_uploaded"] += 1
+        return meta
+
+    def create_batch(self, body):
+        if body["input_file_id"] not in self.files:
+            raise MockAPIError(404, f"No such file: {body['input_file_id']}", "invalid_request_error")
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+            "status": "validating", "created_at": int(time.time()), "metadata": body.get("metadata"),
+            "output_file_id": None, "error_file_id": None, "errors": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+            self.stats["batches_created"] += 1
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch_id):
+        """Answer every line of the input file; injected failures go to the error file."""
+        batch = self.batches[batch_id]
+        with self.lock:
+            batch["status"] = "in_progress"
+        _, data = self.files[batch["input_file_id"]]
+        output, errors = io.StringIO(), io.StringIO()
+        counts = Counter()
+        for line in data.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            counts["total"] += 1
+            if random.random() < self.config.rate_5xx:
+                counts["failed"] += 1
+                errors.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": request["custom_id"],
+                    "response": {"status_code": 500, "body": {"error": {"message": "Injected server error (mock)",
+                                                                         "type": "server_error"}}},
+                    "error": None,
+                }) + "\n")
+                continue
+            counts["completed"] += 1
+            output.write(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                             "body": self.completion(request["body"])},
+                "error": None,
+            }, ensure_ascii=False) + "\n")
+        time.sleep(self.config.batch_seconds)
+        output_meta = self.create_file("batch_output.jsonl", "batch_output", output.getvalue().encode("utf-8"))
+        error_meta = (self.create_file("batch_errors.jsonl", "batch_output", errors.getvalue().encode("utf-8"))
+                      if counts["failed"] else None)
+        with self.lock:
+            batch.update(status="completed", completed_at=int(time.time()), output_file_id=output_meta["id"],
+                         error_file_id=error_meta["id"] if error_meta else None, request_counts=dict(counts))
+            self.stats["batch_lines"] += counts["total"]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the SDK's connection pool expects
+    api = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bytes(self, data, content_type="application/octet-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def dispatch(self, method):
+        body = self.read_body() if method == "POST" else b""
+        path = self.path.split("?", 1)[0].rstrip("/")
+        parts = path.strip("/").split("/")
+        if parts and parts[0] == "v1":
+            parts = parts[1:]
+        api = self.api
+        try:
+            if method == "POST" and parts == ["chat", "completions"]:
+                return self.send_json(200, api.chat_completion(json.loads(body)))
+            if method == "POST" and parts == ["files"]:
+                return self.send_json(200, self.upload(body))
+            if method == "GET" and len(parts) == 3 and parts[0] == "files" and parts[2] == "content":
+                if parts[1] not in api.files:
+                    raise MockAPIError(404, f"No such file: {parts[1]}", "invalid_request_error")
+                return self.send_bytes(api.files[parts[1]][1], "application/jsonl")
+            if method == "GET" and len(parts) == 2 and parts[0] == "files" and parts[1] in api.files:
+                return self.send_json(200, api.files[parts[1]][0])
+            if method == "POST" and parts == ["batches"]:
+                return self.send_json(200, api.create_batch(json.loads(body)))
+            if method == "GET" and len(parts) == 2 and parts[0] == "batches" and parts[1] in api.batches:
+                with api.lock:
+                    api.stats["batch_polls"] += 1
+                    return self.send_json(200, dict(api.batches[parts[1]]))
+            if method == "GET" and parts == ["stats"]:
+                with api.lock:
+                    return self.send_json(200, dict(api.stats))
+            raise MockAPIError(404, f"Unknown route: {method} {self.path}", "invalid_request_error")
+        except MockAPIError as e:
+            headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+            self.send_json(e.status, {"error": {"message": str(e), "type": e.error_type, "code": None}}, headers)
+
+    def upload(self, body):
+        """Parse the multipart/form-data upload of files.create."""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("latin-1")
+        message = BytesParser().parsebytes(header + body)
+        fields, filename, data = {}, "upload.jsonl", b""
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                filename, data = part.get_filename(), part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        return self.api.create_file(filename, fields.get("purpose", "batch"), data)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 resets bursts of concurrent connects
+
+
+def serve(config, host=HOST, port=PORT):
+    """Serve the mock API until interrupted; returns the server (use serve_forever in a thread to embed)."""
+    handler = type("BoundMockHandler", (MockHandler,), {"api": MockOpenAI(config)})
+    server = MockHTTPServer((host, port), handler)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat.completions, files and batches API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of requests answered with 5xx")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute limit (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute limit (0 = unlimited)")
+    parser.add_argument("--batch-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    config = MockConfig(args.latency_ms, args.jitter_ms, args.rate_429, args.rate_5xx, args.rpm, args.tpm,
+                        args.batch_seconds)
+    server = serve(config, args.host, args.port)
+    print(f"Mock OpenAI API on http://{args.host}:{server.server_port}/v1 (OPENAI_BASE_URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
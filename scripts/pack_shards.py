@@ -0,0 +1,237 @@
+import os
+import io
+import json
+import glob
+import sqlite3
+import hashlib
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from manifest import refresh_manifest, iter_images
+from metrics import instrumented, current_stage
+
+DATASET_DIR = '/home/user/kz-mm/data/full_dataset'
+SHARDS_DIR = '/home/user/kz-mm/data/full_dataset_shards'
+TARGET_SHARD_BYTES = 1 << 30  # ~1 GiB per shard
+# Optional {image_path: caption} JSON, e.g. built from batch captioning results
+CAPTIONS_JSON = None
+PACK_WORKERS = 8
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    shard TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    key TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (key, ext)
+);
+CREATE INDEX IF NOT EXISTS samples_path ON samples (path);
+CREATE TABLE IF NOT EXISTS shards (
+    shard TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+"""
+
+
+def _add_bytes(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shard(args):
+    """
+    Write one WebDataset-style tar: for every sample `<key>.<img ext>` with the
+    original image bytes, `<key>.json` with score/topic/path and `<key>.txt`
+    with the caption if there is one. Returns [(key, ext, offset, size)] with
+    the data offset of each member, read back from the finished tar.
+    """
+    shard_path, samples = args
+    tmp_path = shard_path + '.tmp'
+    with tarfile.open(tmp_path, 'w') as tar:
+        for sample in samples:
+            key = sample['key']
+            with open(sample['path'], 'rb') as f:
+                image_bytes = f.read()
+            mtime = int(os.path.getmtime(sample['path']))
+            _add_bytes(tar, f"{key}.{sample['ext']}", image_bytes, mtime)
+            meta = {
+                'path': sample['path'],
+                'topic': sample['topic'],
+                'aesthetic_score': sample['aesthetic_score'],
+            }
+            _add_bytes(tar, f"{key}.json", json.dumps(meta, ensure_ascii=False).encode('utf-8'), mtime)
+            if sample['caption'] is not None:
+                _add_bytes(tar, f"{key}.txt", sample['caption'].encode('utf-8'), mtime)
+    os.replace(tmp_path, shard_path)
+    return os.path.basename(shard_path), read_members(shard_path)
+
+
+def read_members(shard_path):
+    """[(key, ext, offset, size)] with the data offset of each member of a finished tar."""
+    members = []
+    with tarfile.open(shard_path, 'r') as tar:
+        for member in tar:
+            key, ext = member.name.split('.', 1)
+            members.append((key, ext, member.offset_data, member.size))
+    return members
+
+
+def sample_key(image):
+    """Stable key from the image's cluster/subcluster/topic/filename, so other images don't renumber it."""
+    rel_path = f"{image.cluster}/{image.subcluster}/{image.topic}/{image.filename}"
+    return hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:24]
+
+
+def shard_fingerprint(samples):
+    """Hash of everything a shard's content depends on; equal fingerprints mean an identical tar."""
+    fields = [(s['key'], s['path'], s['ext'], s['size'], s['mtime_ns'], s['topic'], s['aesthetic_score'],
+               s['caption']) for s in samples]
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def plan_shards(dataset_dir, target_bytes=TARGET_SHARD_BYTES, captions=None):
+    """
+    Assign manifest images (in stable path order) to shards of ~target_bytes each.
+    Shard boundaries are content-defined: past half the target a shard ends
+    after an image whose key hash falls below a size-proportional cut-off (or at
+    twice the target). Adding or removing an image therefore only changes the
+    shard it falls in, and the boundaries of the following shards stay put.
+    """
+    captions = captions or {}
+    shards, current, current_bytes = [], [], 0
+    scores_cache = {}
+    for image in iter_images([dataset_dir]):
+        topic_path = os.path.dirname(image.path)
+        if topic_path not in scores_cache:
+            scores_cache.clear()  # images are grouped by topic
+            try:
+                with open(os.path.join(topic_path, 'aesthetic_data.json')) as f:
+                    scores_cache[topic_path] = json.load(f)
+            except (OSError, ValueError):
+                scores_cache[topic_path] = {}
+        key = sample_key(image)
+        current.append({
+            'key': key,
+            'path': image.path,
+            'ext': 'jpg' if image.format == 'jpeg' else image.format,
+            'size': image.size,
+            'mtime_ns': image.mtime_ns,
+            'topic': f"{image.cluster}/{image.subcluster}/{image.topic}",
+            'aesthetic_score': scores_cache[topic_path].get(image.filename),
+            'caption': captions.get(image.path),
+        })
+        current_bytes += image.size
+        boundary = int(key[:8], 16) / 2**32 < 2 * image.size / target_bytes
+        if (current_bytes >= target_bytes // 2 and boundary) or current_bytes >= 2 * target_bytes:
+            shards.append(current)
+            current, current_bytes = [], 0
+    if current:
+        shards.append(current)
+    return shards
+
+
+@instrumented("pack")
+def pack_dataset(dataset_dir=DATASET_DIR, shards_dir=SHARDS_DIR, target_bytes=TARGET_SHARD_BYTES,
+                 captions_json=CAPTIONS_JSON, workers=PACK_WORKERS):
+    """
+    Pack dataset_dir into tar shards written in parallel, plus index.sqlite for
+    keyed access. Shards whose content is unchanged since the last run are kept
+    (renamed if their position moved) instead of being rewritten, and shard
+    files the new plan does not cover are deleted.
+    """
+    refresh_manifest([dataset_dir])
+    captions = {}
+    if captions_json:
+        with open(captions_json, encoding='utf-8') as f:
+            captions = json.load(f)
+
+    os.makedirs(shards_dir, exist_ok=True)
+    shards = plan_shards(dataset_dir, target_bytes, captions)
+    planned = [(os.path.join(shards_dir, f"shard-{i:05d}.tar"), samples, shard_fingerprint(samples))
+               for i, samples in enumerate(shards)]
+
+    index_path = os.path.join(shards_dir, 'index.sqlite')
+    previous = {}  # fingerprint → shard file of the last run
+    if os.path.exists(index_path):
+        old = sqlite3.connect(index_path)
+        try:
+            previous = {fp: os.path.join(shards_dir, shard)
+                        for shard, fp in old.execute("SELECT shard, fingerprint FROM shards")}
+        except sqlite3.OperationalError:
+            pass  # index from before shards were fingerprinted: rewrite everything
+        old.close()
+        os.remove(index_path)
+
+    # Reused shards are moved aside first, so renames can't clobber each other
+    reused, tasks = [], []
+    for shard_path, samples, fingerprint in planned:
+        old_path = previous.pop(fingerprint, None)
+        if old_path and os.path.exists(old_path):
+            os.replace(old_path, shard_path + '.reuse')
+            reused.append((shard_path, samples, fingerprint))
+        else:
+            tasks.append((shard_path, samples, fingerprint))
+    for shard_path, _, _ in reused:
+        os.replace(shard_path + '.reuse', shard_path)
+    keep = {shard_path for shard_path, _, _ in planned}
+    for stale in glob.glob(os.path.join(shards_dir, 'shard-*.tar*')):
+        if stale not in keep:
+            os.remove(stale)
+
+    conn = sqlite3.connect(index_path)
+    conn.executescript(INDEX_SCHEMA)
+    stage = current_stage()
+
+    def index_shard(shard_name, samples, fingerprint, members):
+        with conn:
+            conn.executemany("INSERT INTO samples VALUES (?, ?, ?)",
+                             [(s['key'], s['path'], shard_name) for s in samples])
+            conn.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?)",
+                             [(key, ext, shard_name, offset, size) for key, ext, offset, size in members])
+            conn.execute("INSERT INTO shards VALUES (?, ?)", (shard_name, fingerprint))
+
+    for shard_path, samples, fingerprint in reused:
+        index_shard(os.path.basename(shard_path), samples, fingerprint, read_members(shard_path))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [(shard_path, samples) for shard_path, samples, _ in tasks]
+        for (shard_path, samples, fingerprint), (shard_name, members) in tqdm(
+            zip(tasks, pool.map(write_shard, jobs)), total=len(tasks), desc="Packing shards"
+        ):
+            index_shard(shard_name, samples, fingerprint, members)
+            # The shards are read and written by the worker processes
+            stage.items(len(samples))
+            stage.add_bytes(read=sum(size for _, ext, _, size in members if ext not in ('json', 'txt')),
+                            written=os.path.getsize(shard_path))
+    conn.close()
+    stage.count('shards_reused', len(reused))
+    n_samples = sum(len(s) for s in shards)
+    print(f"✅ Packed {n_samples:,} images into {len(shards)} shards in {shards_dir} "
+          f"({len(tasks)} written, {len(reused)} unchanged)")
+    return len(shards), n_samples
+
+
+def read_member(shards_dir, key, ext, conn=None):
+    """Bytes of one member (e.g. key, 'json') with a single seek into its shard."""
+    own_conn = conn is None
+    conn = conn or sqlite3.connect(os.path.join(shards_dir, 'index.sqlite'))
+    row = conn.execute("SELECT shard, offset, size FROM members WHERE key = ? AND ext = ?", (key, ext)).fetchone()
+    if own_conn:
+        conn.close()
+    if row is None:
+        raise KeyError(f"{key}.{ext}")
+    shard, offset, size = row
+    with open(os.path.join(shards_dir, shard), 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+if __name__ == "__main__":
+    pack_dataset()
@@ -0,0 +1,340 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import traceback
+from collections import namedtuple
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from pathlib import Path
+import metrics
+from manifest import MANIFEST_PATH, connect, refresh_manifest
+from image_probe import probe_manifest
+from scoring_state import STATE_PATH
+from file_utils import atomic_write_json
+
+DATASETS = [
+    '/home/user/kz-mm/data/DataSet_1',
+    '/home/user/kz-mm/data/DataSet_2',
+    '/home/user/kz-mm/data/DataSet_3',
+    '/home/user/kz-mm/data/DataSet_4'
+]
+OUTPUT_DIR = '/home/user/kz-mm/data/full_dataset'
+PIPELINE_STATE = "pipeline_state.json"
+PIPELINE_WORKERS = 4
+# Written after a successful merge and removed before one starts, so an interrupted merge is redone
+MERGE_MARKER = "merge_complete.json"
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# run:       callable doing the work (heavy modules are imported inside it)
+# inputs:    callable → JSON value of what the stage reads besides its deps' outputs
+# outputs:   files the stage writes; a changed or missing output forces a rerun
+# sources:   scripts whose code is part of the fingerprint
+# resources: stages sharing a resource never run at the same time ("gpu", "cpu", "io"); manifest
+#            writers need none, they wait for each other's short transactions (manifest.BUSY_TIMEOUT)
+# always:    run every time; the fingerprint is taken afterwards (scans that detect new data)
+Stage = namedtuple("Stage", ["name", "deps", "run", "inputs", "outputs", "sources", "resources", "always"],
+                   defaults=(lambda: None, (), (), (), False))
+
+
+def dataset_name(base_dir):
+    return os.path.basename(os.path.normpath(base_dir))
+
+
+def dataset_signature(base_dir, db_path=MANIFEST_PATH):
+    """Image count, newest mtime, total size, probed count and topic count of one dataset in the manifest."""
+    root = os.path.abspath(base_dir)
+    conn = connect(db_path)
+    images = conn.execute("SELECT COUNT(*), COALESCE(MAX(mtime_ns), 0), COALESCE(SUM(size), 0), COUNT(width) "
+                          "FROM images WHERE root = ?", (root,)).fetchone()
+    topics = conn.execute("SELECT COUNT(*) FROM topics WHERE root = ?", (root,)).fetchone()[0]
+    conn.close()
+    return [*images, topics]
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+@lru_cache(maxsize=None)
+def source_digest(sources):
+    digest = hashlib.sha1()
+    for name in sources:
+        with open(os.path.join(SCRIPTS_DIR, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def stage_fingerprint(stage, state):
+    """Hash of the stage's inputs, code and the fingerprints and outputs of its deps."""
+    parts = {
+        'inputs': stage.inputs(),
+        'code': source_digest(tuple(stage.sources)),
+        'deps': {d: [state[d]['fingerprint'], state[d]['outputs']] for d in sorted(stage.deps)},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# ----------------------- Stage bodies -----------------------
+
+def scan_dataset(base_dir):
+    refresh_manifest([base_dir])
+    probe_manifest([base_dir])
+
+
+def hash_dataset(base_dir):
+    from find_duplicates import find_dataset_duplicates
+    find_dataset_duplicates(base_dir)
+
+
+def global_dedup(datasets):
+    from find_duplicates import find_global_duplicates
+    find_global_duplicates(datasets)
+
+
+def score_datasets(datasets):
+    from aesthetic_scorer import score_dataset
+    score_dataset(datasets)
+
+
+def semantic_dedup(datasets):
+    from semantic_dedup import find_semantic_duplicates
+    find_semantic_duplicates(datasets)
+
+
+def dataset_stats(datasets):
+    from stats_engine import build_statistics
+    build_statistics(datasets)
+
+
+def merge(datasets, output_dir):
+    from merge_clusters import merge_datasets, print_merge_summary
+    if os.path.exists(MERGE_MARKER):
+        os.remove(MERGE_MARKER)
+    os.makedirs(output_dir, exist_ok=True)
+    files, nbytes = merge_datasets(datasets, output_dir)
+    print_merge_summary(files, nbytes)
+    atomic_write_json(MERGE_MARKER, {'output_dir': output_dir, 'files': files, 'bytes': nbytes}, indent=2)
+
+
+def split(output_dir):
+    from split_data import create_splits
+    create_splits(output_dir)
+
+
+def file_map(output_dir):
+    from generate_file_map import generate_file_map, BASE_URL
+    generate_file_map(Path(output_dir).resolve(), BASE_URL)
+
+
+def batch_prep():
+    from batch_jsonl_prepare import INPUT_SOURCE, LINKS_DB_PATH, write_sharded_jsonl, generate_batch_requests, \
+        iter_input_paths
+    write_sharded_jsonl(generate_batch_requests(iter_input_paths(INPUT_SOURCE), LINKS_DB_PATH))
+
+
+def build_stages(datasets=DATASETS, output_dir=OUTPUT_DIR):
+    """
+    scan → hash → dedup → score → merge → split → file map → batch prep as a DAG.
+    Scanning and hashing are per dataset, so a new dataset only adds new nodes;
+    the incremental stages (score, stats, merge, file map) then only touch new files.
+    """
+    from split_data import SPLITS
+    from merge_clusters import MERGE_STRATEGY, VIRTUAL_MANIFEST
+    from stats_engine import STATS_DB, STATISTICS_JSON
+    from generate_file_map import FILE_MAP_DB, BASE_URL
+    from batch_jsonl_prepare import INPUT_SOURCE, OUTPUT_DIR as BATCH_DIR, SHARD_MANIFEST
+
+    names = [dataset_name(d) for d in datasets]
+    scans = [f"scan:{n}" for n in names]
+    hashes = [f"hash:{n}" for n in names]
+    all_signatures = lambda: {n: dataset_signature(d) for n, d in zip(names, datasets)}
+
+    stages = []
+    for base_dir, name in zip(datasets, names):
+        stages.append(Stage(f"scan:{name}", [], lambda d=base_dir: scan_dataset(d),
+                            inputs=lambda d=base_dir: dataset_signature(d),
+                            sources=("manifest.py", "image_probe.py"), always=True))
+        stages.append(Stage(f"hash:{name}", [f"scan:{name}"], lambda d=base_dir: hash_dataset(d),
+                            outputs=(f"all_duplicates_{name}.json", f"duplicates_summary_{name}.json"),
+                            sources=("find_duplicates.py", "dhash_engine.py"), resources=("cpu",)))
+    stages += [
+        Stage("dedup", hashes, lambda: global_dedup(datasets),
+              outputs=("global_duplicates.json", "global_duplicate_groups.json"),
+              sources=("find_duplicates.py", "hash_index.py"), resources=("cpu",)),
+        Stage("score", scans, lambda: score_datasets(datasets), inputs=all_signatures, outputs=(STATE_PATH,),
+              sources=("aesthetic_scorer.py", "embedding_store.py", "scoring_state.py"), resources=("gpu",)),
+        Stage("semantic", ["score"], lambda: semantic_dedup(datasets),
+              outputs=("semantic_duplicates.json", "semantic_duplicate_groups.json"),
+              sources=("semantic_dedup.py", "hash_index.py"), resources=("cpu",)),
+        Stage("stats", hashes + ["score"], lambda: dataset_stats(datasets),
+              outputs=(STATISTICS_JSON, STATS_DB), sources=("stats_engine.py",)),
+        Stage("merge", hashes + ["score"], lambda: merge(datasets, output_dir),
+              inputs=lambda: {'output_dir': output_dir, 'strategy': MERGE_STRATEGY},
+              # The marker catches interrupted merges, the folder's signature a deleted or recreated output
+              outputs=(MERGE_MARKER, output_dir) + ((VIRTUAL_MANIFEST,) if MERGE_STRATEGY == 'virtual' else ()),
+              sources=("merge_clusters.py",), resources=("io",)),
+        Stage("split", ["merge", "dedup", "semantic"], lambda: split(output_dir),
+              inputs=lambda: {'output_dir': output_dir},
+              outputs=tuple(f"{kind}_set_{name}.json" for name in SPLITS for kind in ("train", "valid")),
+              sources=("split_data.py",)),
+        Stage("file_map", ["merge"], lambda: file_map(output_dir),
+              inputs=lambda: {'output_dir': output_dir, 'base_url': BASE_URL},
+              outputs=(FILE_MAP_DB,), sources=("generate_file_map.py",)),
+        Stage("batch_prep", ["split", "file_map"], batch_prep, inputs=lambda: {'source': INPUT_SOURCE},
+              outputs=(os.path.join(BATCH_DIR, SHARD_MANIFEST),), sources=("batch_jsonl_prepare.py",)),
+    ]
+    return stages
+
+
+# ----------------------- Runner -----------------------
+
+def select_stages(stages, only=None):
+    """Stages in topological order, restricted to `only` and everything they depend on."""
+    by_name = {s.name: s for s in stages}
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in by_name]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {missing}")
+    wanted = set(by_name)
+    if only:
+        unknown = [n for n in only if n not in by_name]
+        if unknown:
+            raise ValueError(f"Unknown stages: {unknown}")
+        wanted, todo = set(), list(only)
+        while todo:
+            name = todo.pop()
+            if name not in wanted:
+                wanted.add(name)
+                todo.extend(by_name[name].deps)
+
+    ordered, done = [], set()
+    while len(ordered) < len(wanted):
+        ready = [s for s in stages if s.name in wanted and s.name not in done and set(s.deps) <= done]
+        if not ready:
+            raise ValueError("Stage dependencies contain a cycle")
+        ordered += ready
+        done.update(s.name for s in ready)
+    return ordered
+
+
+def load_state(path=PIPELINE_STATE):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def run_pipeline(stages, state_path=PIPELINE_STATE, only=None, force=(), workers=PIPELINE_WORKERS):
+    """
+    Run the selected stages, each as soon as its deps are done and its
+    resources are free. A stage whose fingerprint matches the last successful
+    run and whose outputs are untouched is skipped. A failed stage blocks only
+    its descendants. Returns {stage: "ran" | "cached" | "failed" | "blocked"}.
+    """
+    ordered = select_stages(stages, only)
+    by_name = {s.name: s for s in ordered}
+    state = load_state(state_path)
+    state_lock = threading.Lock()
+    locks = {r: threading.Lock() for s in ordered for r in s.resources}
+    status = {}
+
+    def execute(stage):
+        if not stage.always:
+            with state_lock:
+                fingerprint = stage_fingerprint(stage, state)
+                record = state.get(stage.name)
+            if (stage.name not in force and record and record['fingerprint'] == fingerprint
+                    and all(file_signature(p) == record['outputs'].get(p) for p in stage.outputs)):
+                print(f"[PIPELINE] {stage.name}: unchanged, skipped")
+                metrics.emit({'type': 'stage', 'stage': f"pipeline.{stage.name}", 'status': "cached",
+                              'started_at': time.time(), 'seconds': 0.0})
+                return "cached"
+        with ExitStack() as stack:
+            for resource in sorted(stage.resources):
+                stack.enter_context(locks[resource])
+            print(f"[PIPELINE] {stage.name}: running")
+            started = time.time()
+            with metrics.stage(f"pipeline.{stage.name}"):
+                stage.run()
+        with state_lock:
+            if stage.always:
+                fingerprint = stage_fingerprint(stage, state)
+            missing = [p for p in stage.outputs if not os.path.exists(p)]
+            if missing:
+                print(f"⚠️ {stage.name} did not write {missing}")
+            state[stage.name] = {
+                'fingerprint': fingerprint,
+                'outputs': {p: file_signature(p) for p in stage.outputs},
+                'seconds': round(time.time() - started, 2),
+                'finished_at': time.time(),
+            }
+            atomic_write_json(state_path, state, indent=2)
+        print(f"[PIPELINE] {stage.name}: done in {time.time() - started:.1f}s")
+        return "ran"
+
+    remaining = {s.name: set(s.deps) for s in ordered}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while remaining or running:
+            for name in [n for n, deps in remaining.items() if not deps]:
+                del remaining[name]
+                running[pool.submit(execute, by_name[name])] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    status[name] = "failed"
+                    blocked = {name}
+                    for stage in ordered:  # topological order: descendants follow their deps
+                        if stage.name in remaining and blocked & set(stage.deps):
+                            blocked.add(stage.name)
+                            status[stage.name] = "blocked"
+                            del remaining[stage.name]
+                    continue
+                for deps in remaining.values():
+                    deps.discard(name)
+
+    print_pipeline_summary(ordered, status, state)
+    return status
+
+
+def print_pipeline_summary(ordered, status, state):
+    print("\n🧩 Pipeline Summary")
+    print("=" * 60)
+    for stage in ordered:
+        result = status.get(stage.name, "blocked")
+        seconds = state.get(stage.name, {}).get('seconds', 0) if result == "ran" else 0
+        emoji = {"ran": "✅", "cached": "💾", "failed": "❌"}.get(result, "⏸️")
+        print(f"  {emoji} {stage.name:<20} {result:<8} {seconds:>10.1f}s")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the dataset pipeline, skipping stages whose inputs are unchanged")
+    parser.add_argument("--datasets", nargs="+", default=DATASETS, help="DataSet_N folders to process")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="merged dataset folder")
+    parser.add_argument("--only", nargs="+", help="run these stages and whatever they depend on")
+    parser.add_argument("--force", nargs="+", default=[], help="rerun these stages even if unchanged")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS)
+    parser.add_argument("--list", action="store_true", help="print the stages and their deps")
+    args = parser.parse_args()
+
+    stages = build_stages(args.datasets, args.output_dir)
+    if args.list:
+        for stage in select_stages(stages, args.only):
+            print(f"{stage.name:<20} ← {', '.join(stage.deps) or '-'}")
+    else:
+        status = run_pipeline(stages, only=args.only, force=set(args.force), workers=args.workers)
+        if "failed" in status.values() or "blocked" in status.values():
+            raise SystemExit(1)
@@ -0,0 +1,173 @@
+import time
+import random
+import asyncio
+from collections import Counter
+from response_cache import request_key, response_to_dict
+from metrics import current_stage
+
+# Defaults sized for gpt-4o-mini on a low usage tier; raise them to match the account limits
+MAX_CONCURRENCY = 32
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200_000
+MAX_RETRIES = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Low-detail images are billed at a flat 85 tokens
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+class TokenBucket:
+    """Async token bucket holding up to `per_minute` tokens, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:  # first come, first served
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits applied together."""
+
+    def __init__(self, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    async def acquire(self, tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+
+def estimate_tokens(body):
+    """Rough upper estimate of what a chat request counts against TPM: prompt + max_tokens."""
+    tokens = body.get("max_tokens", 0)
+    for message in body["messages"]:
+        content = message["content"]
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        for part in parts:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 3 + 1  # Kazakh Cyrillic tokenizes densely
+            else:
+                tokens += LOW_DETAIL_IMAGE_TOKENS
+    return tokens
+
+
+def is_retryable(exc):
+    """429 / 5xx API errors and connection-level failures (no status code) are retried."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        return type(exc).__name__ in {"APIConnectionError", "APITimeoutError"} or isinstance(exc, OSError)
+    return status in RETRY_STATUSES
+
+
+def retry_delay(attempt, exc=None, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """Full-jitter exponential backoff, never shorter than a server-sent Retry-After."""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    response = getattr(exc, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        delay = max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+async def create_with_retries(client, body, limiter, stats, max_retries=MAX_RETRIES, cache=None):
+    """
+    One chat.completions call under the rate limiter, retried with backoff on
+    transient errors. Returns (response dict, cached); with a ResponseCache,
+    identical requests are answered from it without touching the API. Fresh
+    responses are not stored here: run_requests stores them once the result
+    handler accepted them.
+    """
+    if cache is not None:
+        cached = cache.get(body)
+        if cached is not None:
+            stats["cache_hits"] += 1
+            return cached, True
+    tokens = estimate_tokens(body)
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(tokens)
+        stats["requests"] += 1
+        try:
+            response = response_to_dict(await client.chat.completions.create(**body))
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            stats["retries"] += 1
+            await asyncio.sleep(retry_delay(attempt, e))
+            continue
+        return response, False
+
+
+async def run_requests(client, jobs, on_result, concurrency=MAX_CONCURRENCY,
+                       rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE, max_retries=MAX_RETRIES, cache=None):
+    """
+    Run (key, body) jobs with at most `concurrency` requests in flight. Jobs are
+    pulled lazily; body may be a callable that builds the request body (e.g.
+    reads and encodes an image), which then runs in a worker thread so bodies
+    are built concurrently. A body that fails to build counts as a failed job.
+    on_result(key, response dict, error) is called as each one
+    finishes, so callers can checkpoint as they go. If on_result raises on a
+    response (e.g. a refusal without content), the job counts as failed and
+    on_result is called again with that error. Only responses on_result accepted
+    are written to the cache; a rejected cached response is dropped from it.
+    Returns request/retry/failure counts.
+    """
+    limiter = RateLimiter(rpm, tpm)
+    stats = Counter()
+    jobs = iter(jobs)
+    started = time.perf_counter()
+
+    async def worker():
+        # Pulling from the shared iterator is cheap and never awaits; the
+        # expensive body building runs outside of it, in a thread per worker
+        for key, body in jobs:
+            try:
+                if callable(body):
+                    body = await asyncio.to_thread(body)
+                response, cached = await create_with_retries(client, body, limiter, stats, max_retries, cache)
+            except Exception as e:
+                error = e
+            else:
+                try:
+                    on_result(key, response, None)
+                except Exception as e:
+                    error = e
+                    if cached:
+                        cache.delete_key(request_key(body))
+                else:
+                    stats["succeeded"] += 1
+                    if cache is not None and not cached:
+                        cache.put_key(request_key(body), response, body.get("model"))
+                    continue
+            stats["failed"] += 1
+            try:
+                on_result(key, None, error)
+            except Exception as e:
+                print(f"[ERROR] Result handler failed on {key}: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stage = current_stage()
+    stage.items(stats["succeeded"])
+    for key, value in stats.items():
+        stage.count(key, value)
+    print(f"[REALTIME] {stats['succeeded']} ok ({stats['cache_hits']} cached), {stats['failed']} failed, "
+          f"{stats['retries']} retries "
+          f"in {elapsed:.1f}s ({stats['succeeded'] / max(elapsed, 1e-9):.1f} req/s)")
+    return stats
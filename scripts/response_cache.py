@@ -0,0 +1,131 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+RESPONSE_CACHE_PATH = "response_cache.sqlite"
+MAX_CACHE_BYTES = 2 << 30  # least recently used responses are evicted beyond ~2 GiB
+EVICT_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def request_key(body):
+    """sha256 of the canonical JSON of a request body (model, messages incl. image payload, max_tokens, ...)."""
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def response_to_dict(response):
+    """SDK response objects are stored and returned as plain dicts."""
+    return response.model_dump() if hasattr(response, "model_dump") else response
+
+
+def has_content(response):
+    """True if a chat completion carries non-empty message content (not a refusal or filtered output)."""
+    try:
+        content = response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return False
+    return isinstance(content, str) and bool(content.strip())
+
+
+class ResponseCache:
+    """
+    Content-addressed store of chat.completions responses keyed by request_key.
+    Identical requests (same model, prompt, image and parameters) are answered
+    locally; the store is trimmed by least recent use when over max_bytes.
+    Only responses with message content are stored, so refusals and filtered
+    outputs are requested again instead of being replayed forever.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get_key(self, key):
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        response = json.loads(row[0])
+        if not has_content(response):  # stored before empty responses were refused
+            self.delete_key(key)
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return response
+
+    def put_key(self, key, response, model=None):
+        """Store a response; returns False (and stores nothing) if it has no message content."""
+        response = response_to_dict(response)
+        if not has_content(response):
+            return False
+        text = json.dumps(response, ensure_ascii=False)
+        size = len(text.encode("utf-8"))
+        now = time.time()
+        with self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, model, text, size, now, now))
+        self.total += size - (old[0] if old else 0)
+        if self.total > self.max_bytes:
+            self.evict()
+        return True
+
+    def delete_key(self, key):
+        """Drop one response, e.g. one its caller could not use."""
+        with self.conn:
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        if row:
+            self.total -= row[0]
+
+    def get(self, body):
+        return self.get_key(request_key(body))
+
+    def put(self, body, response):
+        self.put_key(request_key(body), response, body.get("model"))
+
+    def complete(self, client, body):
+        """Synchronous chat.completions call through the cache; returns the response as a dict."""
+        key = request_key(body)
+        cached = self.get_key(key)
+        if cached is not None:
+            return cached
+        response = response_to_dict(client.chat.completions.create(**body))
+        self.put_key(key, response, body.get("model"))
+        return response
+
+    def evict(self, target=None):
+        """Drop least recently used responses until the store is at most target bytes."""
+        target = self.max_bytes * EVICT_TO if target is None else target
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self.total <= target:
+                break
+            doomed.append((key,))
+            self.total -= size
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        return len(doomed)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,107 @@
+import os
+import json
+import sqlite3
+
+STATE_PATH = "aesthetic_state.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    path TEXT PRIMARY KEY,
+    topic_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_topic ON scores (topic_path);
+CREATE TABLE IF NOT EXISTS failures (
+    path TEXT PRIMARY KEY,
+    topic_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS failures_topic ON failures (topic_path);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    topic_path TEXT PRIMARY KEY,
+    images INTEGER NOT NULL,
+    completed_at REAL NOT NULL
+);
+"""
+
+
+def connect_state(db_path=STATE_PATH):
+    """Open the scoring state database (which image+mtime has which score)."""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_topic_state(conn, topic_dir, output_name="aesthetic_data.json"):
+    """
+    {filename: (mtime_ns, score)} already scored for topic_dir.
+
+    Topics scored before the state database existed are bootstrapped from their
+    aesthetic_data.json: an entry is trusted if the image is not newer than the JSON.
+    """
+    stored = {
+        fname: (mtime_ns, score)
+        for fname, mtime_ns, score in conn.execute(
+            "SELECT filename, mtime_ns, score FROM scores WHERE topic_path = ?", (topic_dir,)
+        )
+    }
+    if stored or conn.execute("SELECT 1 FROM checkpoints WHERE topic_path = ?", (topic_dir,)).fetchone():
+        return stored
+
+    json_path = os.path.join(topic_dir, output_name)
+    try:
+        json_mtime = os.stat(json_path).st_mtime_ns
+        with open(json_path) as f:
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    for fname, score in legacy.items():
+        try:
+            mtime_ns = os.stat(os.path.join(topic_dir, fname)).st_mtime_ns
+        except OSError:
+            continue
+        if mtime_ns <= json_mtime:
+            stored[fname] = (mtime_ns, float(score))
+    return stored
+
+
+def load_topic_failures(conn, topic_dir):
+    """{filename: mtime_ns} of images of topic_dir that could not be decoded."""
+    return dict(conn.execute("SELECT filename, mtime_ns FROM failures WHERE topic_path = ?", (topic_dir,)))
+
+
+def commit_topic(conn, topic_dir, rows, completed_at, failures=()):
+    """
+    Replace the stored scores of topic_dir with rows [(filename, mtime_ns, score)]
+    and its undecodable images with failures [(filename, mtime_ns)], and mark
+    the topic as checkpointed.
+    """
+    with conn:
+        conn.execute("DELETE FROM scores WHERE topic_path = ?", (topic_dir,))
+        conn.executemany(
+            "INSERT INTO scores VALUES (?, ?, ?, ?, ?)",
+            [(os.path.join(topic_dir, fname), topic_dir, fname, mtime_ns, score)
+             for fname, mtime_ns, score in rows],
+        )
+        conn.execute("DELETE FROM failures WHERE topic_path = ?", (topic_dir,))
+        conn.executemany(
+            "INSERT INTO failures VALUES (?, ?, ?, ?)",
+            [(os.path.join(topic_dir, fname), topic_dir, fname, mtime_ns) for fname, mtime_ns in failures],
+        )
+        conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (topic_dir, len(rows), completed_at))
+
+
+def invalidate_topic(conn, topic_dir):
+    """
+    Forget everything scored for topic_dir so the next incremental run rescores
+    all of its images. The topic stays checkpointed with no scores, so its
+    aesthetic_data.json (written by someone else) is not adopted as legacy state.
+    """
+    with conn:
+        conn.execute("DELETE FROM scores WHERE topic_path = ?", (topic_dir,))
+        conn.execute("DELETE FROM failures WHERE topic_path = ?", (topic_dir,))
+        conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, 0, 0)", (topic_dir,))
@@ -0,0 +1,200 @@
+import os
+import json
+from collections import defaultdict
+import numpy as np
+from embedding_store import EmbeddingStore, EMBEDDINGS_DIR
+from hash_index import duplicate_groups
+from metrics import instrumented, current_stage
+
+base_dirs = [
+    '/home/user/kz-mm/data/DataSet_1',
+    '/home/user/kz-mm/data/DataSet_2',
+    '/home/user/kz-mm/data/DataSet_3',
+    '/home/user/kz-mm/data/DataSet_4'
+]
+
+SIMILARITY_THRESHOLD = 0.95  # cosine similarity of normalized ViT-L-14 features
+METHOD = "ivf"  # "ivf" (approximate) or "exact" (blocked matmul baseline)
+N_PROBE = 8
+BLOCK_SIZE = 4096
+KMEANS_ITERS = 10
+RECALL_SAMPLE = 20_000
+
+
+def load_embeddings(base_dirs=None, embeddings_dir=EMBEDDINGS_DIR):
+    """(paths, float16 vectors) of stored embeddings, optionally restricted to base_dirs."""
+    try:
+        store = EmbeddingStore(embeddings_dir, readonly=True)
+    except FileNotFoundError:
+        print(f"No embeddings stored in {embeddings_dir} yet")
+        return [], np.empty((0, 768), dtype=np.float16)
+    roots = tuple(os.path.abspath(b) + os.sep for b in base_dirs) if base_dirs else None
+    paths, blocks = [], []
+    for shard_paths, vectors in store.iter_shards():
+        if roots:
+            keep = np.array([p.startswith(roots) for p in shard_paths], dtype=bool)
+            shard_paths = [p for p, k in zip(shard_paths, keep) if k]
+            vectors = vectors[keep]
+        paths.extend(shard_paths)
+        blocks.append(np.asarray(vectors))
+    store.close()
+    vectors = np.concatenate(blocks) if blocks else np.empty((0, store.dim), dtype=np.float16)
+    return paths, vectors
+
+
+def _threshold_pairs(sims, rows, cols, threshold):
+    """(i, j, sim) entries of a similarity block that pass the threshold with i < j."""
+    r, c = np.nonzero(sims >= threshold)
+    i, j = rows[r], cols[c]
+    keep = i < j
+    return i[keep], j[keep], sims[r[keep], c[keep]]
+
+
+def exact_pairs(vectors, threshold=SIMILARITY_THRESHOLD, block_size=BLOCK_SIZE):
+    """
+    Yield (i, j, sim) blocks of all pairs with cosine similarity >= threshold
+    using blocked matrix multiplies over the upper triangle. O(N²): use as a
+    correctness baseline or for small sets.
+    """
+    n = len(vectors)
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        query = vectors[rows].astype(np.float32)
+        for col_start in range(start, n, block_size):
+            cols = np.arange(col_start, min(col_start + block_size, n))
+            sims = query @ vectors[cols].astype(np.float32).T
+            i, j, s = _threshold_pairs(sims, rows, cols, threshold)
+            if len(i):
+                yield i, j, s
+
+
+def _assign(vectors, centroids, top=1, block_size=BLOCK_SIZE):
+    """Indices of the `top` most similar centroids for every vector."""
+    out = np.empty((len(vectors), top), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        sims = vectors[start:start + block_size].astype(np.float32) @ centroids.T
+        if top == 1:
+            out[start:start + block_size, 0] = sims.argmax(axis=1)
+        else:
+            out[start:start + block_size] = np.argpartition(-sims, top - 1, axis=1)[:, :top]
+    return out
+
+
+class IVFIndex:
+    """
+    Inverted-file index for cosine similarity on normalized vectors.
+
+    A spherical k-means coarse quantizer splits the vectors into n_lists cells.
+    A query is compared only with the members of its n_probe most similar
+    cells, which turns the all-pairs self-join into many small matmuls.
+    """
+
+    def __init__(self, vectors, n_lists=None, seed=0, iters=KMEANS_ITERS):
+        self.vectors = vectors
+        n = len(vectors)
+        self.n_lists = min(n, n_lists or max(1, int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, 256 * self.n_lists), replace=False)].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), size=self.n_lists, replace=False)]
+        for _ in range(iters):
+            labels = _assign(sample, centroids)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=self.n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+        self.centroids = centroids
+        labels = _assign(vectors, centroids)[:, 0]
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(self.n_lists + 1))
+        self.lists = [order[bounds[l]:bounds[l + 1]] for l in range(self.n_lists)]
+
+    def pairs(self, threshold=SIMILARITY_THRESHOLD, n_probe=N_PROBE):
+        """
+        Yield one (i, j, sim) block of approximate pairs with similarity >= threshold
+        and i < j. A pair is found if either image probes the other's list, so
+        hits are normalized to (min, max) and deduplicated across lists.
+        """
+        n_probe = min(n_probe, self.n_lists)
+        probes = _assign(self.vectors, self.centroids, top=n_probe)
+        # Invert: which queries probe each list
+        flat = probes.ravel()
+        queries = np.repeat(np.arange(len(self.vectors)), n_probe)
+        order = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[order], np.arange(self.n_lists + 1))
+        found_i, found_j, found_s = [], [], []
+        for l, members in enumerate(self.lists):
+            if len(members) == 0:
+                continue
+            member_vectors = self.vectors[members].astype(np.float32)
+            probing = queries[order[bounds[l]:bounds[l + 1]]]
+            for start in range(0, len(probing), BLOCK_SIZE):
+                rows = probing[start:start + BLOCK_SIZE]
+                sims = self.vectors[rows].astype(np.float32) @ member_vectors.T
+                r, c = np.nonzero(sims >= threshold)
+                i, j = rows[r], members[c]
+                keep = i != j
+                found_i.append(np.minimum(i[keep], j[keep]))
+                found_j.append(np.maximum(i[keep], j[keep]))
+                found_s.append(sims[r[keep], c[keep]])
+        if not found_i:
+            return
+        i, j, s = np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_s)
+        _, first = np.unique(i.astype(np.int64) * len(self.vectors) + j, return_index=True)
+        if len(first):
+            yield i[first], j[first], s[first]
+
+
+def pair_recall(vectors, threshold=SIMILARITY_THRESHOLD, n_probe=N_PROBE, sample_size=RECALL_SAMPLE, seed=0):
+    """Fraction of exact pairs the IVF search finds on a random sample."""
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+    sample = vectors[idx]
+    exact = {(i, j) for ib, jb, _ in exact_pairs(sample, threshold) for i, j in zip(ib.tolist(), jb.tolist())}
+    if not exact:
+        return 1.0
+    found = {(i, j) for ib, jb, _ in IVFIndex(sample).pairs(threshold, n_probe)
+             for i, j in zip(ib.tolist(), jb.tolist())}
+    return len(exact & found) / len(exact)
+
+
+@instrumented("semantic_dedup")
+def find_semantic_duplicates(base_dirs, threshold=SIMILARITY_THRESHOLD, method=METHOD, n_probe=N_PROBE):
+    """
+    Group images whose CLIP embeddings have cosine similarity >= threshold.
+    Writes semantic_duplicates.json ({path: [paths]}, the format of
+    all_duplicates_*.json / global_duplicates.json) and semantic_duplicate_groups.json.
+    """
+    stage = current_stage()
+    with stage.timer('load'):
+        paths, vectors = load_embeddings(base_dirs)
+    stage.items(len(paths))
+    print(f"Semantic duplicate search over {len(paths)} embeddings ({method}, similarity >= {threshold})")
+    if not paths:
+        return []
+    with stage.timer('search'):
+        if method == "exact":
+            pairs = list(exact_pairs(vectors, threshold))
+        elif method == "ivf":
+            pairs = list(IVFIndex(vectors).pairs(threshold, n_probe))
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+    semantic_duplicates = defaultdict(list)
+    for i_block, j_block, _ in pairs:
+        for i, j in zip(i_block.tolist(), j_block.tolist()):
+            semantic_duplicates[paths[i]].append(paths[j])
+            semantic_duplicates[paths[j]].append(paths[i])
+    groups = [[paths[i] for i in group] for group in duplicate_groups(len(paths), pairs)]
+
+    with open('semantic_duplicates.json', 'w') as f:
+        json.dump({k: sorted(v) for k, v in sorted(semantic_duplicates.items())}, f, indent=2)
+    with open('semantic_duplicate_groups.json', 'w') as f:
+        json.dump(groups, f, indent=2)
+
+    print(f"✅ {len(groups)} groups, {sum(len(g) for g in groups)} images saved to semantic_duplicates.json")
+    return groups
+
+
+if __name__ == "__main__":
+    find_semantic_duplicates(base_dirs)
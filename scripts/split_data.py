@@ -1,65 +1,180 @@
 import os
 import json
-from PIL import Image
+import numpy as np
 from tqdm import tqdm
+from manifest import refresh_manifest, load_image_columns
+from image_probe import probe_manifest
+from metrics import instrumented, current_stage
 
 base_dir = '/home/user/kz-mm/data/full_dataset'
-train_samples = []
-valid_samples = []
-
-def compute_sorting_score(image_path, aesthetic_score):
-    try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            return (width * height) * aesthetic_score
-    except Exception as e:
-        print(f"⚠️ Failed to open {image_path}: {e}")
-        return -1
-
-for cluster in tqdm(os.listdir(base_dir), desc="Clusters"):
-    cluster_path = os.path.join(base_dir, cluster)
-    if not os.path.isdir(cluster_path):
-        continue
-
-    for subcluster in os.listdir(cluster_path):
-        subcluster_path = os.path.join(cluster_path, subcluster)
-        if not os.path.isdir(subcluster_path):
-            continue
 
-        for topic in os.listdir(subcluster_path):
-            topic_path = os.path.join(subcluster_path, topic)
-            if not os.path.isdir(topic_path):
-                continue
+# name → (train, valid) images per topic, taken from the top of the topic's ranking
+SPLITS = {
+    'Xsmall': (4, 2),
+    'S': (16, 4),
+    'M': (64, 8),
+    'L': (256, 16),
+}
+# Outputs of find_duplicates.py / semantic_dedup.py used for the leakage check
+DUPLICATE_GROUP_FILES = ['global_duplicate_groups.json', 'semantic_duplicate_groups.json']
 
-            json_path = os.path.join(topic_path, 'aesthetic_data.json')
-            if not os.path.exists(json_path):
-                continue
 
+def load_split_columns(base_dir):
+    """
+    Manifest columns of base_dir plus an `aesthetic` float column (NaN when the
+    topic has no score for the image), read once per topic's aesthetic_data.json.
+    """
+    columns = load_image_columns([base_dir])
+    aesthetic = np.full(len(columns['path']), np.nan)
+    topic_paths = columns['topic_path']
+    # Rows come grouped by topic: one JSON read and one vectorized lookup per run of rows
+    bounds = np.flatnonzero(np.r_[True, topic_paths[1:] != topic_paths[:-1], True]) if len(topic_paths) else []
+    for start, end in tqdm(list(zip(bounds[:-1], bounds[1:])), desc="Topics"):
+        json_path = os.path.join(topic_paths[start], 'aesthetic_data.json')
+        try:
             with open(json_path) as f:
-                aesthetics = json.load(f)
+                scores = json.load(f)
+        except (OSError, ValueError):
+            continue
+        aesthetic[start:end] = [scores.get(name, np.nan) for name in columns['filename'][start:end]]
+    columns['aesthetic'] = aesthetic
+    return columns
+
+
+def sorting_scores(columns):
+    """Resolution × aesthetic score per image; -1 for images without dimensions or score."""
+    pixels = columns['width'].astype(np.float64) * columns['height']
+    scores = pixels * columns['aesthetic']
+    scores[~(pixels > 0) | np.isnan(scores)] = -1
+    return scores
+
+
+def grouped_topk(groups, scores, k):
+    """
+    Row indices of the k best positive scores of every group, ordered by group
+    and then by descending score (ties by row index), with each row's rank.
+    Groups are padded into size buckets (powers of two) so one partition per
+    bucket selects the top k without sorting whole groups.
+    """
+    valid = scores > 0
+    rows = np.flatnonzero(valid)
+    groups, scores = groups[valid], scores[valid]
+    if rows.size == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    order = np.argsort(groups, kind='stable')
+    rows, groups, scores = rows[order], groups[order], scores[order]
+    group_ids, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+    position = np.arange(rows.size) - np.repeat(starts, counts)
+    bucket_of_group = np.ceil(np.log2(counts)).astype(np.int64)
+    bucket = np.repeat(bucket_of_group, counts)
+
+    out_rows, out_ranks, out_groups = [], [], []
+    for b in np.unique(bucket_of_group):
+        width = 1 << int(b)
+        in_bucket = bucket == b
+        member_groups = np.flatnonzero(bucket_of_group == b)
+        slot = np.repeat(np.arange(member_groups.size), counts[member_groups])
+        matrix = np.full((member_groups.size, width), -np.inf)
+        index = np.full((member_groups.size, width), -1, dtype=np.int64)
+        matrix[slot, position[in_bucket]] = scores[in_bucket]
+        index[slot, position[in_bucket]] = rows[in_bucket]
+
+        kk = min(k, width)
+        if kk < width:
+            # k-th best per group, then everything above it plus the earliest rows tied with it
+            kth = -np.partition(-matrix, kk - 1, axis=1)[:, kk - 1:kk]
+            above = matrix > kth
+            tied = matrix == kth
+            take = above | (tied & (np.cumsum(tied, axis=1) <= kk - above.sum(axis=1, keepdims=True)))
+            matrix = matrix[take].reshape(-1, kk)
+            index = index[take].reshape(-1, kk)
+        ranked = np.lexsort((index, -matrix), axis=1)
+        matrix = np.take_along_axis(matrix, ranked, axis=1)
+        index = np.take_along_axis(index, ranked, axis=1)
+        keep = matrix > -np.inf
+        out_rows.append(index[keep])
+        out_ranks.append(np.broadcast_to(np.arange(kk), matrix.shape)[keep])
+        out_groups.append(np.broadcast_to(member_groups[:, None], matrix.shape)[keep])
+
+    out_rows, out_ranks, out_groups = (np.concatenate(a) for a in (out_rows, out_ranks, out_groups))
+    order = np.lexsort((out_ranks, out_groups))
+    return out_rows[order], out_ranks[order]
+
+
+def build_splits(columns, splits=SPLITS):
+    """{name: (train row indices, valid row indices)} for all splits from a single top-k pass."""
+    _, topic_ids = np.unique(columns['topic_path'].astype(str), return_inverse=True)
+    k = max(train + valid for train, valid in splits.values())
+    rows, ranks = grouped_topk(topic_ids, sorting_scores(columns), k)
+    return {
+        name: (rows[ranks < train], rows[(ranks >= train) & (ranks < train + valid)])
+        for name, (train, valid) in splits.items()
+    }
+
+
+def _relative_key(path):
+    """cluster/subcluster/topic/filename, shared by a source dataset image and its merged copy."""
+    return '/'.join(path.split(os.sep)[-4:])
+
+
+def load_duplicate_groups(files=DUPLICATE_GROUP_FILES):
+    """{relative key: group id} over all existing duplicate group files."""
+    group_of, next_id = {}, 0
+    for path in files:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for group in json.load(f):
+                for member in group:
+                    group_of[_relative_key(member)] = next_id
+                next_id += 1
+    return group_of
+
+
+def check_leakage(columns, splits, group_of, drop=True):
+    """
+    Duplicate groups with members on both the train and valid side of a split.
+    With drop=True those valid images are removed. Returns {name: leaked groups}.
+    """
+    if not group_of:
+        return {}
+    group_ids = np.array([group_of.get(_relative_key(p), -1) for p in columns['path']], dtype=np.int64)
+    leaks = {}
+    for name, (train, valid) in splits.items():
+        train_groups = group_ids[train]
+        leaked = np.intersect1d(train_groups[train_groups >= 0], group_ids[valid])
+        leaks[name] = int(leaked.size)
+        if drop and leaked.size:
+            splits[name] = (train, valid[~np.isin(group_ids[valid], leaked)])
+    return leaks
+
+
+def save_splits(columns, splits, output_dir='.'):
+    for name, (train, valid) in splits.items():
+        for kind, rows in (('train', train), ('valid', valid)):
+            with open(os.path.join(output_dir, f'{kind}_set_{name}.json'), 'w') as f:
+                json.dump(columns['path'][rows].tolist(), f, indent=2)
 
-            image_scores = []
-            for image_name, score in aesthetics.items():
-                image_path = os.path.join(topic_path, image_name)
-                try:
-                    sort_score = compute_sorting_score(image_path, score)
-                except:
-                    continue
-                if sort_score > 0:
-                    image_scores.append((sort_score, image_path))
 
-            image_scores.sort(reverse=True)
+@instrumented("split")
+def create_splits(base_dir, output_dir='.'):
+    """Probe, rank, leak-check and save all splits of base_dir. Returns {name: (train, valid)}."""
+    refresh_manifest([base_dir])
+    probe_manifest([base_dir])
 
-            train_samples.extend([img for _, img in image_scores[:4]])
-            valid_samples.extend([img for _, img in image_scores[4:6]])
+    columns = load_split_columns(base_dir)
+    current_stage().items(len(columns['path']))
+    splits = build_splits(columns)
+    leaks = check_leakage(columns, splits, load_duplicate_groups())
+    save_splits(columns, splits, output_dir)
 
-# Save to JSON
-with open('train_set_Xsmall.json', 'w') as f:
-    json.dump(train_samples, f, indent=2)
+    # Print summary
+    for name, (train, valid) in splits.items():
+        leak_note = f" ({leaks[name]} leaking duplicate groups dropped from valid)" if leaks.get(name) else ""
+        print(f"✅ {name}: train {len(train)} / valid {len(valid)} images{leak_note}")
+    return splits
 
-with open('valid_set_Xsmall.json', 'w') as f:
-    json.dump(valid_samples, f, indent=2)
 
-# Print summary
-print(f"✅ Train set: {len(train_samples)} images")
-print(f"✅ Valid set: {len(valid_samples)} images")
\ No newline at end of file
+if __name__ == "__main__":
+    create_splits(base_dir)
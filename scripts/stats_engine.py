@@ -0,0 +1,313 @@
+import os
+import json
+import sqlite3
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+from manifest import (MANIFEST_PATH, connect as connect_manifest, refresh_manifest, iter_topics, iter_images,
+                      root_filter, load_topic_duplicates)
+from image_probe import probe_manifest
+from metrics import instrumented, current_stage
+
+STATS_DB = "stats_partials.sqlite"
+STATISTICS_JSON = "dataset_statistics.json"
+SKETCH_K = 200  # ~1% rank error; samples of up to SKETCH_K values are kept exactly
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+LEVELS = ("topic", "subcluster", "cluster", "dataset", "all")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS partials (
+    topic_path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+def get_resolution_group(width, height):
+    pixels = width * height
+    if pixels < 500_000:
+        return 'small'
+    elif pixels <= 2_000_000:
+        return 'medium'
+    else:
+        return 'large'
+
+
+class QuantileSketch:
+    """
+    KLL-style mergeable quantile sketch. Level i holds values of weight 2**i;
+    a level over its capacity is sorted and every other value is promoted.
+    Compaction offsets alternate instead of being random, so a sketch built from
+    the same data (and merged in the same order) is always identical.
+    """
+
+    def __init__(self, k=SKETCH_K):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.total = 0.0
+        self.flip = 0
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            buf = self.levels[level]
+            if buf.size > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                buf = np.sort(buf)
+                keep, buf = (buf[-1:], buf[:-1]) if buf.size % 2 else (buf[:0], buf)
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], buf[self.flip::2]])
+                self.levels[level] = keep
+                self.flip ^= 1
+            level += 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return self
+        self.n += int(values.size)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.total += float(values.sum())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        if not other.n:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for i, buf in enumerate(other.levels):
+            self.levels[i] = np.concatenate([self.levels[i], buf])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.total += other.total
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Value at rank q (exact, interpolated like np.quantile, while nothing was compacted)."""
+        if not self.n:
+            return None
+        if len(self.levels) == 1:
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(buf.size, 2 ** i) for i, buf in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        idx = min(int(np.searchsorted(cumulative, q * cumulative[-1], side='left')), values.size - 1)
+        return float(values[order][idx])
+
+    def summary(self, quantiles=QUANTILES):
+        if not self.n:
+            return {'n': 0}
+        out = {'n': self.n, 'min': self.min, 'mean': self.total / self.n, 'max': self.max}
+        out.update({f'p{int(q * 100)}': self.quantile(q) for q in quantiles})
+        return out
+
+    def to_dict(self):
+        return {'k': self.k, 'n': self.n, 'min': self.min, 'max': self.max, 'total': self.total,
+                'flip': self.flip, 'levels': [buf.tolist() for buf in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['k'])
+        sketch.n, sketch.min, sketch.max = data['n'], data['min'], data['max']
+        sketch.total, sketch.flip = data['total'], data['flip']
+        sketch.levels = [np.asarray(buf, dtype=np.float64) for buf in data['levels']]
+        return sketch
+
+
+class StatsNode:
+    """Counters plus named quantile sketches for one topic / subcluster / cluster / dataset."""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.sketches = {}
+
+    def add(self, metric, values):
+        self.sketches.setdefault(metric, QuantileSketch()).update(values)
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        for metric, sketch in other.sketches.items():
+            self.sketches.setdefault(metric, QuantileSketch(sketch.k)).merge(sketch)
+        return self
+
+    def median(self, metric):
+        sketch = self.sketches.get(metric)
+        return sketch.quantile(0.5) if sketch else None
+
+    def summary(self):
+        return {'counts': dict(self.counters),
+                'distributions': {m: s.summary() for m, s in sorted(self.sketches.items())}}
+
+    def to_dict(self):
+        return {'counters': dict(self.counters), 'sketches': {m: s.to_dict() for m, s in self.sketches.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        node = cls()
+        node.counters.update(data['counters'])
+        node.sketches = {m: QuantileSketch.from_dict(s) for m, s in data['sketches'].items()}
+        return node
+
+
+def topic_partial(topic, images):
+    """StatsNode of one topic from its manifest rows, aesthetic_data.json and duplicates_<topic>.json."""
+    node = StatsNode()
+    node.counters['topics'] = 1
+    node.counters['images'] = len(images)
+    node.counters.update(f'format:{img.format}' for img in images)
+
+    widths = np.array([img.width or 0 for img in images], dtype=np.int64)
+    heights = np.array([img.height or 0 for img in images], dtype=np.int64)
+    readable = (widths > 0) & (heights > 0)
+    node.counters['unreadable'] = int((~readable).sum())
+    node.counters.update(f'resolution:{w}x{h}' for w, h in zip(widths[readable], heights[readable]))
+    node.counters.update(f'resolution_group:{get_resolution_group(w, h)}'
+                         for w, h in zip(widths[readable], heights[readable]))
+    node.add('megapixels', widths[readable] * heights[readable] / 1e6)
+    node.add('file_size_kb', np.array([img.size for img in images], dtype=np.float64) / 1024)
+
+    try:
+        with open(os.path.join(topic.path, 'aesthetic_data.json')) as f:
+            scores = list(json.load(f).values())
+    except (OSError, ValueError):
+        scores = []
+    node.counters['scored_images'] = len(scores)
+    node.add('aesthetic', scores)
+    node.counters['duplicates'] = len(load_topic_duplicates(os.path.dirname(topic.path), topic.topic))
+    return node
+
+
+def topic_fingerprints(base_dirs, db_path=MANIFEST_PATH):
+    """
+    {topic_path: fingerprint} covering the topic's images (count, sizes, mtimes,
+    probed dimensions) and the mtimes of its score and duplicate files.
+    """
+    where, params = root_filter(base_dirs)
+    conn = connect_manifest(db_path)
+    image_parts = {
+        row[0]: row[1:] for row in conn.execute(
+            "SELECT topic_path, COUNT(*), MAX(mtime_ns), SUM(size), SUM(COALESCE(width, 0) + COALESCE(height, 0)) "
+            f"FROM images{where} GROUP BY topic_path", params)
+    }
+    conn.close()
+    fingerprints = {}
+    for topic in iter_topics(base_dirs, db_path):
+        sidecars = []
+        for path in (os.path.join(topic.path, 'aesthetic_data.json'),
+                     os.path.join(os.path.dirname(topic.path), f'duplicates_{topic.topic}.json')):
+            try:
+                sidecars.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                sidecars.append(0)
+        fingerprints[topic.path] = json.dumps([list(image_parts.get(topic.path, ())), sidecars])
+    return fingerprints
+
+
+def update_partials(base_dirs, db_path=STATS_DB, full=False):
+    """
+    Recompute the stored per-topic partials whose fingerprint changed (all with
+    full=True) and drop topics that disappeared. Returns the number recomputed.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    fingerprints = topic_fingerprints(base_dirs)
+    roots = [os.path.abspath(b) for b in base_dirs]
+    stored = {}
+    for root in roots:
+        stored.update(conn.execute("SELECT topic_path, fingerprint FROM partials WHERE root = ?", (root,)))
+
+    changed = [t for t in iter_topics(base_dirs) if full or stored.get(t.path) != fingerprints[t.path]]
+    stage = current_stage()
+    stage.count('topics_unchanged', len(fingerprints) - len(changed))
+    for topic in tqdm(changed, desc="Topic statistics"):
+        node = topic_partial(topic, list(iter_images(topic_path=topic.path)))
+        meta = {'dataset': topic.dataset, 'cluster': topic.cluster, 'subcluster': topic.subcluster,
+                'topic': topic.topic}
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?, ?)",
+                         (topic.path, topic.root, fingerprints[topic.path], json.dumps(meta, ensure_ascii=False),
+                          json.dumps(node.to_dict())))
+        stage.items(node.counters['images'])
+    gone = [(p,) for p in stored if p not in fingerprints]
+    with conn:
+        conn.executemany("DELETE FROM partials WHERE topic_path = ?", gone)
+    conn.close()
+    print(f"[STATS] {len(changed)}/{len(fingerprints)} topics recomputed, {len(gone)} removed")
+    return len(changed)
+
+
+def rollup(base_dirs, db_path=STATS_DB):
+    """
+    Merge the stored topic partials into {level: {key: StatsNode}} for every
+    level in LEVELS. Parent levels also get distributions of per-topic values
+    (topic_images, topic_duplicates, topic_aesthetic_median); dataset and all
+    get the per-cluster ones (cluster_images, cluster_duplicates).
+    """
+    levels = {level: {} for level in LEVELS}
+    conn = sqlite3.connect(db_path)
+    where, params = root_filter(base_dirs)
+    rows = conn.execute(f"SELECT meta, data FROM partials{where} ORDER BY topic_path", params).fetchall()
+    conn.close()
+
+    for meta, data in rows:
+        meta, node = json.loads(meta), StatsNode.from_dict(json.loads(data))
+        subcluster_key = f"{meta['dataset']}/{meta['cluster']}/{meta['subcluster']}"
+        keys = {
+            'topic': f"{subcluster_key}/{meta['topic']}",
+            'subcluster': subcluster_key,
+            'cluster': f"{meta['dataset']}/{meta['cluster']}",
+            'dataset': meta['dataset'],
+            'all': 'all',
+        }
+        levels['topic'][keys['topic']] = node
+        topic_median = node.median('aesthetic')
+        for level in LEVELS[1:]:
+            parent = levels[level].setdefault(keys[level], StatsNode())
+            parent.merge(node)
+            parent.add('topic_images', [node.counters['images']])
+            parent.add('topic_duplicates', [node.counters['duplicates']])
+            if topic_median is not None:
+                parent.add('topic_aesthetic_median', [topic_median])
+
+    for cluster_key, node in levels['cluster'].items():
+        for parent in (levels['dataset'][cluster_key.split('/', 1)[0]], levels['all']['all']):
+            parent.add('cluster_images', [node.counters['images']])
+            parent.add('cluster_duplicates', [node.counters['duplicates']])
+    return levels
+
+
+@instrumented("stats")
+def build_statistics(base_dirs, db_path=STATS_DB, full=False, output_path=STATISTICS_JSON, probe=True):
+    """
+    Refresh manifest and probes, update changed topic partials, roll up and save
+    every level's summary. probe=False skips probing image dimensions (enough for
+    counts and duplicates; partials are redone once the images are probed).
+    """
+    refresh_manifest(base_dirs)
+    if probe:
+        probe_manifest(base_dirs)
+    update_partials(base_dirs, db_path, full)
+    levels = rollup(base_dirs, db_path)
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({level: {key: node.summary() for key, node in sorted(nodes.items())}
+                       for level, nodes in levels.items()}, f, ensure_ascii=False, indent=2)
+        print(f"[STATS] Summaries of all levels saved to {output_path}")
+    return levels